@@ -8,18 +8,14 @@
 
 from qiita_client import QiitaPlugin
 
-from qiime2 import __version__ as qiime2_version
-from qiime2.sdk import PluginManager
-from qiime2.sdk.util import actions_by_input_type
-
 from .qp_qiime2 import (
     QIITA_Q2_SEMANTIC_TYPE, Q2_ANALYSIS_PLUGINS, Q2_PROCESSING_PLUGINS,
     Q2_EXTRA_COMMANDS)
-from .util import register_qiime2_commands
-
+from .util import (
+    register_qiime2_commands, get_registry_cache_key, load_registry_cache,
+    save_registry_cache)
 
-# Initialize the qiita_plugin
-plugin = QiitaPlugin('qiime2', qiime2_version, 'QIIME 2 - Analysis')
+DESCRIPTION = 'QIIME 2 - Analysis'
 
 
 # PLEASE READ:
@@ -38,61 +34,99 @@ plugin = QiitaPlugin('qiime2', qiime2_version, 'QIIME 2 - Analysis')
 # we are going to store each parameter twice: one in the
 # opt_params[q2-description]: value; and
 # req_params['qp-hide-param' + q2-description]: q2-parameter
+def _register_commands():
+    from qiime2 import __version__ as qiime2_version
+    from qiime2.sdk import PluginManager
+    from qiime2.sdk.util import actions_by_input_type
+
+    # Initialize the qiita_plugin
+    plugin = QiitaPlugin('qiime2', qiime2_version, DESCRIPTION)
+
+    pm = PluginManager()
+    methods_to_add = []
+    for plugin_name, method_name in Q2_EXTRA_COMMANDS:
+        q2plugin = pm.plugins[plugin_name]
+        m = q2plugin.actions[method_name]
+        methods_to_add.append((q2plugin, m))
+
+    for qiita_artifact, q2_artifacts in QIITA_Q2_SEMANTIC_TYPE.items():
+        if q2_artifacts['expression']:
+            actions = [a for e in q2_artifacts['expression']
+                       for a in actions_by_input_type('%s[%s]' % (
+                           q2_artifacts['name'], e))]
+        else:
+            actions = actions_by_input_type(q2_artifacts['name'])
+
+        for q2plugin, methods in actions:
+            # note that the qiita_artifact are strings not objects
+            if qiita_artifact.startswith('BIOM'):
+                qiita_artifact = 'BIOM'
+
+            if q2plugin.name not in Q2_ANALYSIS_PLUGINS:
+                # As of qiime2-2022.11 this filters out:
+                # alignment
+                # deblur
+                # diversity-lib
+                # feature-classifier
+                # fragment-insertion
+                # greengenes2
+                # quality-control
+                # sourcetracker2
+                # vsearch
+                continue
+
+            for m in methods:
+                # after review of qiime2-2019.4 we decided to not add these
+                # methods
+                if (q2plugin.name, m.id) not in [
+                        ('feature-table', 'group'),
+                        ('feature-table', 'filter_seqs'),
+                        # qiime2-2022.11 we added this:
+                        ('composition', 'ancombc')]:
+                    methods_to_add.append((q2plugin, m))
+
+    # make sure we have seen all expected analysis plugins
+    q2_expected_plugins = register_qiime2_commands(
+        plugin, methods_to_add, Q2_ANALYSIS_PLUGINS.copy())
+    if q2_expected_plugins:
+        raise ValueError(f'Never saw plugin(s): {q2_expected_plugins}')
+
+    # make sure we have seen all expected processing plugins
+    gg2 = pm.plugins['greengenes2']
+    methods = [
+        (gg2, gg2.methods['filter_features']),
+        (gg2, gg2.actions['non_v4_16s']),
+    ]
+    q2_expected_plugins = register_qiime2_commands(
+        plugin, methods, Q2_PROCESSING_PLUGINS.copy(), False)
+    if q2_expected_plugins:
+        raise ValueError(f'Never saw plugin(s): {q2_expected_plugins}')
+
+    return plugin
+
+
+def _get_plugin():
+    # Scanning all the qiime2 plugins is slow so we store the resulting
+    # commands in a registry cache (if QP_QIIME2_CACHE is set), see util.py
+    # for details. Note that when the cache is valid we don't import qiime2
+    # at all so start_qiime2 can retrieve the job information from Qiita
+    # right away; qiime2 will be imported by call_qiime2 when it's actually
+    # needed
+    registry_cache_key = get_registry_cache_key()
+    plugin = load_registry_cache(registry_cache_key, DESCRIPTION)
+    if plugin is None:
+        plugin = _register_commands()
+        save_registry_cache(plugin, registry_cache_key)
+    return plugin
+
 
-pm = PluginManager()
-methods_to_add = []
-for plugin_name, method_name in Q2_EXTRA_COMMANDS:
-    q2plugin = pm.plugins[plugin_name]
-    m = q2plugin.actions[method_name]
-    methods_to_add.append((q2plugin, m))
-
-for qiita_artifact, q2_artifacts in QIITA_Q2_SEMANTIC_TYPE.items():
-    if q2_artifacts['expression']:
-        actions = [a for e in q2_artifacts['expression']
-                   for a in actions_by_input_type('%s[%s]' % (
-                       q2_artifacts['name'], e))]
-    else:
-        actions = actions_by_input_type(q2_artifacts['name'])
-
-    for q2plugin, methods in actions:
-        # note that the qiita_artifact are strings not objects
-        if qiita_artifact.startswith('BIOM'):
-            qiita_artifact = 'BIOM'
-
-        if q2plugin.name not in Q2_ANALYSIS_PLUGINS:
-            # As of qiime2-2022.11 this filters out:
-            # alignment
-            # deblur
-            # diversity-lib
-            # feature-classifier
-            # fragment-insertion
-            # greengenes2
-            # quality-control
-            # sourcetracker2
-            # vsearch
-            continue
-
-        for m in methods:
-            # after review of qiime2-2019.4 we decided to not add these methods
-            if (q2plugin.name, m.id) not in [('feature-table', 'group'),
-                                             ('feature-table', 'filter_seqs'),
-                                             # qiime2-2022.11 we added this:
-                                             ('composition', 'ancombc')]:
-                methods_to_add.append((q2plugin, m))
-
-# make sure we have seen all expected analysis plugins
-q2_expected_plugins = register_qiime2_commands(
-    plugin, methods_to_add, Q2_ANALYSIS_PLUGINS.copy())
-if q2_expected_plugins:
-    raise ValueError(f'Never saw plugin(s): {q2_expected_plugins}')
-
-# make sure we have seen all expected processing plugins
-gg2 = pm.plugins['greengenes2']
-methods = [
-    (gg2, gg2.methods['filter_features']),
-    (gg2, gg2.actions['non_v4_16s']),
-]
-q2_expected_plugins = register_qiime2_commands(
-    plugin, methods, Q2_PROCESSING_PLUGINS.copy(), False)
-if q2_expected_plugins:
-    raise ValueError(f'Never saw plugin(s): {q2_expected_plugins}')
+def __getattr__(name):
+    # the plugin is only created when it's first imported so importing the
+    # other modules, for example the daemon to forward a job to it (see
+    # daemon.py), doesn't register the commands
+    if name == 'plugin':
+        global plugin
+        plugin = _get_plugin()
+        return plugin
+    raise AttributeError(
+        'module %r has no attribute %r' % (__name__, name))
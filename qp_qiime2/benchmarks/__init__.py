@@ -0,0 +1,19 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from .suite import (
+    BENCHMARKS, ALL_BENCHMARKS, run_benchmark, format_results)
+from .synthetic import generate_dataset
+from .fake_qiita import FakeQiitaClient
+from .baseline import (
+    save_baseline, load_baseline, compare_to_baseline, format_comparison)
+
+__all__ = ['BENCHMARKS', 'ALL_BENCHMARKS', 'run_benchmark',
+           'format_results', 'generate_dataset', 'FakeQiitaClient',
+           'save_baseline', 'load_baseline', 'compare_to_baseline',
+           'format_comparison']
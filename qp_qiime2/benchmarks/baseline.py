@@ -0,0 +1,181 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from datetime import datetime
+from json import dump, load
+from importlib.metadata import version, PackageNotFoundError
+
+# the version of the format of the baseline files, it should be increased
+# when the format changes in a way that old files can't be compared
+BASELINE_VERSION = 1
+# the metrics compared: {metric: (description, unit, unit size, minimum
+# absolute difference to be a regression)}; the minimum difference avoids
+# reporting the noise of the small benchmarks as regressions
+METRICS = {
+    'wall_time': ('wall time', 's', 1, 0.5),
+    'peak_rss': ('peak memory', 'MB', 2 ** 20, 16 * 2 ** 20)}
+# the parameters of the dataset, they must match to compare the results
+DATASET_PARAMETERS = ('samples', 'features', 'seed', 'richness')
+
+
+def _get_qiime2_version():
+    try:
+        return version('qiime2')
+    except PackageNotFoundError:
+        return None
+
+
+def save_baseline(fp, results, dataset_parameters):
+    """Stores the results of the benchmarks as a baseline
+
+    Parameters
+    ----------
+    fp : str
+        The path of the baseline file
+    results : list of dict
+        The results of the benchmarks, see suite.run_benchmark
+    dataset_parameters : dict
+        The parameters used to generate the dataset, see DATASET_PARAMETERS
+    """
+    benchmarks = {}
+    for result in results:
+        if not result['success']:
+            raise ValueError('Benchmark "%s" failed, it can not be used as '
+                             'baseline: %s' % (result['name'],
+                                               result['message']))
+        benchmarks[result['name']] = {m: result[m] for m in METRICS}
+
+    with open(fp, 'w') as f:
+        dump({'version': BASELINE_VERSION,
+              'qiime2': _get_qiime2_version(),
+              'created': datetime.now().isoformat(),
+              'dataset': {p: dataset_parameters.get(p)
+                          for p in DATASET_PARAMETERS},
+              'benchmarks': benchmarks}, f, indent=4, sort_keys=True)
+
+
+def load_baseline(fp):
+    """Loads a baseline file
+
+    Parameters
+    ----------
+    fp : str
+        The path of the baseline file
+
+    Returns
+    -------
+    dict
+        The baseline, see save_baseline
+
+    Raises
+    ------
+    ValueError
+        If the baseline version is not supported
+    """
+    with open(fp) as f:
+        baseline = load(f)
+    if baseline.get('version') != BASELINE_VERSION:
+        raise ValueError(
+            'Baseline version %s is not supported, expected %d; please '
+            'store the baseline again' % (
+                baseline.get('version'), BASELINE_VERSION))
+    return baseline
+
+
+def compare_to_baseline(results, baseline, dataset_parameters,
+                        tolerance=0.2, memory_tolerance=None):
+    """Compares the results of the benchmarks with a baseline
+
+    Parameters
+    ----------
+    results : list of dict
+        The results of the benchmarks, see suite.run_benchmark
+    baseline : dict
+        The baseline, see load_baseline
+    dataset_parameters : dict
+        The parameters used to generate the dataset, see DATASET_PARAMETERS
+    tolerance : float, optional
+        The fraction that a metric can grow before it's a regression, 0.2
+        means that 20% slower is still fine
+    memory_tolerance : float, optional
+        The tolerance for the memory, if None it's the same as tolerance
+
+    Returns
+    -------
+    list of dict
+        One per benchmark and metric: {'name', 'metric', 'baseline',
+        'current', 'ratio', 'regression'}; the failed benchmarks are
+        always regressions and the benchmarks that are not in the baseline
+        are never regressions (their baseline is None)
+
+    Raises
+    ------
+    ValueError
+        If the dataset parameters are not the same as in the baseline
+    """
+    dataset_parameters = {p: dataset_parameters.get(p)
+                          for p in DATASET_PARAMETERS}
+    if dataset_parameters != baseline['dataset']:
+        raise ValueError(
+            'The dataset (%s) is not the same as the one of the baseline '
+            '(%s), they can not be compared' % (
+                dataset_parameters, baseline['dataset']))
+    tolerances = {'wall_time': tolerance,
+                  'peak_rss': tolerance if memory_tolerance is None
+                  else memory_tolerance}
+
+    comparison = []
+    for result in results:
+        expected = baseline['benchmarks'].get(result['name'])
+        for metric, (_, _, _, min_difference) in METRICS.items():
+            current = result[metric] if result['success'] else None
+            previous = None if expected is None else expected[metric]
+            ratio = None
+            regression = not result['success']
+            if current is not None and previous:
+                ratio = current / previous
+                regression = (
+                    ratio > 1 + tolerances[metric] and
+                    current - previous > min_difference)
+            comparison.append({
+                'name': result['name'], 'metric': metric,
+                'baseline': previous, 'current': current, 'ratio': ratio,
+                'regression': regression})
+    return comparison
+
+
+def format_comparison(comparison):
+    """Formats a comparison as a table, one row per benchmark and metric
+
+    Parameters
+    ----------
+    comparison : list of dict
+        The comparison, see compare_to_baseline
+
+    Returns
+    -------
+    str
+        The table
+    """
+    def _value(value, unit_size):
+        return 'n/a' if value is None else '%.2f' % (value / unit_size)
+
+    rows = [('benchmark', 'metric', 'baseline', 'current', 'change', '')]
+    for row in comparison:
+        description, unit, unit_size, _ = METRICS[row['metric']]
+        change = ('n/a' if row['ratio'] is None
+                  else '%+.1f%%' % ((row['ratio'] - 1) * 100))
+        rows.append((
+            row['name'], '%s (%s)' % (description, unit),
+            _value(row['baseline'], unit_size),
+            _value(row['current'], unit_size), change,
+            'REGRESSION' if row['regression'] else ''))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(v.ljust(w) for v, w in zip(row, widths))
+                     .rstrip() for row in rows)
@@ -0,0 +1,58 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from re import compile
+from time import time
+from copy import deepcopy
+
+ARTIFACT_URL = compile(r'^/qiita_db/artifacts/(\d+)/$')
+METADATA_URL = compile(r'^/qiita_db/analysis/(\d+)/metadata/$')
+
+
+class FakeQiitaClient:
+    """An in-process stand-in of the Qiita REST API used by call_qiime2
+
+    Parameters
+    ----------
+    artifacts : dict of {int: dict}
+        The artifacts, {artifact id: artifact information} where the
+        information is what Qiita returns in /qiita_db/artifacts/<id>/; at
+        least: {'files': {filepath type: [{'filepath': str}]},
+        'analysis': analysis id}
+    analyses : dict of {int: dict}
+        The metadata of the analyses, {analysis id: metadata} where the
+        metadata is what Qiita returns in /qiita_db/analysis/<id>/metadata/:
+        {sample id: {column: value}}
+
+    Attributes
+    ----------
+    requests : list of (float, str)
+        The time and url of each of the GET requests
+    steps : list of (float, str, str)
+        The time, job id and text of each of the job step updates
+    """
+    def __init__(self, artifacts, analyses):
+        self.artifacts = artifacts
+        self.analyses = analyses
+        self.requests = []
+        self.steps = []
+
+    def get(self, url, **kwargs):
+        self.requests.append((time(), url))
+        match = ARTIFACT_URL.match(url)
+        if match is not None:
+            # copying so changes by the caller don't modify our artifacts,
+            # like with a real server
+            return deepcopy(self.artifacts[int(match.group(1))])
+        match = METADATA_URL.match(url)
+        if match is not None:
+            return deepcopy(self.analyses[int(match.group(1))])
+        raise ValueError('Unexpected request: %s' % url)
+
+    def update_job_step(self, job_id, new_step, ignore_error=False):
+        self.steps.append((time(), job_id, new_step))
@@ -0,0 +1,269 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import makedirs, environ
+from os.path import join
+from time import time
+from json import loads
+from subprocess import run, PIPE
+from sys import executable
+from tempfile import TemporaryDirectory
+
+from qp_qiime2.cache import load_json
+from qp_qiime2.profiling import PROFILE_FILENAME
+
+from .fake_qiita import FakeQiitaClient
+
+# the ids used in the fake Qiita
+ARTIFACT_ID = 1
+ANALYSIS_ID = 1
+
+# The benchmarks: {name: (q2 plugin, q2 method, parameters, use the tree)}
+# where parameters are {q2 parameter name: value or function}; the
+# functions receive the dataset (see synthetic.generate_dataset) and return
+# the value. The parameters not listed use their Qiita default.
+BENCHMARKS = {
+    'rarefy': ('feature-table', 'rarefy', {
+        'sampling_depth': lambda dataset: dataset['sampling_depth']}, False),
+    'alpha': ('diversity', 'alpha', {}, False),
+    'beta': ('diversity', 'beta', {}, False),
+    'beta_phylogenetic': ('diversity', 'beta_phylogenetic', {}, True),
+    'core_metrics': ('diversity', 'core_metrics', {
+        'sampling_depth': lambda dataset: dataset['sampling_depth']}, False),
+    'collapse': ('taxa', 'collapse', {'level': 6}, False),
+    'classify_sklearn': ('feature-classifier', 'classify_sklearn', {}, False),
+    'filter_features': ('feature-table', 'filter_features', {
+        'min_frequency': 10}, False)}
+# the benchmark of the registration of the QIIME 2 commands, when the plugin
+# is imported without the registry cache
+REGISTRATION_BENCHMARK = 'registration'
+ALL_BENCHMARKS = sorted(BENCHMARKS) + [REGISTRATION_BENCHMARK]
+
+# the code executed to benchmark the registration, in a new python process
+# so nothing is already imported; it prints the wall & CPU time and peak
+# RSS of each phase. Note that it doesn't use profiling.JobProfile as
+# importing it would import qp_qiime2 before the phases being measured.
+_REGISTRATION_CODE = '''
+from json import dumps
+from os import times
+from time import time
+from resource import getrusage, RUSAGE_SELF
+
+phases = []
+def add_phase(name, start, start_cpu):
+    t = times()
+    phases.append({
+        'name': name, 'wall': time() - start,
+        'cpu': t.user + t.system - start_cpu, 'children_cpu': 0,
+        'peak_rss': getrusage(RUSAGE_SELF).ru_maxrss * 1024,
+        'peak_rss_is_per_phase': False})
+    return time(), t.user + t.system
+
+start, start_cpu = time(), 0
+import qiime2.sdk
+qiime2.sdk.PluginManager()
+start, start_cpu = add_phase('Importing qiime2', start, start_cpu)
+from qp_qiime2 import plugin
+add_phase('Registering commands', start, start_cpu)
+print(dumps(phases))
+'''
+
+
+def get_command(q2plugin, q2method):
+    """Returns the Qiita command of a QIIME 2 method
+
+    Parameters
+    ----------
+    q2plugin : str
+        The QIIME 2 plugin name, like diversity
+    q2method : str
+        The QIIME 2 method id, like beta
+
+    Returns
+    -------
+    qiita_client.QiitaCommand
+
+    Raises
+    ------
+    ValueError
+        If the method is not registered
+    """
+    from qp_qiime2 import plugin
+
+    for cmd in plugin.task_dict.values():
+        req_params = cmd.required_parameters
+        if (req_params['qp-hide-plugin'][1] == q2plugin and
+                req_params['qp-hide-method'][1] == q2method):
+            return cmd
+    raise ValueError('%s %s is not registered' % (q2plugin, q2method))
+
+
+def build_parameters(command, artifact_id, parameters, use_tree):
+    """Builds the parameters of a job, as Qiita would
+
+    Parameters
+    ----------
+    command : qiita_client.QiitaCommand
+        The command
+    artifact_id : int
+        The artifact id to use for all the artifact parameters
+    parameters : dict of {str: object}
+        {q2 parameter name: value}, the parameters that shouldn't use the
+        default value
+    use_tree : bool
+        Whether to use the tree of the artifact
+
+    Returns
+    -------
+    dict of {str: str}
+        The job parameters
+    """
+    label = 'qp-hide-param'
+    all_params = dict(command.required_parameters)
+    all_params.update(command.optional_parameters)
+
+    job_params = {}
+    for name, (ptype, default) in all_params.items():
+        if ptype == 'artifact':
+            value = str(artifact_id)
+        elif name == 'Phylogenetic tree':
+            value = 'Artifact tree, if exists' if use_tree else 'None'
+        else:
+            value = default if isinstance(default, str) else str(default)
+        job_params[name] = value
+
+    for name, (_, default) in all_params.items():
+        if name.startswith(label) and default in parameters:
+            job_params[name[len(label):]] = str(parameters[default])
+
+    return job_params
+
+
+def run_registration_benchmark():
+    """Runs the registration benchmark, see REGISTRATION_BENCHMARK
+
+    Returns
+    -------
+    dict
+        The results, see run_benchmark
+    """
+    env = environ.copy()
+    env.pop('QP_QIIME2_CACHE', None)
+    start = time()
+    proc = run([executable, '-c', _REGISTRATION_CODE], stdout=PIPE,
+               stderr=PIPE, env=env, universal_newlines=True)
+    wall_time = time() - start
+
+    success = proc.returncode == 0
+    phases = loads(proc.stdout.strip().splitlines()[-1]) if success else []
+    return {
+        'name': REGISTRATION_BENCHMARK, 'success': success,
+        'message': '' if success else proc.stderr.strip(),
+        'wall_time': wall_time,
+        'peak_rss': max([p['peak_rss'] for p in phases], default=None),
+        'phases': phases, 'steps': []}
+
+
+def run_benchmark(name, dataset, out_dir):
+    """Runs a benchmark via call_qiime2
+
+    Parameters
+    ----------
+    name : str
+        The name of the benchmark, see BENCHMARKS
+    dataset : dict
+        The dataset to use, see synthetic.generate_dataset
+    out_dir : str
+        The folder where to run the job
+
+    Returns
+    -------
+    dict
+        The results: {'name', 'success', 'message', 'wall_time', 'peak_rss',
+        'phases', 'steps'} where phases is the profile of each step of the
+        job (see profiling.JobProfile) and steps the time of each job step
+        update, relative to the start of the job
+    """
+    from qp_qiime2.qp_qiime2 import call_qiime2
+
+    if name == REGISTRATION_BENCHMARK:
+        return run_registration_benchmark()
+
+    q2plugin, q2method, parameters, use_tree = BENCHMARKS[name]
+    parameters = {k: v(dataset) if callable(v) else v
+                  for k, v in parameters.items()}
+    files = {'biom': [{'filepath': dataset['biom']}]}
+    if use_tree:
+        files['plain_text'] = [{'filepath': dataset['tree']}]
+    qclient = FakeQiitaClient(
+        {ARTIFACT_ID: {'files': files, 'analysis': ANALYSIS_ID}},
+        {ANALYSIS_ID: dataset['metadata']})
+    job_params = build_parameters(
+        get_command(q2plugin, q2method), ARTIFACT_ID, parameters, use_tree)
+
+    job_dir = join(out_dir, name)
+    makedirs(job_dir, exist_ok=True)
+    # we want to measure the job, not to reuse the artifacts, hashes,
+    # taxonomy or results of the previous runs, so each benchmark runs with
+    # empty caches, see cache.py
+    old_cache = environ.get('QP_QIIME2_CACHE')
+    with TemporaryDirectory(dir=out_dir) as cache_dir:
+        environ['QP_QIIME2_CACHE'] = cache_dir
+        try:
+            start = time()
+            success, _, msg = call_qiime2(qclient, name, job_params, job_dir)
+            wall_time = time() - start
+        finally:
+            if old_cache is None:
+                environ.pop('QP_QIIME2_CACHE', None)
+            else:
+                environ['QP_QIIME2_CACHE'] = old_cache
+
+    profile = load_json(join(job_dir, PROFILE_FILENAME)) or {'phases': []}
+    phases = profile['phases']
+    return {
+        'name': name, 'success': success, 'message': msg,
+        'wall_time': wall_time,
+        'peak_rss': max([p['peak_rss'] for p in phases], default=None),
+        'phases': phases,
+        'steps': [(t - start, step) for t, _, step in qclient.steps]}
+
+
+def format_results(results):
+    """Formats the results of the benchmarks as a table, one row per phase
+
+    Parameters
+    ----------
+    results : list of dict
+        The results of run_benchmark
+
+    Returns
+    -------
+    str
+        The table
+    """
+    rows = [('benchmark', 'phase', 'wall (s)', 'cpu (s)', 'peak rss (MB)',
+             'read (MB)', 'written (MB)')]
+    for result in results:
+        if not result['success']:
+            rows.append((result['name'], 'FAILED: %s' % result['message'],
+                         '', '', '', '', ''))
+            continue
+        for phase in result['phases']:
+            rows.append((
+                result['name'], phase['name'], '%.2f' % phase['wall'],
+                '%.2f' % (phase['cpu'] + phase['children_cpu']),
+                '%.1f' % (phase['peak_rss'] / 2 ** 20),
+                '%.1f' % (phase.get('rchar', 0) / 2 ** 20),
+                '%.1f' % (phase.get('wchar', 0) / 2 ** 20)))
+        rows.append((result['name'], 'total', '%.2f' % result['wall_time'],
+                     '', '', '', ''))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return '\n'.join('  '.join(v.ljust(w) for v, w in zip(row, widths))
+                     .rstrip() for row in rows)
@@ -0,0 +1,446 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os.path import join, dirname
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+# PLEASE READ:
+# This module generates datasets that look like the ones in Qiita, for
+# benchmarking and capacity planning, from 100 to 100k samples and from 1k
+# to 1M features:
+# - a sparse BIOM table where the feature ids are DNA sequences (like deblur)
+#   with their taxonomy as observation metadata. Each sample has a random
+#   number of features (its richness), which are selected following a
+#   power law (a few features are in most samples), with random counts.
+# - a rooted binary tree with all the features as tips.
+# - the analysis metadata as returned by Qiita, with numeric, categorical
+#   and missing values.
+# Everything is deterministic given the seed and the size. To keep the
+# memory low (and independent of the number of samples), all the files are
+# written in chunks of CHUNK_SIZE features or samples; each chunk uses its
+# own random generator so it can be generated again, when needed, without
+# generating the previous chunks.
+
+# the number of features or samples generated at a time
+CHUNK_SIZE = 1000
+# the maximum number of non zero values of the table copied at a time to the
+# observation (CSR) matrix of the BIOM table
+MAX_NNZ_IN_MEMORY = 2 * 10 ** 6
+# the length of the sequences used as feature ids, like deblur's
+SEQUENCE_LENGTH = 150
+TAXONOMY_RANKS = ('k', 'p', 'c', 'o', 'f', 'g', 's')
+# the fraction of features without taxonomy
+UNASSIGNED_FRACTION = 0.02
+# the keys of the random generators of each of the parts of the dataset
+_FEATURES, _TAXONOMY, _POPULARITY, _SAMPLES, _TREE, _METADATA = range(6)
+
+
+def _rng(seed, *keys):
+    return np.random.default_rng([seed, *keys])
+
+
+def _chunks(n):
+    for start in range(0, n, CHUNK_SIZE):
+        yield start // CHUNK_SIZE, start, min(start + CHUNK_SIZE, n)
+
+
+def get_sample_ids(end, start=0):
+    """Returns the sample ids, Qiita style: <study id>.<sample name>"""
+    return ['1.sample.%d' % i for i in range(start, end)]
+
+
+def iter_feature_ids(n_features, seed=0):
+    """Yields the feature ids (random DNA sequences) in chunks
+
+    Parameters
+    ----------
+    n_features : int
+        The number of features
+    seed : int, optional
+        The seed of the random generators
+
+    Yields
+    ------
+    list of str
+        The ids of the next CHUNK_SIZE features
+    """
+    bases = np.frombuffer(b'ACGT', dtype='S1')
+    for chunk, start, end in _chunks(n_features):
+        rng = _rng(seed, _FEATURES, chunk)
+        seqs = bases[rng.integers(0, 4, size=(end - start, SEQUENCE_LENGTH))]
+        yield [s.decode('ascii') for s in seqs.view('S%d' % SEQUENCE_LENGTH)
+               .ravel()]
+
+
+def iter_taxonomy(n_features, seed=0):
+    """Yields the taxonomy of the features in chunks
+
+    Parameters
+    ----------
+    n_features : int
+        The number of features
+    seed : int, optional
+        The seed of the random generators
+
+    Yields
+    ------
+    numpy.array of str
+        A (CHUNK_SIZE, 7) array with the taxonomy of the next CHUNK_SIZE
+        features, one rank per column, as stored in the BIOM tables; the
+        unassigned features are 'Unassigned' followed by empty ranks
+
+    Notes
+    -----
+    Each rank has 3 times more taxa than the previous one and the taxa of a
+    rank are derived from the taxa of the next one, so the taxonomy is
+    consistent: 2 features with the same genus have the same family, etc.
+    """
+    n_ranks = len(TAXONOMY_RANKS)
+    for chunk, start, end in _chunks(n_features):
+        rng = _rng(seed, _TAXONOMY, chunk)
+        species = rng.integers(0, 3 ** (n_ranks - 1), end - start)
+        taxonomy = np.empty((end - start, n_ranks), dtype=object)
+        for i, rank in enumerate(TAXONOMY_RANKS):
+            taxa = species // 3 ** (n_ranks - 1 - i)
+            taxonomy[:, i] = np.char.add('%s__%s' % (rank, rank.upper()),
+                                         taxa.astype(str))
+        unassigned = rng.random(end - start) < UNASSIGNED_FRACTION
+        taxonomy[unassigned, 0] = 'Unassigned'
+        taxonomy[unassigned, 1:] = ''
+        yield taxonomy
+
+
+def _get_popularity_cdf(n_features, seed):
+    # a power law over the features, in a random order so the most common
+    # features are not the first ones
+    rng = _rng(seed, _POPULARITY)
+    weights = 1 / np.arange(1, n_features + 1) ** 1.1
+    weights = weights[rng.permutation(n_features)]
+    cdf = np.cumsum(weights)
+    return cdf / cdf[-1]
+
+
+def iter_samples(n_samples, n_features, seed=0, richness=None):
+    """Yields the counts of the samples in chunks
+
+    Parameters
+    ----------
+    n_samples : int
+        The number of samples
+    n_features : int
+        The number of features
+    seed : int, optional
+        The seed of the random generators
+    richness : int, optional
+        The mean number of features per sample; by default 5% of the
+        features, between 10 and 2000
+
+    Yields
+    ------
+    scipy.sparse.csc_matrix
+        The (n_features, CHUNK_SIZE) counts of the next CHUNK_SIZE samples,
+        with sorted indices
+    """
+    from scipy.sparse import csc_matrix
+
+    if richness is None:
+        richness = min(max(n_features // 20, 10), 2000)
+    cdf = _get_popularity_cdf(n_features, seed)
+
+    for chunk, start, end in _chunks(n_samples):
+        rng = _rng(seed, _SAMPLES, chunk)
+        indptr = [0]
+        indices = []
+        data = []
+        for _ in range(end - start):
+            k = int(rng.lognormal(np.log(richness), 0.5)) + 1
+            # sampling with replacement, the duplicates are removed so the
+            # features of a sample are usually less than k
+            features = np.unique(np.searchsorted(cdf, rng.random(k)))
+            features = features[features < n_features]
+            counts = np.ceil(rng.lognormal(1.5, 1.2, len(features)))
+            indices.append(features)
+            data.append(counts)
+            indptr.append(indptr[-1] + len(features))
+        yield csc_matrix(
+            (np.concatenate(data), np.concatenate(indices), indptr),
+            shape=(n_features, end - start))
+
+
+def _create_dataset(grp, name, shape, dtype, data=None):
+    return grp.create_dataset(
+        name, shape=shape, dtype=dtype, data=data,
+        maxshape=(None, ) + tuple(shape[1:]), chunks=True,
+        compression='gzip')
+
+
+def _memmap(fp, dtype, size):
+    # numpy can't map empty files
+    return np.memmap(fp, dtype=dtype, mode='w+', shape=(max(size, 1), ))
+
+
+def _append(dataset, values):
+    start = dataset.shape[0]
+    dataset.resize((start + len(values), ) + dataset.shape[1:])
+    dataset[start:] = values
+
+
+def write_table(biom_fp, n_samples, n_features, seed=0, richness=None):
+    """Writes a synthetic BIOM table, in HDF5 format, in chunks
+
+    Parameters
+    ----------
+    biom_fp : str
+        The path where to write the table
+    n_samples : int
+        The number of samples
+    n_features : int
+        The number of features
+    seed : int, optional
+        The seed of the random generators
+    richness : int, optional
+        The mean number of features per sample, see iter_samples
+
+    Returns
+    -------
+    numpy.array of float
+        The total counts of each sample
+
+    Notes
+    -----
+    BIOM tables store the counts both per sample (CSC) and per feature
+    (CSR). The samples are generated, and written, in chunks; then the
+    samples are read back from the file, once, and each value is placed in
+    its position of the per feature matrix, which is built in temporary
+    memory mapped files (next to biom_fp) and copied to the table in blocks
+    of MAX_NNZ_IN_MEMORY values.
+    """
+    import h5py
+
+    str_dtype = h5py.string_dtype()
+    sample_totals = np.zeros(n_samples)
+    feature_nnz = np.zeros(n_features, dtype=np.int64)
+
+    with h5py.File(biom_fp, 'w') as f:
+        f.attrs['id'] = 'No Table ID'
+        f.attrs['type'] = 'OTU table'
+        f.attrs['format-url'] = 'http://biom-format.org'
+        f.attrs['format-version'] = (2, 1)
+        f.attrs['generated-by'] = 'qp-qiime2 synthetic dataset (seed %d)' % (
+            seed)
+        f.attrs['creation-date'] = datetime(2000, 1, 1).isoformat()
+        f.attrs['shape'] = (n_features, n_samples)
+
+        obs = f.create_group('observation')
+        obs.create_group('group-metadata')
+        obs_md = obs.create_group('metadata')
+        ids = _create_dataset(obs, 'ids', (n_features, ), str_dtype)
+        taxonomy = _create_dataset(
+            obs_md, 'taxonomy', (n_features, len(TAXONOMY_RANKS)), str_dtype)
+        for (_, start, end), chunk_ids, chunk_taxonomy in zip(
+                _chunks(n_features), iter_feature_ids(n_features, seed),
+                iter_taxonomy(n_features, seed)):
+            ids[start:end] = chunk_ids
+            taxonomy[start:end] = chunk_taxonomy
+
+        smp = f.create_group('sample')
+        smp.create_group('group-metadata')
+        smp.create_group('metadata')
+        _create_dataset(smp, 'ids', (n_samples, ), str_dtype,
+                        data=get_sample_ids(n_samples))
+        matrix = smp.create_group('matrix')
+        data = _create_dataset(matrix, 'data', (0, ), np.float64)
+        indices = _create_dataset(matrix, 'indices', (0, ), np.int32)
+        indptr = [np.zeros(1, dtype=np.int64)]
+        for (_, start, end), counts in zip(
+                _chunks(n_samples),
+                iter_samples(n_samples, n_features, seed, richness)):
+            _append(data, counts.data)
+            _append(indices, counts.indices)
+            indptr.append(counts.indptr[1:] + indptr[-1][-1])
+            sample_totals[start:end] = np.asarray(counts.sum(axis=0)).ravel()
+            feature_nnz += np.bincount(counts.indices, minlength=n_features)
+        indptr = np.concatenate(indptr)
+        nnz = int(indptr[-1])
+        index_dtype = np.int32 if nnz < 2 ** 31 else np.int64
+        matrix.create_dataset('indptr', data=indptr.astype(index_dtype))
+        f.attrs['nnz'] = nnz
+
+        # now the counts per feature; as the samples are read in order, the
+        # values of each feature are placed after the ones of the previous
+        # chunks, so they end up sorted by sample
+        obs_indptr = np.concatenate([[0], np.cumsum(feature_nnz)])
+        matrix = obs.create_group('matrix')
+        matrix.create_dataset('indptr', data=obs_indptr.astype(index_dtype))
+        with TemporaryDirectory(dir=dirname(biom_fp)) as tmp_dir:
+            csr_data = _memmap(join(tmp_dir, 'data'), np.float64, nnz)
+            csr_indices = _memmap(join(tmp_dir, 'indices'), np.int32, nnz)
+            # the next free position of each feature
+            filled = obs_indptr[:-1].copy()
+            for _, start, end in _chunks(n_samples):
+                chunk_indptr = indptr[start:end + 1]
+                chunk_rows = indices[chunk_indptr[0]:chunk_indptr[-1]]
+                chunk_data = data[chunk_indptr[0]:chunk_indptr[-1]]
+                cols = np.repeat(np.arange(start, end, dtype=np.int32),
+                                 np.diff(chunk_indptr))
+                # grouping the values by feature, keeping the sample order
+                order = np.argsort(chunk_rows, kind='stable')
+                rows = chunk_rows[order]
+                positions = filled[rows] + (
+                    np.arange(len(rows)) - np.searchsorted(rows, rows))
+                csr_data[positions] = chunk_data[order]
+                csr_indices[positions] = cols[order]
+                uniq, counts = np.unique(rows, return_counts=True)
+                filled[uniq] += counts
+
+            obs_data = _create_dataset(matrix, 'data', (nnz, ), np.float64)
+            obs_indices = _create_dataset(
+                matrix, 'indices', (nnz, ), np.int32)
+            for start in range(0, nnz, MAX_NNZ_IN_MEMORY):
+                end = min(start + MAX_NNZ_IN_MEMORY, nnz)
+                obs_data[start:end] = csr_data[start:end]
+                obs_indices[start:end] = csr_indices[start:end]
+            del csr_data, csr_indices
+
+    return sample_totals
+
+
+def write_tree(tree_fp, n_features, seed=0):
+    """Writes a rooted binary tree with all the features as tips
+
+    Parameters
+    ----------
+    tree_fp : str
+        The path where to write the tree, in newick format
+    n_features : int
+        The number of features, the ids are the ones of iter_feature_ids
+    seed : int, optional
+        The seed of the random generators
+
+    Notes
+    -----
+    The tree is balanced with the tips in the order of the features, which
+    is random as the ids are random sequences, and random branch lengths.
+    It's written while traversing it, so only the ids of a chunk of features
+    and the path to the current tip (log2 n_features nodes) are in memory.
+    """
+    rng = _rng(seed, _TREE)
+    ids = (fid for chunk in iter_feature_ids(n_features, seed)
+           for fid in chunk)
+
+    def _write(f, start, end):
+        if end - start == 1:
+            f.write(next(ids))
+        else:
+            middle = (start + end) // 2
+            f.write('(')
+            _write(f, start, middle)
+            f.write(',')
+            _write(f, middle, end)
+            f.write(')')
+        f.write(':%.5f' % rng.random())
+
+    with open(tree_fp, 'w') as f:
+        if n_features == 1:
+            f.write('(')
+            _write(f, 0, 1)
+            f.write(')root;\n')
+            return
+        middle = n_features // 2
+        f.write('(')
+        _write(f, 0, middle)
+        f.write(',')
+        _write(f, middle, n_features)
+        f.write(')root;\n')
+
+
+def iter_metadata(n_samples, seed=0):
+    """Yields the analysis metadata of each sample, as returned by Qiita
+
+    Parameters
+    ----------
+    n_samples : int
+        The number of samples
+    seed : int, optional
+        The seed of the random generators
+
+    Yields
+    ------
+    str, dict of {str: str}
+        The sample id and its metadata: {column: value}
+
+    Notes
+    -----
+    Like in Qiita, all values are strings and the missing values are either
+    empty or one of the INSDC missing terms
+    """
+    missing = ['not provided', 'not collected', 'not applicable',
+               'missing: not provided', '']
+    start_date = datetime(2015, 1, 1)
+    for chunk, start, end in _chunks(n_samples):
+        rng = _rng(seed, _METADATA, chunk)
+        for sid in get_sample_ids(end, start):
+            is_missing = rng.random(4) < 0.1
+            md = {
+                'ph': '%.2f' % rng.normal(7, 1),
+                'depth': str(int(rng.integers(0, 100))),
+                'env_biome': str(rng.choice(
+                    ['soil', 'marine', 'freshwater', 'host-associated'])),
+                'host_sex': str(rng.choice(['female', 'male'])),
+                'collection_timestamp': (start_date + timedelta(
+                    days=int(rng.integers(0, 1000)))).strftime('%Y-%m-%d'),
+                'qiita_study_id': '1'}
+            for column, value_missing in zip(
+                    ('ph', 'depth', 'env_biome', 'host_sex'), is_missing):
+                if value_missing:
+                    md[column] = str(rng.choice(missing))
+            yield sid, md
+
+
+def generate_metadata(n_samples, seed=0):
+    """Returns the analysis metadata as returned by Qiita, see iter_metadata
+    """
+    return dict(iter_metadata(n_samples, seed))
+
+
+def generate_dataset(out_dir, n_samples, n_features, seed=0, richness=None):
+    """Generates a table, tree and metadata
+
+    Parameters
+    ----------
+    out_dir : str
+        The folder where to write the files
+    n_samples : int
+        The number of samples
+    n_features : int
+        The number of features
+    seed : int, optional
+        The seed of the random generators
+    richness : int, optional
+        The mean number of features per sample, see iter_samples
+
+    Returns
+    -------
+    dict
+        {'biom': filepath, 'tree': filepath, 'metadata': the analysis
+        metadata, 'sampling_depth': the smallest number of counts of a
+        sample}
+    """
+    biom_fp = join(out_dir, 'table.biom')
+    sample_totals = write_table(
+        biom_fp, n_samples, n_features, seed, richness)
+
+    tree_fp = join(out_dir, 'tree.tre')
+    write_tree(tree_fp, n_features, seed)
+
+    return {'biom': biom_fp, 'tree': tree_fp,
+            'metadata': generate_metadata(n_samples, seed),
+            'sampling_depth': int(sample_totals.min())}
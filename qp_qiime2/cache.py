@@ -0,0 +1,289 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import (
+    environ, makedirs, replace, stat, utime, remove, close, scandir, walk)
+from os.path import join, dirname, exists
+from shutil import rmtree
+from hashlib import sha256
+from json import dumps, load, dump
+from tempfile import NamedTemporaryFile, mkstemp
+
+# Note that this module should not import qiime2 (or any of the heavy
+# dependencies) as it is used while importing qp_qiime2, before we know if
+# we actually need qiime2 loaded
+
+# the maximum size, in GB, of each of the caches; note that this can be
+# changed via the ENV var QP_QIIME2_CACHE_MAX_SIZE
+DEFAULT_CACHE_MAX_SIZE = 50
+# the extension of the files being written to the cache, so they are ignored
+# while looking for files or evicting them
+TMP_EXTENSION = '.tmp'
+
+
+def get_cache_dir(name):
+    """Returns the folder to store the cache `name`
+
+    Parameters
+    ----------
+    name : str
+        The name of the cache, this will be a subfolder of QP_QIIME2_CACHE
+
+    Returns
+    -------
+    str or None
+        The path to the cache folder or None if caching is disabled, which
+        happens when the ENV var QP_QIIME2_CACHE is not set
+    """
+    cache_dir = environ.get('QP_QIIME2_CACHE')
+    if not cache_dir:
+        return None
+    cache_dir = join(cache_dir, name)
+    makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+
+def hash_key(values):
+    """Generates a stable hash for a JSON serializable object
+
+    Parameters
+    ----------
+    values : object
+        Any JSON serializable object
+
+    Returns
+    -------
+    str
+        The hex digest of the sorted JSON representation of values
+    """
+    return sha256(dumps(values, sort_keys=True, default=str).encode(
+        'utf-8')).hexdigest()
+
+
+def load_json(fp):
+    """Loads a JSON file returning None if it doesn't exist or is invalid"""
+    try:
+        with open(fp) as f:
+            return load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_json(fp, data):
+    """Atomically writes data as JSON to fp
+
+    We first write to a temporary file in the same folder and then move it
+    so concurrent jobs never read a half written file
+    """
+    with NamedTemporaryFile('w', dir=dirname(fp), delete=False,
+                            suffix=TMP_EXTENSION) as f:
+        dump(data, f)
+    replace(f.name, fp)
+
+
+def hash_file(fp, block_size=2 ** 20):
+    """Returns the hash of the contents of fp
+
+    Parameters
+    ----------
+    fp : str
+        The file to hash
+    block_size : int, optional
+        The number of bytes to read at a time
+
+    Returns
+    -------
+    str
+        The hex digest of the file contents
+
+    Notes
+    -----
+    As hashing large files is expensive, if caching is enabled the hashes are
+    stored in the hashes cache, keyed by the path, size and modification time
+    of the file, so each file is only read once. Like the other caches, the
+    least recently used hashes are evicted (see evict_cache) but, as a job
+    can hash several files, that's done once at the end of the job, see
+    qp_qiime2.call_qiime2
+    """
+    fstat = stat(fp)
+    hashes_dir = get_cache_dir('hashes')
+    if hashes_dir is not None:
+        hash_fp = join(hashes_dir, hash_key(
+            [fp, fstat.st_size, fstat.st_mtime]))
+        try:
+            with open(hash_fp) as f:
+                fhash = f.read()
+            # updating the modification time, see get_cached_file
+            utime(hash_fp)
+        except FileNotFoundError:
+            fhash = None
+        if fhash:
+            return fhash
+
+    fhash = sha256()
+    with open(fp, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            fhash.update(block)
+    fhash = fhash.hexdigest()
+
+    if hashes_dir is not None:
+        with NamedTemporaryFile('w', dir=hashes_dir, delete=False,
+                                suffix=TMP_EXTENSION) as f:
+            f.write(fhash)
+        replace(f.name, hash_fp)
+
+    return fhash
+
+
+def get_cached_file(name, key, extension):
+    """Returns the path of a file stored in a cache
+
+    Parameters
+    ----------
+    name : str
+        The name of the cache
+    key : str
+        The key of the file
+    extension : str
+        The extension of the file, like .qza
+
+    Returns
+    -------
+    str or None
+        The path to the cached file or None if it doesn't exist or caching is
+        disabled
+    """
+    cache_dir = get_cache_dir(name)
+    if cache_dir is None:
+        return None
+    fp = join(cache_dir, key + extension)
+    try:
+        # updating the access and modification time so the least recently
+        # used files are evicted first
+        utime(fp)
+    except FileNotFoundError:
+        return None
+
+    return fp
+
+
+def add_to_cache(name, key, extension, writer):
+    """Writes a file to a cache and evicts files if the cache is too big
+
+    Parameters
+    ----------
+    name : str
+        The name of the cache
+    key : str
+        The key of the file
+    extension : str
+        The extension of the file, like .qza
+    writer : callable
+        A function that receives a filepath, with the given extension, and
+        writes the file to cache in it
+
+    Returns
+    -------
+    str or None
+        The path to the cached file or None if caching is disabled
+    """
+    cache_dir = get_cache_dir(name)
+    if cache_dir is None:
+        return None
+
+    # first writing to a temporary file so other jobs never see a partially
+    # written file
+    fd, tmp_fp = mkstemp(dir=cache_dir, suffix=TMP_EXTENSION + extension)
+    close(fd)
+    try:
+        writer(tmp_fp)
+        fp = join(cache_dir, key + extension)
+        replace(tmp_fp, fp)
+    finally:
+        if exists(tmp_fp):
+            remove(tmp_fp)
+
+    evict_cache(name)
+
+    return fp
+
+
+def get_cache_max_size():
+    """Returns the maximum size of each of the caches
+
+    Returns
+    -------
+    float
+        The size in GB, QP_QIIME2_CACHE_MAX_SIZE or DEFAULT_CACHE_MAX_SIZE
+    """
+    return float(environ.get(
+        'QP_QIIME2_CACHE_MAX_SIZE', DEFAULT_CACHE_MAX_SIZE))
+
+
+def evict_cache(name, max_size=None):
+    """Removes the least recently used files until the cache fits max_size
+
+    Parameters
+    ----------
+    name : str
+        The name of the cache
+    max_size : float, optional
+        The maximum size of the cache in GB, if None it will use
+        QP_QIIME2_CACHE_MAX_SIZE or DEFAULT_CACHE_MAX_SIZE
+    """
+    cache_dir = get_cache_dir(name)
+    if cache_dir is None:
+        return
+    if max_size is None:
+        max_size = get_cache_max_size()
+    max_size = max_size * 2 ** 30
+
+    files = []
+    for entry in scandir(cache_dir):
+        if TMP_EXTENSION in entry.name:
+            continue
+        try:
+            is_dir = entry.is_dir()
+            if is_dir:
+                # some caches store folders, see jobs.py
+                size = get_folder_size(entry.path)
+            elif entry.is_file():
+                size = entry.stat().st_size
+            else:
+                continue
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            # another job just removed it
+            continue
+        files.append((mtime, size, entry.path, is_dir))
+
+    total_size = sum(size for _, size, _, _ in files)
+    for _, size, fp, is_dir in sorted(files):
+        if total_size <= max_size:
+            break
+        if is_dir:
+            rmtree(fp, ignore_errors=True)
+        else:
+            try:
+                remove(fp)
+            except FileNotFoundError:
+                pass
+        total_size -= size
+
+
+def get_folder_size(folder):
+    """Returns the total size of the files in folder, recursively"""
+    size = 0
+    for root, _, fnames in walk(folder):
+        for fname in fnames:
+            try:
+                size += stat(join(root, fname)).st_size
+            except FileNotFoundError:
+                pass
+    return size
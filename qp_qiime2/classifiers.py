@@ -0,0 +1,280 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import stat
+from os.path import join
+from sqlite3 import connect, OperationalError
+from zipfile import ZipFile
+from math import ceil
+from time import time
+
+from .cache import get_cache_dir, get_cache_max_size, hash_key, hash_file
+from .resources import get_memory_limit, get_cpu_count
+
+# Note that qiime2 & pandas are imported within the functions, see the note
+# in qp_qiime2.py
+
+# The taxonomic classifiers (QP_QIIME2_DBS) are large and loading them can
+# take longer than the actual classification so we keep the loaded artifacts
+# in this pool: {filepath: (size, modification time, qiime2.Artifact)}. The
+# daemon (see daemon.py) fills it before forking the workers so they share
+# the loaded classifiers (copy-on-write) and don't need to load them again.
+# Note that the artifacts are passed to classify_sklearn as they are, so
+# the classification keeps its provenance.
+CLASSIFIERS_POOL = {}
+
+# the values used to estimate the memory needed by classify_sklearn, see
+# get_classify_sklearn_batching
+MEMORY_FRACTION = 0.8
+BASE_MEMORY = 2 ** 30
+MAX_READS_PER_BATCH = 20000
+MIN_READS_PER_BATCH = 1000
+
+
+def load_classifier(fp):
+    """Loads a taxonomic classifier using the classifiers pool
+
+    Parameters
+    ----------
+    fp : str
+        The path to the classifier .qza
+
+    Returns
+    -------
+    qiime2.Artifact
+        The classifier
+    """
+    import qiime2
+
+    fstat = stat(fp)
+    if fp in CLASSIFIERS_POOL:
+        size, mtime, classifier = CLASSIFIERS_POOL[fp]
+        # making sure that the file hasn't been replaced since we loaded it
+        if (size, mtime) == (fstat.st_size, fstat.st_mtime):
+            return classifier
+
+    classifier = qiime2.Artifact.load(fp)
+    CLASSIFIERS_POOL[fp] = (fstat.st_size, fstat.st_mtime, classifier)
+
+    return classifier
+
+
+# PLEASE READ:
+# The same sequences (ASVs) are classified over and over with the same
+# classifiers so, if QP_QIIME2_CACHE is set, we store the taxonomy assigned
+# to each sequence in the taxonomy cache, which is a SQLite database (so it
+# can be used by multiple jobs at the same time). The assignments are keyed
+# by a hash of the classifier contents, the version of q2-feature-classifier
+# and the parameters that change the result (confidence & read_orientation),
+# see get_assignments_key. Then call_qiime2 only classifies the sequences
+# that are not in the cache and merges them with the cached ones.
+# Each assignment keeps when it was last used so, like the rest of the
+# caches, the least recently used ones are removed when the database is over
+# QP_QIIME2_CACHE_MAX_SIZE; as the database doesn't shrink, the size is
+# estimated from the number of assignments, ASSIGNMENT_SIZE bytes each.
+ASSIGNMENT_SIZE = 512
+
+
+def get_assignments_key(classifier_fp, q2params):
+    """Returns the key of the assignments for a classifier and parameters
+
+    Parameters
+    ----------
+    classifier_fp : str
+        The path to the classifier .qza
+    q2params : dict
+        The parameters passed to classify_sklearn
+
+    Returns
+    -------
+    str or None
+        The assignments key, or None if caching is disabled; the classifier
+        is only hashed when the key is needed
+    """
+    if get_cache_dir('taxonomy') is None:
+        return None
+
+    import qiime2
+
+    version = qiime2.sdk.PluginManager().plugins['feature-classifier'].version
+    return hash_key([hash_file(classifier_fp), version,
+                     q2params.get('confidence'),
+                     q2params.get('read_orientation')])
+
+
+def _connect_assignments():
+    cache_dir = get_cache_dir('taxonomy')
+    if cache_dir is None:
+        return None
+    # the timeout is long as other jobs could be writing to the database
+    conn = connect(join(cache_dir, 'assignments.sqlite'), timeout=600)
+    conn.execute('CREATE TABLE IF NOT EXISTS assignments ('
+                 'key TEXT, sequence TEXT, taxon TEXT, confidence TEXT, '
+                 'last_access INTEGER DEFAULT 0, '
+                 'PRIMARY KEY (key, sequence))')
+    columns = [c[1] for c in conn.execute('PRAGMA table_info(assignments)')]
+    if 'last_access' not in columns:
+        # a database created before the assignments were evicted
+        try:
+            conn.execute('ALTER TABLE assignments ADD COLUMN '
+                         'last_access INTEGER DEFAULT 0')
+        except OperationalError:
+            # another job just added it
+            pass
+    conn.execute('CREATE INDEX IF NOT EXISTS assignments_last_access '
+                 'ON assignments (last_access)')
+    return conn
+
+
+def _evict_assignments(conn):
+    """Removes the least recently used assignments over the cache size"""
+    max_rows = int(get_cache_max_size() * 2 ** 30 / ASSIGNMENT_SIZE)
+    n_rows = conn.execute('SELECT COUNT(*) FROM assignments').fetchone()[0]
+    if n_rows > max_rows:
+        conn.execute(
+            'DELETE FROM assignments WHERE rowid IN ('
+            'SELECT rowid FROM assignments ORDER BY last_access LIMIT ?)',
+            (n_rows - max_rows, ))
+
+
+def get_cached_assignments(key, sequences):
+    """Retrieves the taxonomy of the sequences from the taxonomy cache
+
+    Parameters
+    ----------
+    key : str
+        The assignments key, see get_assignments_key
+    sequences : iterable of str
+        The sequences to look for
+
+    Returns
+    -------
+    pandas.DataFrame or None
+        The taxonomy of the sequences found in the cache, as in the
+        FeatureData[Taxonomy] view as DataFrame: indexed by 'Feature ID' and
+        with the Taxon & Confidence columns; None if caching is disabled
+    """
+    import pandas as pd
+
+    conn = _connect_assignments()
+    if conn is None:
+        return None
+
+    with conn:
+        conn.execute(
+            'CREATE TEMP TABLE sequences (sequence TEXT PRIMARY KEY)')
+        conn.executemany('INSERT OR IGNORE INTO sequences VALUES (?)',
+                         ((s, ) for s in sequences))
+        rows = conn.execute(
+            'SELECT a.sequence, a.taxon, a.confidence FROM assignments a '
+            'JOIN sequences s ON a.sequence = s.sequence '
+            'WHERE a.key = ?', (key, )).fetchall()
+        # so they are not evicted, see _evict_assignments
+        conn.execute(
+            'UPDATE assignments SET last_access = ? WHERE key = ? AND '
+            'sequence IN (SELECT sequence FROM sequences)',
+            (int(time()), key))
+    conn.close()
+
+    df = pd.DataFrame(rows, columns=['Feature ID', 'Taxon', 'Confidence'])
+    return df.set_index('Feature ID')
+
+
+def add_cached_assignments(key, taxonomy):
+    """Adds the taxonomy of the sequences to the taxonomy cache
+
+    Parameters
+    ----------
+    key : str
+        The assignments key, see get_assignments_key
+    taxonomy : pandas.DataFrame
+        The taxonomy of the sequences as in get_cached_assignments
+
+    Notes
+    -----
+    The least recently used assignments are removed if the cache is over
+    QP_QIIME2_CACHE_MAX_SIZE, see ASSIGNMENT_SIZE
+    """
+    conn = _connect_assignments()
+    if conn is None:
+        return
+
+    if 'Confidence' in taxonomy.columns:
+        confidence = taxonomy['Confidence'].astype(str)
+    else:
+        confidence = [None] * len(taxonomy.index)
+    n = len(taxonomy.index)
+    with conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO assignments (key, sequence, taxon, '
+            'confidence, last_access) VALUES (?, ?, ?, ?, ?)',
+            zip([key] * n, taxonomy.index, taxonomy['Taxon'], confidence,
+                [int(time())] * n))
+        _evict_assignments(conn)
+    conn.close()
+
+
+def get_classify_sklearn_batching(classifier_fp, n_reads, memory=None,
+                                  cpus=None):
+    """Returns reads_per_batch & n_jobs so classify_sklearn fits in memory
+
+    Parameters
+    ----------
+    classifier_fp : str
+        The path to the classifier .qza
+    n_reads : int
+        The number of reads (features) to classify
+    memory : int, optional
+        The memory available in bytes, if None it will use get_memory_limit
+    cpus : int, optional
+        The CPUs available, if None it will use get_cpu_count
+
+    Returns
+    -------
+    int, int
+        The reads_per_batch and n_jobs to use
+
+    Notes
+    -----
+    classify_sklearn splits the reads in batches of reads_per_batch and
+    classifies them in n_jobs workers; each worker (when n_jobs > 1) gets its
+    own copy of the classifier and needs, per read, a few dense arrays of
+    the size of the number of taxa of the classifier, which is what makes
+    the large tables run out of memory with the default values.
+    We estimate the size of the classifier in memory from its uncompressed
+    size in the .qza, and the number of taxa from that size and the number
+    of features of the default HashingVectorizer (8192), as the classifier
+    stores 2 float64 arrays of taxa x features. Then we use as many workers
+    as possible, with the largest batches (up to MAX_READS_PER_BATCH) that
+    fit within MEMORY_FRACTION of the memory; n_jobs is only reduced if the
+    batches would be smaller than MIN_READS_PER_BATCH.
+    """
+    if memory is None:
+        memory = get_memory_limit()
+    if cpus is None:
+        cpus = get_cpu_count()
+
+    with ZipFile(classifier_fp) as zf:
+        classifier_size = sum(info.file_size for info in zf.infolist())
+    # 3 float64 arrays per read of n_taxa = classifier_size / (2 * 8 * 8192)
+    read_size = max(ceil(3 * 8 * classifier_size / (2 * 8 * 8192)), 1)
+    # the main process always has a copy of the classifier
+    available = memory * MEMORY_FRACTION - BASE_MEMORY - classifier_size
+
+    n_reads = max(n_reads, 1)
+    for n_jobs in range(max(min(cpus, n_reads), 1), 0, -1):
+        workers_size = n_jobs * classifier_size if n_jobs > 1 else 0
+        fit = int((available - workers_size) // (n_jobs * read_size))
+        reads_per_batch = min(
+            ceil(n_reads / n_jobs), MAX_READS_PER_BATCH, fit)
+        if reads_per_batch >= min(n_reads, MIN_READS_PER_BATCH):
+            return reads_per_batch, n_jobs
+
+    # not even 1 worker fits in the expected memory so let's use the
+    # smallest batches and hope for the best
+    return min(n_reads, MIN_READS_PER_BATCH), 1
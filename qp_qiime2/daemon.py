@@ -0,0 +1,216 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import remove, environ, getcwd, chdir, umask
+from os.path import exists
+from json import dumps, loads
+from socket import socket, AF_UNIX, SOCK_STREAM
+from socketserver import ForkingMixIn, UnixStreamServer, StreamRequestHandler
+from traceback import format_exc
+
+from .resources import (
+    get_cpu_count, get_memory_limit, CPU_LIMIT_ENV_VAR, MEMORY_LIMIT_ENV_VAR)
+
+# PLEASE READ:
+# Each job executed via start_qiime2 is a new python process that needs to
+# import qiime2 and load all the plugins (PluginManager), which takes several
+# seconds. To avoid this, the daemon loads everything once and then listens
+# on a UNIX socket for (url, job_id, output_dir) requests, each request is
+# executed in a forked child (so they get a copy-on-write version of the
+# pre-warmed process and a crash/leak in a job doesn't affect the daemon).
+# start_qiime2 forwards the job to the daemon if QP_QIIME2_DAEMON_SOCKET is
+# set and falls back to executing the job in-process if the daemon is not
+# available.
+# Note that the worker runs in the environment and cgroup of the daemon, not
+# the ones of start_qiime2 (for example, the SLURM job), so start_qiime2 also
+# sends its ENV vars, working directory and CPU & memory limits, and the
+# worker uses them instead of its own, see resources.py
+
+
+def warm_up():
+    """Imports qiime2 and its plugins so the forked workers don't need to
+
+    Notes
+    -----
+    This also loads all the taxonomic classifiers in QP_QIIME2_DBS into the
+    classifiers pool, see classifiers.py
+    """
+    import qiime2
+    import pandas  # noqa: F401
+    import biom  # noqa: F401
+
+    from .util import get_extra_configuration_paths
+    from .classifiers import load_classifier
+
+    qiime2.sdk.PluginManager()
+    qp_qiime2_dbs, _ = get_extra_configuration_paths()
+    for fp in qp_qiime2_dbs:
+        load_classifier(fp)
+
+
+def apply_request_context(request):
+    """Sets the environment of start_qiime2 in the worker
+
+    Parameters
+    ----------
+    request : dict
+        The job request, see execute_in_daemon
+    """
+    environ.clear()
+    environ.update(request['environ'])
+    environ[CPU_LIMIT_ENV_VAR] = str(request['cpus'])
+    environ[MEMORY_LIMIT_ENV_VAR] = str(request['memory'])
+    chdir(request['cwd'])
+
+
+class JobRequestHandler(StreamRequestHandler):
+    def _respond(self, response):
+        self.wfile.write(dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = loads(self.rfile.readline())
+        except ValueError:
+            # not a job request, the connection is closed without accepting
+            # it so the client executes it in-process
+            return
+        # from now on the job is executed here, see execute_in_daemon
+        self._respond({'accepted': True})
+        try:
+            # note that this runs in the forked worker so it doesn't change
+            # the daemon
+            apply_request_context(request)
+            self.server.plugin(
+                request['url'], request['job_id'], request['output_dir'])
+            response = {'success': True, 'error': ''}
+        except Exception:
+            response = {'success': False, 'error': format_exc()}
+        self._respond(response)
+
+
+class QiitaDaemon(ForkingMixIn, UnixStreamServer):
+    """UNIX socket server that executes each job in a forked worker
+
+    Parameters
+    ----------
+    socket_path : str
+        The path of the UNIX socket to listen to
+    plugin : callable
+        The function to execute the jobs, called as plugin(url, job_id,
+        output_dir); normally qp_qiime2.plugin
+    workers : int, optional
+        The maximum number of jobs to execute at the same time
+
+    Notes
+    -----
+    The socket is only accessible by the user running the daemon, as anyone
+    who can connect to it can execute jobs as that user
+    """
+    def __init__(self, socket_path, plugin, workers=1):
+        # a previous daemon could have left the socket behind
+        if exists(socket_path):
+            remove(socket_path)
+        self.plugin = plugin
+        self.max_children = workers
+        # the socket is created with mode 0600, setting the mode after
+        # creating it would leave it open to anyone for a moment
+        old_umask = umask(0o177)
+        try:
+            super().__init__(socket_path, JobRequestHandler)
+        finally:
+            umask(old_umask)
+
+    def server_close(self):
+        super().server_close()
+        if exists(self.server_address):
+            remove(self.server_address)
+
+
+def serve(socket_path, workers=1):
+    """Warms up qiime2 and starts the daemon
+
+    Parameters
+    ----------
+    socket_path : str
+        The path of the UNIX socket to listen to
+    workers : int, optional
+        The maximum number of jobs to execute at the same time
+    """
+    from qp_qiime2 import plugin
+
+    warm_up()
+    with QiitaDaemon(socket_path, plugin, workers) as server:
+        server.serve_forever()
+
+
+def execute_in_daemon(socket_path, url, job_id, output_dir):
+    """Forwards a job to the daemon and waits for it to finish
+
+    Parameters
+    ----------
+    socket_path : str
+        The path of the daemon UNIX socket
+    url : str
+        The url of the Qiita server
+    job_id : str
+        The job id
+    output_dir : str
+        The path to the job's output directory
+
+    Returns
+    -------
+    bool
+        True if the job was executed by the daemon, False if the daemon is
+        not available or didn't accept the job so it should be executed
+        in-process
+
+    Raises
+    ------
+    RuntimeError
+        If the daemon failed executing the job or it died while executing it
+
+    Notes
+    -----
+    The job is executed with the ENV vars, working directory and CPU &
+    memory limits of this process, see apply_request_context. The daemon
+    answers with a line when it accepts the job and another one with the
+    result when the job is done
+    """
+    request = {'url': url, 'job_id': job_id, 'output_dir': output_dir,
+               'environ': dict(environ), 'cwd': getcwd(),
+               'cpus': get_cpu_count(), 'memory': get_memory_limit()}
+    with socket(AF_UNIX, SOCK_STREAM) as sock, sock.makefile('rb') as f:
+        # any error before the daemon accepts the job means that it's not
+        # available, for example, a stale socket of another user
+        # (PermissionError) or a daemon that is shutting down
+        try:
+            sock.connect(socket_path)
+            sock.sendall(dumps(request).encode('utf-8') + b'\n')
+            accepted = f.readline()
+        except OSError:
+            return False
+        if not accepted:
+            return False
+        try:
+            response = f.readline()
+        except OSError:
+            response = None
+
+    # note that at this point the job was already accepted by the daemon so
+    # we can't fallback to in-process execution as the job might be half done
+    if not response:
+        raise RuntimeError(
+            'The qp-qiime2 daemon died while executing job %s' % job_id)
+    response = loads(response)
+    if not response['success']:
+        raise RuntimeError(
+            'The qp-qiime2 daemon failed executing job %s: %s' % (
+                job_id, response['error']))
+
+    return True
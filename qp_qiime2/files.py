@@ -0,0 +1,128 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import link, makedirs, scandir, remove, stat, chmod
+from os.path import join, isdir
+from shutil import copyfile
+from stat import S_IMODE
+from fcntl import ioctl
+
+# the Linux ioctl request to clone a file, see FICLONE in linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    """Creates dst as a copy-on-write clone of src
+
+    Parameters
+    ----------
+    src : str
+        The path of the file to clone
+    dst : str
+        The path of the new file
+
+    Raises
+    ------
+    OSError
+        If the filesystem doesn't support reflinks (or they are in different
+        filesystems)
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            remove(dst)
+            raise
+
+
+def place_file(src, dst, mode=None):
+    """Places src in dst avoiding copying the data when possible
+
+    Parameters
+    ----------
+    src : str
+        The path of the file to place
+    dst : str
+        The path where to place the file
+    mode : int, optional
+        The permissions of dst, like 0o664
+
+    Notes
+    -----
+    We first try to reflink the file (supported by filesystems like btrfs or
+    XFS), which creates a new file sharing the data until one of them is
+    modified; then to hardlink it, which doesn't write any data; and finally
+    we copy it. In all cases dst is a new path that can be moved or removed
+    without affecting src. However, as hardlinks share the data and
+    permissions with src: they are only used if src already has the
+    requested mode (so dst is never chmod-ed, which would change src too),
+    and dst should never be modified in place, it must be replaced instead.
+    """
+    try:
+        reflink(src, dst)
+    except OSError:
+        if mode is None or S_IMODE(stat(src).st_mode) == mode:
+            try:
+                link(src, dst)
+                return
+            except OSError:
+                pass
+        copyfile(src, dst)
+
+    # reflinks & copies are new files (inodes), so this doesn't change src
+    if mode is not None:
+        chmod(dst, mode)
+
+
+def export_artifact(q2artifact, output_dir, mode=None):
+    """Exports the data of a qiime2.Artifact
+
+    Parameters
+    ----------
+    q2artifact : qiime2.Artifact
+        The artifact to export
+    output_dir : str
+        The folder where to export the data
+    mode : int, optional
+        The permissions of the exported files, like 0o664
+
+    Returns
+    -------
+    list of str
+        The names of the files exported
+
+    Notes
+    -----
+    Artifact.export_data copies the files of the data folder of the archive,
+    which qiime2 keeps extracted, to output_dir; as this doubles the write
+    I/O of the outputs, which we already wrote to the .qza, we place the
+    files from that folder, via place_file, instead. If the archive doesn't
+    look as expected, because it's not extracted or the data has subfolders,
+    we fallback to export_data. Note that the files placed from the archive
+    can be hardlinks to the files of qiime2, so their permissions must be
+    set via mode, not changed after exporting them.
+    """
+    archiver = getattr(q2artifact, '_archiver', None)
+    data_dir = getattr(archiver, 'data_dir', None)
+    if data_dir is not None and isdir(data_dir):
+        entries = list(scandir(data_dir))
+        if all(entry.is_file() for entry in entries):
+            makedirs(output_dir, exist_ok=True)
+            for entry in entries:
+                place_file(entry.path, join(output_dir, entry.name), mode)
+            return [entry.name for entry in entries]
+
+    # export_data copies the files, so they can be chmod-ed
+    q2artifact.export_data(output_dir=output_dir)
+    names = []
+    for entry in scandir(output_dir):
+        if mode is not None and entry.is_file():
+            chmod(entry.path, mode)
+        names.append(entry.name)
+    return names
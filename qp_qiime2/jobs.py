@@ -0,0 +1,240 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import makedirs, rename, remove
+from os.path import join, dirname, relpath, isabs, basename
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qiita_client import ArtifactInfo
+
+from .cache import (
+    get_cache_dir, get_cached_file, hash_key, load_json, save_json,
+    evict_cache, TMP_EXTENSION)
+from .files import place_file
+from .resources import THREAD_PARAMETERS
+
+# Note that qiime2 is imported within the functions, see the note in
+# qp_qiime2.py
+
+# the version of the job results, it should be increased when call_qiime2
+# changes its outputs (for example, their files) so the cached results of
+# the previous versions are not used
+JOB_CACHE_VERSION = 1
+# the Qiita parameter to reuse the results of an identical job, added to
+# all the commands (see util.py); it's enabled by default so the users can
+# opt out, for example, to run a job again
+JOB_CACHE_PARAMETER = 'Reuse the results of an identical job'
+# the methods with random results that don't take a seed, their results are
+# never reused as they would always return the same result
+RANDOM_METHODS = {
+    ('feature-table', 'rarefy'), ('feature-table', 'subsample_ids'),
+    ('diversity', 'core_metrics'), ('diversity', 'core_metrics_phylogenetic'),
+    ('diversity', 'alpha_rarefaction'), ('diversity', 'beta_rarefaction')}
+# the parameters with the seed of the methods with random results; without
+# a seed (None) their results are random too
+SEED_PARAMETERS = ('random_state', 'random_seed', 'seed')
+# the file, in each job folder of the cache, with the artifacts information
+OUT_INFO_FILENAME = 'out_info.json'
+# the parameters that only change how fast a method runs, not its results,
+# so they are not part of the key
+PERFORMANCE_PARAMETERS = THREAD_PARAMETERS + ('reads_per_batch', )
+
+
+def is_reusable(q2plugin, q2method, q2params):
+    """Whether the results of a job can be reused by an identical job
+
+    Parameters
+    ----------
+    q2plugin : str
+        The QIIME 2 plugin name
+    q2method : str
+        The QIIME 2 method id
+    q2params : dict of {str: object}
+        The primitive parameters of the method
+
+    Returns
+    -------
+    bool
+        False for the methods with random results, see RANDOM_METHODS &
+        SEED_PARAMETERS
+    """
+    if (q2plugin, q2method) in RANDOM_METHODS:
+        return False
+    return not any(name in q2params and q2params[name] is None
+                   for name in SEED_PARAMETERS)
+
+
+def get_job_key(q2plugin, q2method, q2params, inputs):
+    """Generates the key of a job for the jobs cache
+
+    Parameters
+    ----------
+    q2plugin : str
+        The QIIME 2 plugin name
+    q2method : str
+        The QIIME 2 method id
+    q2params : dict of {str: object}
+        The primitive parameters of the method
+    inputs : dict of {str: object}
+        The inputs of the method, identified by their content, like the hash
+        of their files
+
+    Returns
+    -------
+    str
+        The key of the job
+
+    Notes
+    -----
+    The key includes the versions of QIIME 2 and of the plugin of the method
+    as a new version can generate different results. The parameters are
+    normalized: the sets are sorted and the PERFORMANCE_PARAMETERS are
+    ignored, so the jobs that only differ on them share their results.
+    """
+    import qiime2
+    from qiime2.sdk import PluginManager
+
+    params = {}
+    for name, value in q2params.items():
+        if name in PERFORMANCE_PARAMETERS:
+            continue
+        if isinstance(value, (set, frozenset)):
+            value = sorted(value, key=str)
+        params[name] = value
+
+    return hash_key([
+        JOB_CACHE_VERSION, qiime2.__version__,
+        PluginManager().plugins[q2plugin].version, q2plugin, q2method,
+        params, inputs])
+
+
+def _rename(fp, names):
+    """Replaces the file name of fp if it's in names"""
+    fname = basename(fp)
+    if fname not in names:
+        return fp
+    return join(dirname(fp), names[fname])
+
+
+def get_cached_job(key, out_dir, names=None):
+    """Places the results of a cached job in out_dir
+
+    Parameters
+    ----------
+    key : str
+        The key of the job, see get_job_key
+    out_dir : str
+        The folder where to place the results
+    names : dict of {str: str}, optional
+        The names of the files that depend on the job, like the trees named
+        after the input artifact: {placeholder: file name}, see
+        add_job_to_cache
+
+    Returns
+    -------
+    list of qiita_client.ArtifactInfo or None
+        The artifacts information of the job, pointing to the files in
+        out_dir, or None if the job is not cached
+
+    Notes
+    -----
+    The files are hardlinked (or reflinked) from the cache when possible,
+    see files.place_file, so this doesn't copy any data
+    """
+    cached_dir = get_cached_file('jobs', key, '')
+    if cached_dir is None:
+        return None
+    out_info = load_json(join(cached_dir, OUT_INFO_FILENAME))
+    if out_info is None:
+        return None
+
+    names = names or {}
+    placed = []
+    result = []
+    try:
+        for name, atype, files in out_info:
+            ai_files = []
+            for fp, ftype in files:
+                dst = join(out_dir, _rename(fp, names))
+                makedirs(dirname(dst), exist_ok=True)
+                place_file(join(cached_dir, fp), dst)
+                placed.append(dst)
+                ai_files.append((dst, ftype))
+            result.append(ArtifactInfo(name, atype, ai_files))
+    except OSError:
+        # the job could have been evicted while we were placing the files;
+        # the job will run normally so let's not leave any of them behind
+        for fp in placed:
+            remove(fp)
+        return None
+
+    return result
+
+
+def add_job_to_cache(key, out_dir, out_info, names=None):
+    """Stores the results of a job in the jobs cache
+
+    Parameters
+    ----------
+    key : str
+        The key of the job, see get_job_key
+    out_dir : str
+        The folder of the job results
+    out_info : list of qiita_client.ArtifactInfo
+        The artifacts information of the job
+    names : dict of {str: str}, optional
+        The names of the files that depend on the job: {placeholder: file
+        name}. These files are stored as their placeholder so, when reused,
+        they get the names of the new job, see get_cached_job
+
+    Returns
+    -------
+    bool
+        Whether the job was stored; the jobs with files outside of out_dir
+        are not, as we can't place them in the same location
+    """
+    cache_dir = get_cache_dir('jobs')
+    if cache_dir is None:
+        return False
+
+    placeholders = {v: k for k, v in (names or {}).items()}
+    cached_info = []
+    sources = {}
+    for ai in out_info:
+        files = []
+        for fp, ftype in ai.files:
+            rfp = relpath(fp, out_dir)
+            if isabs(rfp) or rfp.startswith('..'):
+                return False
+            cfp = _rename(rfp, placeholders)
+            sources[cfp] = rfp
+            files.append((cfp, ftype))
+        cached_info.append((ai.output_name, ai.artifact_type, files))
+
+    # first placing the files in a temporary folder so other jobs never see
+    # a partially written job
+    tmp_dir = mkdtemp(dir=cache_dir, suffix=TMP_EXTENSION)
+    try:
+        for _, _, files in cached_info:
+            for fp, _ in files:
+                dst = join(tmp_dir, fp)
+                makedirs(dirname(dst), exist_ok=True)
+                place_file(join(out_dir, sources[fp]), dst)
+        save_json(join(tmp_dir, OUT_INFO_FILENAME), cached_info)
+        try:
+            rename(tmp_dir, join(cache_dir, key))
+        except OSError:
+            # an identical job stored its results first, which is fine
+            pass
+    finally:
+        rmtree(tmp_dir, ignore_errors=True)
+
+    evict_cache('jobs')
+
+    return True
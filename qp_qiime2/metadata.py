@@ -0,0 +1,111 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from pickle import dump, load, UnpicklingError, PicklingError
+
+from .cache import hash_key, get_cached_file, add_to_cache
+from .qiita import METADATA_URL
+
+# Note that qiime2 & pandas are imported within the functions, see the note
+# in qp_qiime2.py
+
+
+def build_metadata(payload):
+    """Creates a qiime2.Metadata from the Qiita analysis metadata
+
+    Parameters
+    ----------
+    payload : dict of {str: dict of {str: str}}
+        The analysis metadata as returned by Qiita:
+        /qiita_db/analysis/<id>/metadata/; {sample_id: {column: value}}
+
+    Returns
+    -------
+    qiime2.Metadata
+        The metadata, using INSDC:missing as the missing scheme of all the
+        columns
+
+    Notes
+    -----
+    This is equivalent to saving the metadata as a TSV and loading it with
+    qiime2.Metadata.load(fp, column_missing_schemes={c: 'INSDC:missing'}),
+    which is what we used to do, but without the round-trip to disk:
+    all values are converted to strings (like when writing the TSV), the
+    whitespace around them is removed and empty values are missing. Then
+    the INSDC:missing encoding of qiime2 replaces the INSDC terms with
+    missing values and makes numeric the columns that only have numbers.
+    """
+    import pandas as pd
+    import qiime2
+
+    df = pd.DataFrame.from_dict(payload, orient='index')
+    df.index = df.index.astype(str).str.strip()
+    df.index.name = '#SampleID'
+    df.columns = df.columns.astype(str).str.strip()
+    df = df.fillna('').astype(str)
+    df = df.apply(lambda x: x.str.strip()).replace('', float('nan'))
+    # pandas can set the column types while replacing; we want them as
+    # objects so qiime2 is the one deciding which columns are numeric
+    df = df.astype(object)
+
+    return qiime2.Metadata(df, column_missing_schemes={
+        c: 'INSDC:missing' for c in df.columns})
+
+
+def get_analysis_metadata(qclient, analysis_id):
+    """Retrieves the metadata of an analysis as a qiime2.Metadata
+
+    Parameters
+    ----------
+    qclient : qiita_client.QiitaClient
+        The Qiita server client
+    analysis_id : int
+        The analysis id
+
+    Returns
+    -------
+    qiime2.Metadata
+        The analysis metadata, see build_metadata
+
+    Notes
+    -----
+    All the jobs of an analysis use the same metadata so, if QP_QIIME2_CACHE
+    is set, the resulting qiime2.Metadata is stored in the metadata cache.
+    As the metadata can change (for example, when the sample information is
+    updated), the cache is keyed by the analysis id and a fingerprint of the
+    payload returned by Qiita, so a modified metadata will never match.
+    """
+    import qiime2
+    import pandas as pd
+
+    payload = qclient.get(METADATA_URL % analysis_id)
+    key = hash_key([str(analysis_id), qiime2.__version__, pd.__version__,
+                    payload])
+
+    cached_fp = get_cached_file('metadata', key, '.pickle')
+    if cached_fp is not None:
+        try:
+            with open(cached_fp, 'rb') as f:
+                return load(f)
+        except (OSError, EOFError, UnpicklingError):
+            # the file could have been evicted or be corrupted so let's
+            # simply build it again
+            pass
+
+    q2Metadata = build_metadata(payload)
+
+    def _writer(fp):
+        with open(fp, 'wb') as f:
+            dump(q2Metadata, f)
+    try:
+        add_to_cache('metadata', key, '.pickle', _writer)
+    except (OSError, PicklingError):
+        # not being able to cache (for example, disk full) is not an error
+        pass
+
+    return q2Metadata
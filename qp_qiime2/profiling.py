@@ -0,0 +1,180 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from os import times, scandir
+from os.path import getsize, isdir, exists
+from time import time
+from json import dump
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+
+from .tables import load_table_shape
+
+# the name of the profile file written in the job's output directory
+PROFILE_FILENAME = 'qp-qiime2-profile.json'
+
+
+def _read_proc_io():
+    """Returns the I/O counters of this process, see proc(5)"""
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+def _reset_peak_rss():
+    """Resets the peak RSS (VmHWM) of this process, returns if it worked"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _read_peak_rss():
+    """Returns the peak RSS (VmHWM) of this process in bytes"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    # ru_maxrss is in KB and it's the peak of the whole process
+    return getrusage(RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_path_size(fp):
+    """Returns the size of a file or folder (all its files) in bytes"""
+    if not isdir(fp):
+        return getsize(fp)
+    return sum(get_path_size(entry.path) for entry in scandir(fp))
+
+
+class JobProfile:
+    """Collects the time & resources used by each phase of a job
+
+    Parameters
+    ----------
+    job_id : str
+        The job id
+
+    Notes
+    -----
+    Each phase starts when the previous one ends, via start_phase, and
+    records its wall and CPU time (of this process and its children, like
+    the joblib workers), its peak RSS and the bytes read/written, both
+    from/to storage and in total, from /proc/self/io. The peak RSS of each
+    phase is only available on Linux, where we can reset it; otherwise it's
+    the peak of the whole job so far. The inputs & outputs, with their size
+    and, for BIOM tables, their dimensions, are added by call_qiime2.
+    """
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.phases = []
+        self.inputs = []
+        self.outputs = []
+        self._current = None
+
+    def _snapshot(self):
+        t = times()
+        io = _read_proc_io()
+        return {'wall': time(),
+                'cpu': t.user + t.system,
+                'children_cpu': t.children_user + t.children_system,
+                'read_bytes': io.get('read_bytes', 0),
+                'write_bytes': io.get('write_bytes', 0),
+                'rchar': io.get('rchar', 0),
+                'wchar': io.get('wchar', 0)}
+
+    def start_phase(self, name):
+        """Ends the current phase, if any, and starts a new one
+
+        Parameters
+        ----------
+        name : str
+            The name of the phase
+        """
+        self.end_phase()
+        per_phase_rss = _reset_peak_rss()
+        self._current = (name, per_phase_rss, self._snapshot())
+
+    def end_phase(self):
+        """Ends the current phase, if any"""
+        if self._current is None:
+            return
+        name, per_phase_rss, start = self._current
+        end = self._snapshot()
+        phase = {'name': name}
+        phase.update({k: end[k] - start[k] for k in start})
+        phase['peak_rss'] = _read_peak_rss()
+        phase['peak_rss_is_per_phase'] = per_phase_rss
+        # ru_maxrss of the children is the peak of the largest child
+        phase['children_peak_rss'] = getrusage(
+            RUSAGE_CHILDREN).ru_maxrss * 1024
+        self.phases.append(phase)
+        self._current = None
+
+    def _describe(self, name, fp, ftype):
+        info = {'name': name, 'filepath': fp, 'type': ftype, 'size': None}
+        if fp is not None and exists(fp):
+            info['size'] = get_path_size(fp)
+            if ftype == 'biom' or fp.endswith('.biom'):
+                try:
+                    info['shape'] = load_table_shape(fp)
+                except Exception:
+                    # not a valid HDF5 BIOM table, we simply don't report it
+                    pass
+        return info
+
+    def add_input(self, name, fp, ftype=None):
+        """Adds an input file of the job
+
+        Parameters
+        ----------
+        name : str
+            The name of the input, like the method input name
+        fp : str
+            The path to the input file
+        ftype : str, optional
+            The type of the file, like biom
+        """
+        self.inputs.append(self._describe(name, fp, ftype))
+
+    def add_outputs(self, out_info):
+        """Adds the outputs of the job
+
+        Parameters
+        ----------
+        out_info : list of qiita_client.ArtifactInfo
+            The outputs of the job
+        """
+        for ai in out_info:
+            for fp, ftype in ai.files:
+                self.outputs.append(self._describe(ai.output_name, fp, ftype))
+
+    def save(self, fp, success):
+        """Ends the current phase and writes the profile as JSON
+
+        Parameters
+        ----------
+        fp : str
+            The path where to write the profile
+        success : bool
+            Whether the job was successful
+        """
+        self.end_phase()
+        with open(fp, 'w') as f:
+            dump({'job_id': self.job_id, 'success': success,
+                  'phases': self.phases, 'inputs': self.inputs,
+                  'outputs': self.outputs}, f, indent=4)
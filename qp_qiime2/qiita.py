@@ -0,0 +1,352 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from random import random
+from socket import timeout as socket_timeout
+from threading import Lock, Condition, Thread
+from time import time, sleep
+
+# the maximum number of requests to Qiita running at the same time for a job;
+# a job needs a few (its artifacts & the analysis metadata) so there is no
+# need to load the server more than this. Note that it should not be larger
+# than the connection pool of requests (DEFAULT_POOLSIZE, 10 per host) so
+# all the connections of the job are kept alive and reused
+MAX_CONCURRENT_REQUESTS = 4
+
+# the minimum seconds between two updates of the job step; the changes in
+# between are coalesced so only the last one is sent
+MIN_STEP_INTERVAL = 5
+# the seconds between updates when the step doesn't change, so the users can
+# see that the job is still running (and for how long)
+HEARTBEAT_INTERVAL = 60
+# the maximum seconds to wait for a running update when the job finishes
+CLOSE_TIMEOUT = 10
+
+# the number of times a request is retried when it fails with a transient
+# error (see is_transient_error), waiting RETRY_BACKOFF seconds the first
+# time and doubling the wait each time
+MAX_RETRIES = 2
+RETRY_BACKOFF = 2
+
+ARTIFACT_URL = "/qiita_db/artifacts/%s/"
+METADATA_URL = "/qiita_db/analysis/%s/metadata/"
+
+
+def is_transient_error(error):
+    """Whether a request error is transient, so it's worth retrying
+
+    Parameters
+    ----------
+    error : Exception
+        The error raised by the request
+
+    Returns
+    -------
+    bool
+        True for the connection errors & timeouts, of requests or not; the
+        rest of the OSErrors, like a missing file (ENOENT) or a permission
+        error (EACCES), are not transient
+
+    Notes
+    -----
+    qiita_client already retries the requests that Qiita answers with an
+    error status code, raising a RuntimeError when it gives up, so those are
+    not retried again; it doesn't retry the requests that don't get an
+    answer at all
+    """
+    if isinstance(error, (ConnectionError, TimeoutError, socket_timeout)):
+        return True
+    if not isinstance(error, OSError):
+        return False
+    # the errors of requests are OSErrors but not the builtin ones
+    from requests.exceptions import (
+        ConnectionError as RequestsConnectionError, Timeout)
+
+    return isinstance(error, (RequestsConnectionError, Timeout))
+
+
+def call_with_retries(func, *args, **kwargs):
+    """Calls func, retrying it if it fails with a transient error
+
+    Parameters
+    ----------
+    func : callable
+        The request to do, like qclient.get
+    args, kwargs
+        The arguments of func
+
+    Returns
+    -------
+    object
+        What func returns
+
+    Notes
+    -----
+    It's retried up to MAX_RETRIES times with an exponential backoff, with
+    some jitter so the jobs retrying at the same time don't all hit Qiita
+    at once again
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == MAX_RETRIES or not is_transient_error(e):
+                raise
+        sleep(RETRY_BACKOFF * 2 ** attempt * (0.5 + random()))
+
+
+class QiitaJobClient:
+    """Wraps the Qiita client of a job to retrieve its information
+    concurrently and only once
+
+    Parameters
+    ----------
+    qclient : qiita_client.QiitaClient
+        The Qiita server client
+
+    Notes
+    -----
+    The GET requests are memoized for the duration of the job, so asking
+    twice for the same artifact only makes one request, and they can be
+    started in the background with prefetch so their round trips overlap.
+    The requests that fail with a transient error are retried, see
+    call_with_retries, and the ones that fail anyway are not memoized so
+    they are retried the next time they are needed. The requests go through
+    qclient, so they reuse its connections to Qiita (see
+    MAX_CONCURRENT_REQUESTS). The job step updates
+    are sent in the background, see JobStepReporter, and everything else is
+    passed to qclient.
+    """
+    def __init__(self, qclient):
+        self.qclient = qclient
+        self._reporter = JobStepReporter(qclient)
+        self._executor = ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_REQUESTS)
+        self._requests = {}
+        # all the requests started, to cancel the pending ones in close
+        self._futures = []
+        self._lock = Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.qclient, name)
+
+    def _request(self, url):
+        with self._lock:
+            future = self._requests.get(url)
+            if future is None:
+                future = self._executor.submit(
+                    call_with_retries, self.qclient.get, url)
+                self._requests[url] = future
+                self._futures.append(future)
+        return future
+
+    def prefetch(self, *urls):
+        """Starts the GET requests of urls in the background
+
+        Parameters
+        ----------
+        urls : str
+            The urls to retrieve
+        """
+        for url in urls:
+            self._request(url)
+
+    def get(self, url, **kwargs):
+        """GET request to Qiita, memoized
+
+        Parameters
+        ----------
+        url : str
+            The url to retrieve
+        kwargs : dict
+            Passed to qclient.get; the requests with extra arguments are not
+            memoized
+
+        Returns
+        -------
+        dict
+            The response of Qiita; note that it's shared by all the callers
+            so it should not be modified
+        """
+        if kwargs:
+            return call_with_retries(self.qclient.get, url, **kwargs)
+
+        future = self._request(url)
+        try:
+            return future.result()
+        except Exception:
+            with self._lock:
+                if self._requests.get(url) is future:
+                    del self._requests[url]
+            raise
+
+    def update_job_step(self, job_id, new_step, ignore_error=False):
+        """Updates the step of the job without waiting, see JobStepReporter
+        """
+        self._reporter.update(job_id, new_step)
+
+    def update_progress(self, done, total, units):
+        """Updates the progress within the step, see JobStepReporter"""
+        self._reporter.update_progress(done, total, units)
+
+    def close(self):
+        """Stops the background requests & updates that didn't start"""
+        # note that shutdown(cancel_futures=True) needs python 3.9
+        with self._lock:
+            for future in self._futures:
+                future.cancel()
+        self._executor.shutdown(wait=False)
+        self._reporter.close()
+
+
+class JobStepReporter:
+    """Sends the job step updates to Qiita from a background thread
+
+    Parameters
+    ----------
+    qclient : qiita_client.QiitaClient
+        The Qiita server client
+    clock : callable, optional
+        Returns the current time in seconds, time.time by default; the
+        tests use their own so the updates don't depend on how fast the
+        thread runs
+
+    Notes
+    -----
+    update & update_progress never wait for Qiita: they only change the
+    message that the thread sends. The thread sends at most one update each
+    MIN_STEP_INTERVAL seconds, so when the step changes several times in
+    between only the last one is sent, and sends the message again each
+    HEARTBEAT_INTERVAL seconds, with the elapsed time of the step, while it
+    doesn't change. The errors are ignored, the step is only informative.
+    """
+    def __init__(self, qclient, clock=time):
+        self.qclient = qclient
+        self._clock = clock
+        self._cond = Condition()
+        self._thread = None
+        self._closed = False
+        self._version = 0
+        self._job_id = None
+        self._step = None
+        self._step_start = None
+        self._progress = None
+
+    def update(self, job_id, step):
+        """Sets the step of the job
+
+        Parameters
+        ----------
+        job_id : str
+            The job id
+        step : str
+            The new step, it resets the progress
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._job_id = job_id
+            self._step = step
+            self._step_start = self._clock()
+            self._progress = None
+            self._version += 1
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def update_progress(self, done, total, units):
+        """Sets the progress within the current step
+
+        Parameters
+        ----------
+        done : int
+            The number of units done
+        total : int
+            The total number of units
+        units : str
+            What is being processed, like outputs
+        """
+        with self._cond:
+            self._progress = (done, total, units)
+            self._version += 1
+            self._cond.notify()
+
+    def get_message(self, now=None):
+        """Returns the message of the current step
+
+        Parameters
+        ----------
+        now : float, optional
+            The current time, to calculate the elapsed time of the step
+
+        Returns
+        -------
+        str
+            The step, followed by its progress and elapsed time, if any:
+            Step 4 of 4: Processing results (2 of 5 outputs, elapsed:
+            0:01:05)
+        """
+        if now is None:
+            now = self._clock()
+        details = []
+        if self._progress is not None:
+            details.append('%d of %d %s' % self._progress)
+        elapsed = int(now - self._step_start)
+        if elapsed:
+            details.append('elapsed: %s' % timedelta(seconds=elapsed))
+        if not details:
+            return self._step
+        return '%s (%s)' % (self._step, ', '.join(details))
+
+    def _run(self):
+        sent_version = 0
+        last_sent = None
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    now = self._clock()
+                    if last_sent is None:
+                        due = now
+                    elif self._version != sent_version:
+                        due = last_sent + MIN_STEP_INTERVAL
+                    else:
+                        due = last_sent + HEARTBEAT_INTERVAL
+                    if now >= due:
+                        break
+                    self._cond.wait(due - now)
+                job_id, message = self._job_id, self.get_message(now)
+                sent_version = self._version
+
+            # qiita_client retries the update and, with ignore_error, doesn't
+            # raise if it fails
+            try:
+                self.qclient.update_job_step(
+                    job_id, message, ignore_error=True)
+            except Exception:
+                pass
+            last_sent = self._clock()
+
+    def close(self):
+        """Stops sending updates
+
+        Notes
+        -----
+        The pending updates are discarded but, if one is being sent, it
+        waits up to CLOSE_TIMEOUT seconds for it so it doesn't reach Qiita
+        after the job is completed
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(CLOSE_TIMEOUT)
@@ -6,21 +6,35 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os import mkdir, listdir, chmod
-from os.path import join, exists, basename
-from shutil import copyfile
-
-from biom import load_table
-from biom.util import biom_open
+from os import mkdir, chmod, environ, replace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os.path import join, exists, basename, isfile
 
 from qiita_client import ArtifactInfo
 
-import qiime2
-import pandas as pd
-
-# avoid some alpha metrics within the alpha_rarefaction method
-from q2_diversity._alpha import (
-    alpha_rarefaction_unsupported_metrics)
+from .cache import (
+    hash_key, hash_file, get_cache_dir, get_cached_file, add_to_cache,
+    evict_cache)
+from .metadata import get_analysis_metadata
+from .tables import (
+    load_observation_ids, add_observation_metadata,
+    write_observation_ids_as_fasta, write_table_with_taxonomy)
+from .files import export_artifact, place_file
+from .profiling import JobProfile, PROFILE_FILENAME
+from .qiita import QiitaJobClient, ARTIFACT_URL, METADATA_URL
+from .jobs import (
+    get_job_key, get_cached_job, add_job_to_cache, is_reusable,
+    JOB_CACHE_PARAMETER)
+from .resources import (
+    get_cpu_count, fill_thread_parameters, limit_threads, THREAD_PARAMETERS,
+    AUTO_THREADS)
+from .classifiers import (
+    load_classifier, get_assignments_key, get_cached_assignments,
+    add_cached_assignments, get_classify_sklearn_batching)
+
+# Note that qiime2, pandas and biom are imported within call_qiime2 as they
+# are slow to import and they are not needed to start the plugin or to
+# register the commands (when using the registry cache)
 
 
 Q2_ANALYSIS_PLUGINS = [
@@ -178,13 +192,11 @@ RENAME_COMMANDS = {
     ('beta', 'metric'): BETA_DIVERSITY_METRICS,
     ('alpha_phylogenetic', 'metric'): ALPHA_DIVERSITY_METRICS_PHYLOGENETIC,
     ('beta_phylogenetic', 'metric'): BETA_DIVERSITY_METRICS_PHYLOGENETIC,
-    # alpha rarefaction has some "forbidden" metrics and we need to be sure to
-    # not add them here
+    # alpha rarefaction has some "forbidden" metrics, which are removed while
+    # registering the command (see util.py) so we don't need to import
+    # q2_diversity here
     ('alpha_rarefaction', 'metrics'): {
-        name: metric for name, metric in
-        {**ALPHA_DIVERSITY_METRICS,
-         **ALPHA_DIVERSITY_METRICS_PHYLOGENETIC}.items()
-        if metric not in alpha_rarefaction_unsupported_metrics},
+        **ALPHA_DIVERSITY_METRICS, **ALPHA_DIVERSITY_METRICS_PHYLOGENETIC},
     ('beta_rarefaction', 'metric'): {
         **BETA_DIVERSITY_METRICS, **BETA_DIVERSITY_METRICS_PHYLOGENETIC},
     ('beta_rarefaction', 'correlation_method'): CORRELATION_METHODS,
@@ -194,19 +206,215 @@ RENAME_COMMANDS = {
 }
 
 
-def call_qiime2(qclient, job_id, parameters, out_dir):
-    """helper method to call Qiime2
+def import_data(dt, fpath, view_type=None):
+    """Imports a file as a qiime2.Artifact using the artifacts cache
+
+    Parameters
+    ----------
+    dt : str
+        The semantic type of the artifact
+    fpath : str
+        The path of the file to import
+    view_type : str, optional
+        The format of fpath
+
+    Returns
+    -------
+    qiime2.Artifact
+        The imported artifact
+
+    Notes
+    -----
+    The same Qiita files (mainly BIOM tables) are imported by lots of jobs,
+    thus, if QP_QIIME2_CACHE is set, the imported artifact is stored in the
+    artifacts cache, keyed by the file content, semantic type and format, so
+    other jobs can load it directly
+    """
+    import qiime2
+
+    # without cache there is no need to hash the (possibly large) file
+    if get_cache_dir('artifacts') is None:
+        return qiime2.Artifact.import_data(dt, fpath, view_type)
+
+    key = hash_key([dt, view_type, hash_file(fpath)])
+    cached_fp = get_cached_file('artifacts', key, '.qza')
+    if cached_fp is not None:
+        try:
+            return qiime2.Artifact.load(cached_fp)
+        except Exception:
+            # the file could have been evicted or be corrupted so let's
+            # simply import it again
+            pass
+
+    qza = qiime2.Artifact.import_data(dt, fpath, view_type)
+    try:
+        add_to_cache('artifacts', key, '.qza', qza.save)
+    except OSError:
+        # not being able to cache (for example, disk full) is not an error
+        pass
+
+    return qza
+
+
+def _convert_input(name, fpath, dt):
+    """Converts an input of the job to a QIIME 2 artifact
+
+    Parameters
+    ----------
+    name : str
+        The name of the input
+    fpath : str
+        The path of the input file
+    dt : str
+        The semantic type of the input
+
+    Returns
+    -------
+    qiime2.Artifact or None, str or None
+        The artifact and None, or None and the error message for the user
+    """
+    import qiime2
+
+    if name == 'FeatureData[Taxonomy]':
+        try:
+            qza = import_data(
+                'FeatureData[Taxonomy]', fpath, 'BIOMV210Format')
+        except Exception:
+            return None, ('Error generating taxonomy. Are you sure this '
+                          'artifact has taxonomy?')
+    elif not fpath.endswith('.qza'):
+        try:
+            qza = import_data(dt, fpath)
+        except Exception as e:
+            return None, 'Error converting "%s": %s' % (str(dt), str(e))
+    elif name == 'classifier':
+        qza = load_classifier(fpath)
+    else:
+        qza = qiime2.Artifact.load(fpath)
+
+    return qza, None
+
+
+def _get_job_key(qclient, q2plugin, q2method, q2params, q2inputs,
+                 m_param_name, analysis_id, biom_fp, metadata_fp,
+                 attached_fps):
+    """Returns the key of the job in the jobs cache, see jobs.get_job_key
 
     Parameters
     ----------
     qclient : qiita_client.QiitaClient
         The Qiita server client
+    q2plugin, q2method : str
+        The QIIME 2 plugin name and method id
+    q2params : dict
+        The parameters of the method
+    q2inputs : dict of {str: (str, str)}
+        The inputs of the method: {name: (filepath, semantic type)}
+    m_param_name : str
+        The name of the MetadataColumn parameter of the method, if any
+    analysis_id : int
+        The analysis id of the job
+    biom_fp, metadata_fp : str or None
+        The BIOM table and metadata artifact of the job, if any
+    attached_fps : dict of {str: str}
+        The files of the input artifacts that are added to the outputs,
+        like their trees: {name: filepath or None}
+
+    Returns
+    -------
+    str or None
+        The key or None if some of the inputs are not files, so we can't
+        tell if they are the same
+    """
+    inputs = {}
+    for k, (fpath, dt) in q2inputs.items():
+        if k in ('metadata', 'sample_metadata', m_param_name):
+            # the metadata is identified by its content in Qiita
+            inputs[k] = (fpath, hash_key(
+                qclient.get(METADATA_URL % analysis_id)))
+        elif k == 'FeatureData[Taxonomy]' and biom_fp is not None:
+            # the taxonomy is read from the BIOM table, see _convert_input
+            if not isfile(biom_fp):
+                return None
+            inputs[k] = hash_file(biom_fp)
+        elif fpath is None:
+            inputs[k] = None
+        elif isfile(fpath):
+            inputs[k] = (dt, hash_file(fpath))
+        else:
+            return None
+
+    # the files added to the outputs are part of the results too
+    for name, fpath in attached_fps.items():
+        if fpath is None:
+            inputs['attached %s' % name] = None
+        elif isfile(fpath):
+            inputs['attached %s' % name] = hash_file(fpath)
+        else:
+            return None
+
+    params = dict(q2params)
+    if metadata_fp is not None:
+        if not isfile(metadata_fp):
+            return None
+        params['metadata'] = hash_file(metadata_fp)
+
+    return get_job_key(q2plugin, q2method, params, inputs)
+
+
+def call_qiime2(qclient, job_id, parameters, out_dir):
+    """helper method to call Qiime2, see _call_qiime2
+
+    Notes
+    -----
+    This wraps qclient for the job (see qiita.py) and writes the time &
+    resources used by each of the steps of the job, and the size of its
+    inputs and outputs, to PROFILE_FILENAME in out_dir, see profiling.py.
+    The hashes cache is evicted once, at the end of the job, see
+    cache.hash_file
+    """
+    profile = JobProfile(job_id)
+    # the requests to Qiita of the job are memoized and some of them are
+    # done concurrently, and the job step updates are sent in the
+    # background, see qiita.py
+    qclient = QiitaJobClient(qclient)
+    success, out_info = False, None
+    try:
+        success, out_info, msg = _call_qiime2(
+            qclient, job_id, parameters, out_dir, profile)
+        if success:
+            profile.add_outputs(out_info)
+    finally:
+        qclient.close()
+        # not being able to evict the cache is not an error either
+        try:
+            evict_cache('hashes')
+        except OSError:
+            pass
+        # the profile should never make the job fail
+        try:
+            profile.save(join(out_dir, PROFILE_FILENAME), success)
+        except Exception:
+            pass
+
+    return success, out_info, msg
+
+
+def _call_qiime2(qclient, job_id, parameters, out_dir, profile):
+    """helper method to call Qiime2
+
+    Parameters
+    ----------
+    qclient : qiita.QiitaJobClient
+        The Qiita server client of the job
     job_id : str
         The job id
     parameters : dict
         The parameter values to process
     out_dir : str
         The path to the job's output directory
+    profile : profiling.JobProfile
+        The profile of the job, where each step starts its phase
 
     Returns
     -------
@@ -214,9 +422,19 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
         The results of the job
     """
     qclient.update_job_step(job_id, "Step 1 of 4: Collecting information")
+    profile.start_phase('Collecting information')
+    from biom import load_table
+    from biom.util import biom_open
+    import qiime2
+    import pandas as pd
+
     q2plugin = parameters.pop('qp-hide-plugin')
     q2method = parameters.pop('qp-hide-method').replace('-', '_')
     q2plugin_is_process = q2plugin in Q2_PROCESSING_PLUGINS
+    # the results are reused by default, unless the users opt out (see
+    # jobs.py)
+    reuse_results = str(parameters.pop(
+        JOB_CACHE_PARAMETER, True)).lower() == 'true'
     pm = qiime2.sdk.PluginManager()
     method = pm.plugins[q2plugin].actions[q2method]
 
@@ -237,6 +455,7 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
     method_params = method.signature.parameters.copy()
     artifact_id = None
     analysis_id = None
+    metadata_fp = None
     biom_fp = None
     tree_fp = None
     tree_fp_check = False
@@ -246,6 +465,23 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
                     if y.qiime_type.name == 'MetadataColumn']
     if m_param_name:
         m_param_name = m_param_name[0]
+    # the methods with metadata parameters will need the analysis metadata
+    needs_metadata = bool(m_param_name) or any(
+        y.qiime_type.name == 'Metadata' for y in method_params.values())
+
+    # retrieving the information of all the input artifacts at once, so the
+    # round trips to Qiita overlap, as they are used in the loop below
+    artifact_ids = []
+    for k, key in parameters.items():
+        if not k.startswith(label) or key not in method_inputs:
+            continue
+        val = parameters.get(k[label_len:], '')
+        if key in ('phylogeny', 'classifier', 'data') or (
+                q2plugin_is_process and 'taxonomy' in val):
+            continue
+        artifact_ids.append(val)
+    qclient.prefetch(*[ARTIFACT_URL % aid for aid in artifact_ids])
+
     for k in list(parameters):
         if k in parameters and k.startswith(label):
             key = parameters.pop(k)
@@ -286,13 +522,17 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
                     # filepath here, this will also allow us to collect the
                     # analysis_id
                     artifact_id = val
-                    ainfo = qclient.get(
-                        "/qiita_db/artifacts/%s/" % artifact_id)
+                    ainfo = qclient.get(ARTIFACT_URL % artifact_id)
                     if not q2plugin_is_process and ainfo['analysis'] is None:
                         msg = ('Artifact "%s" is not an analysis '
                                'artifact.' % val)
                         return False, None, msg
                     analysis_id = ainfo['analysis']
+                    # the metadata is retrieved while we process the rest
+                    # of the parameters; note that all the artifacts are
+                    # from the same analysis
+                    if needs_metadata and analysis_id is not None:
+                        qclient.prefetch(METADATA_URL % analysis_id)
                     dt = method_inputs[key].qiime_type.to_ast()['name']
                     if 'qza' not in ainfo['files']:
                         # at this stage in qiita we only have 2 types of
@@ -338,6 +578,10 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
             else:
                 if val in ('', 'None'):
                     continue
+                # the jobs/threads the user didn't set are filled below,
+                # see resources.py
+                if key in THREAD_PARAMETERS and val == AUTO_THREADS:
+                    continue
 
                 # let's bring back the original name of these parameters
                 mkey = method_params[key]
@@ -365,6 +609,7 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
                 key_value = parameters.pop(key)
                 if not key_value:
                     continue
+                metadata_fp = key_value
                 q2params['metadata'] = qiime2.Artifact.load(
                     key_value).view(qiime2.Metadata)
             else:
@@ -386,48 +631,62 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
     if tree_fp_check:
         q2inputs['phylogeny'] = (tree_fp, q2inputs['phylogeny'][1])
 
+    # if QP_QIIME2_CACHE is set, we can reuse the results of an identical
+    # job: same method, parameters and input contents, see jobs.py. Note
+    # that the trees of the inputs are added to the outputs, named after
+    # the input artifact, so they are part of the key and are renamed
+    classify = (q2plugin == 'feature-classifier' and
+                q2method == 'classify_sklearn')
+    attached_fps = {'tree': tree_fp, 'plain_text': None}
+    if classify:
+        reads_files = qclient.get(ARTIFACT_URL % parameters[
+            'The feature data to be classified.'])['files']
+        if 'plain_text' in reads_files:
+            attached_fps['plain_text'] = reads_files['plain_text'][0][
+                'filepath']
+    job_names = {}
+    if tree_fp is not None:
+        job_names['{tree}'] = 'from_%s_%s' % (artifact_id, basename(tree_fp))
+    if attached_fps['plain_text'] is not None:
+        job_names['{plain_text}'] = basename(attached_fps['plain_text'])
+    job_key = None
+    if reuse_results and get_cache_dir('jobs') is not None and is_reusable(
+            q2plugin, q2method, q2params):
+        job_key = _get_job_key(
+            qclient, q2plugin, q2method, q2params, q2inputs, m_param_name,
+            analysis_id, biom_fp, metadata_fp, attached_fps)
+    if job_key is not None:
+        out_info = get_cached_job(job_key, out_dir, job_names)
+        if out_info is not None:
+            qclient.update_job_step(
+                job_id, "Step 4 of 4: Processing results (reusing the "
+                "results of an identical job)")
+            profile.start_phase('Processing results')
+            return True, out_info, ''
+
     # let's process/import inputs
     qclient.update_job_step(
         job_id, "Step 2 of 4: Converting Qiita artifacts to Q2 artifact")
+    profile.start_phase('Converting')
+    # the inputs are independent so they are converted at the same time;
+    # in threads as the artifacts can't be shared between processes. Note
+    # that the errors are returned in the order of the inputs, like when
+    # they were converted one at a time
+    cpus = get_cpu_count()
+    metadata_keys = ('metadata', 'sample_metadata', m_param_name)
+    to_convert = []
     for k, (fpath, dt) in q2inputs.items():
-        if k in ('metadata', 'sample_metadata', m_param_name):
-            metadata = qclient.get(
-                "/qiita_db/analysis/%s/metadata/" % str(analysis_id))
-            metadata = pd.DataFrame.from_dict(metadata, orient='index')
-            # the reason we need to save and load the mapping file is
-            # so Qiime2 assings the expected data types to the columns
-            metadata_fp = join(out_dir, 'metadata.txt')
-            metadata.to_csv(metadata_fp, index_label='#SampleID', na_rep='',
-                            sep='\t', encoding='utf-8')
-            # in 2022.8.3 qiime2 has a bug and the current solution is to load
-            # the file twice; the plan is that in the future this will not be
-            # needed
-            metadata_columns = qiime2.Metadata.load(metadata_fp).columns
-            q2Metadata = qiime2.Metadata.load(
-                metadata_fp, column_missing_schemes={
-                    c: 'INSDC:missing' for c in metadata_columns})
-            if fpath:
-                q2params[k] = q2Metadata.get_column(fpath)
-            else:
-                q2params[k] = q2Metadata
+        if k in metadata_keys:
+            continue
         elif k == 'FeatureData[Taxonomy]':
-            try:
-                qza = qiime2.Artifact.import_data(
-                    'FeatureData[Taxonomy]', biom_fp, 'BIOMV210Format')
-            except Exception:
-                return False, None, ('Error generating taxonomy. Are you '
-                                     'sure this artifact has taxonomy?')
-            q2params['taxonomy'] = qza
-        elif fpath is not None:
-            if not fpath.endswith('.qza'):
-                try:
-                    qza = qiime2.Artifact.import_data(dt, fpath)
-                except Exception as e:
-                    return False, None, 'Error converting "%s": %s' % (
-                        str(dt), str(e))
-            elif exists(fpath):
-                qza = qiime2.Artifact.load(fpath)
-            q2params[k] = qza
+            to_convert.append(('taxonomy', k, biom_fp, dt))
+            if biom_fp is not None:
+                profile.add_input(k, biom_fp, 'biom')
+        elif fpath is not None and (
+                not fpath.endswith('.qza') or k == 'classifier' or
+                exists(fpath)):
+            to_convert.append((k, k, fpath, dt))
+            profile.add_input(k, fpath)
         else:
             # adding an else for completeness: if we get here then we should
             # ignore that parameter/input passed. By design, this should only
@@ -437,24 +696,57 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
             # future it might be useful to always ignore anything that doesn't
             # exits.
             pass
+    # all the metadata inputs are from the same analysis so we only need to
+    # retrieve it once
+    needs_q2metadata = any(k in metadata_keys for k in q2inputs)
+
+    n_tasks = len(to_convert) + needs_q2metadata
+    with ThreadPoolExecutor(max_workers=max(min(n_tasks, cpus), 1)) as ex:
+        futures = [ex.submit(_convert_input, k, fpath, dt)
+                   for _, k, fpath, dt in to_convert]
+        if needs_q2metadata:
+            futures.append(ex.submit(
+                get_analysis_metadata, qclient, analysis_id))
+        for i, _ in enumerate(as_completed(futures)):
+            qclient.update_progress(i + 1, n_tasks, 'inputs')
+
+    for (name, _, _, _), future in zip(to_convert, futures):
+        qza, msg = future.result()
+        if msg is not None:
+            return False, None, msg
+        q2params[name] = qza
+
+    if needs_q2metadata:
+        q2Metadata = futures[-1].result()
+        # the metadata is not needed on disk but it's useful to review what
+        # was passed to qiime2 while debugging
+        if environ.get('QP_QIIME2_DEBUG'):
+            q2Metadata.save(join(out_dir, 'metadata.txt'))
+        for k, (fpath, _) in q2inputs.items():
+            if k not in metadata_keys:
+                continue
+            if fpath:
+                q2params[k] = q2Metadata.get_column(fpath)
+            else:
+                q2params[k] = q2Metadata
 
     # if feature_classifier and classify_sklearn we need to transform the
     # input data to sequences
     if q2plugin == 'feature-classifier' and q2method == 'classify_sklearn':
-        ainfo = qclient.get("/qiita_db/artifacts/%s/" %
-                            parameters['The feature data to be classified.'])
+        ainfo = qclient.get(
+            ARTIFACT_URL % parameters['The feature data to be classified.'])
         biom_fp = ainfo['files']['biom'][0]['filepath']
+        profile.add_input('The feature data to be classified.', biom_fp,
+                          'biom')
         plain_text_fp = None
         if 'plain_text' in ainfo['files']:
             plain_text_fp = ainfo['files']['plain_text'][0]['filepath']
-        biom_table = load_table(biom_fp)
+        # note that we only need the ids (sequences) of the table, the full
+        # table is loaded after the classification
         fna_fp = join(out_dir, 'sequences.fna')
-        with open(fna_fp, 'w') as f:
-            for _id in biom_table.ids(axis='observation'):
-                f.write('>{0}\n{0}\n'.format(_id))
+        write_observation_ids_as_fasta(biom_fp, fna_fp)
         try:
-            q2params['reads'] = qiime2.Artifact.import_data(
-                'FeatureData[Sequence]', fna_fp)
+            q2params['reads'] = import_data('FeatureData[Sequence]', fna_fp)
         except (ValueError, qiime2.core.exceptions.ValidationError) as e:
             msg = str(e)
             if 'DNAFASTAFormat file' in msg:
@@ -463,14 +755,96 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
             return False, None, 'Error converting "%s": %s' % (
                 'Input Table', msg)
 
+        # we only need to classify the sequences that are not in the
+        # taxonomy cache, see classifiers.py
+        assignments_key = get_assignments_key(
+            q2inputs['classifier'][0], q2params)
+        sequences = load_observation_ids(biom_fp)
+        cached_assignments = None
+        if assignments_key is not None:
+            cached_assignments = get_cached_assignments(
+                assignments_key, sequences)
+        if cached_assignments is not None and len(cached_assignments.index):
+            missing = sequences[~pd.Index(sequences).isin(
+                cached_assignments.index)]
+            if len(missing):
+                fna_fp = join(out_dir, 'sequences-not-cached.fna')
+                with open(fna_fp, 'w') as f:
+                    f.write(''.join('>{0}\n{0}\n'.format(s) for s in missing))
+                q2params['reads'] = import_data(
+                    'FeatureData[Sequence]', fna_fp)
+            else:
+                # all the sequences are cached so there is nothing to run
+                q2params.pop('reads')
+        else:
+            missing = sequences
+
+        # if the user didn't change reads_per_batch & n_jobs, we select
+        # them based on the memory & CPUs of the job so large tables don't
+        # run out of memory, see get_classify_sklearn_batching
+        rpb = method_params.get('reads_per_batch')
+        if 'n_jobs' not in q2params and (rpb is None or q2params.get(
+                'reads_per_batch', rpb.default) == rpb.default):
+            reads_per_batch, n_jobs = get_classify_sklearn_batching(
+                q2inputs['classifier'][0], len(missing), cpus=cpus)
+            if 'reads_per_batch' in method_params:
+                q2params['reads_per_batch'] = reads_per_batch
+            if 'n_jobs' in method_params:
+                q2params['n_jobs'] = n_jobs
+        n_jobs = q2params.get('n_jobs', 1)
+    else:
+        # the jobs/threads parameters the user didn't change are set to
+        # the CPUs available to the job, see resources.py
+        n_jobs = fill_thread_parameters(q2params, method_params, cpus)
+
+    # the OpenMP/BLAS threads of each of the jobs of the method, so together
+    # they don't use more than the CPUs of the job; note that n_jobs can be
+    # 'auto' or negative (relative to all the CPUs)
+    if not isinstance(n_jobs, int) or n_jobs < 1:
+        n_jobs = cpus
+    blas_threads = max(cpus // n_jobs, 1)
+    step_details = ', '.join(
+        '%s: %s' % (p, q2params[p]) for p in
+        ('reads_per_batch', ) + THREAD_PARAMETERS if p in q2params)
+    if step_details:
+        step_details = ' (%s)' % step_details
+
     qclient.update_job_step(
-        job_id, "Step 3 of 4: Running '%s %s'" % (q2plugin, q2method))
+        job_id, "Step 3 of 4: Running '%s %s'%s" % (
+            q2plugin, q2method, step_details))
+    profile.start_phase('Running')
     try:
-        results = method(**q2params)
+        # note that the classifier is the artifact from the classifiers pool,
+        # see classifiers.py
+        if 'reads' in q2params or not (
+                q2plugin == 'feature-classifier' and
+                q2method == 'classify_sklearn'):
+            with limit_threads(blas_threads):
+                results = method(**q2params)
+        else:
+            results = None
     except Exception as e:
         return False, None, 'Error running: %s' % str(e)
 
+    if q2plugin == 'feature-classifier' and q2method == 'classify_sklearn' \
+            and cached_assignments is not None:
+        if results is not None:
+            assignments = results.classification.view(pd.DataFrame)
+            add_cached_assignments(assignments_key, assignments)
+            assignments = pd.concat([cached_assignments, assignments])
+        else:
+            assignments = cached_assignments
+        if len(cached_assignments.index):
+            # keeping the order of the features in the table
+            assignments = assignments.loc[sequences]
+            if assignments['Confidence'].isnull().all():
+                assignments = assignments.drop(columns=['Confidence'])
+            results = qiime2.sdk.Results(
+                ['classification'], [qiime2.Artifact.import_data(
+                    'FeatureData[Taxonomy]', assignments)])
+
     qclient.update_job_step(job_id, "Step 4 of 4: Processing results")
+    profile.start_phase('Processing results')
     out_info = []
 
     # if feature_classifier and classify_sklearn we need to add the taxonomy
@@ -478,13 +852,9 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
     if q2plugin == 'feature-classifier' and q2method == 'classify_sklearn':
         new_biom = join(out_dir, 'feature-table-with-taxonomy.biom')
         new_qza = join(out_dir, 'feature-table-with-taxonomy.qza')
-        df = results[0].view(pd.DataFrame)
-        df.rename(columns={'Taxon': 'taxonomy'}, inplace=True)
-        df['taxonomy'] = [[y.strip() for y in x]
-                          for x in df['taxonomy'].str.split(';')]
-        biom_table.add_metadata(df.to_dict(orient='index'), axis='observation')
-        with biom_open(new_biom, 'w') as bf:
-            biom_table.to_hdf5(bf, 'Generated in Qiita')
+        write_table_with_taxonomy(
+            load_table(biom_fp), results[0].view(pd.DataFrame), new_biom,
+            'Generated in Qiita')
 
         qza = qiime2.Artifact.import_data(
             'FeatureTable[Frequency]', new_biom, 'BIOMV210Format')
@@ -496,76 +866,118 @@ def call_qiime2(qclient, job_id, parameters, out_dir):
             # so we don't move the original file
             bn = basename(plain_text_fp)
             new_tree_fp = join(out_dir, bn)
-            copyfile(ainfo['files']['plain_text'][0]['filepath'], new_tree_fp)
+            place_file(ainfo['files']['plain_text'][0]['filepath'],
+                       new_tree_fp, 0o664)
             ftc_fps.append((new_tree_fp, 'plain_text'))
         out_info.append(ArtifactInfo(
             'Feature Table with Classification', 'BIOM', ftc_fps))
 
-    for aname, q2artifact in zip(results._fields, results):
+    # the outputs are independent so they are saved at the same time, in
+    # threads like the inputs in Step 2, except the tables: they are loaded
+    # and rewritten with their observation metadata so, to keep the memory
+    # of a table at a time, they are saved one after the other (in their own
+    # thread, next to the rest). The out_info (and the errors) keep the order
+    # of the outputs of the method
+    def _save_output(aname, q2artifact):
         aout = join(out_dir, aname)
         if isinstance(q2artifact, qiime2.Visualization):
             qzv_fp = q2artifact.save(aout)
-            out_info.append(
-                ArtifactInfo(aname, 'q2_visualization', [(qzv_fp, 'qzv')]))
-        else:
-            qza_fp = q2artifact.save(aout + '.qza')
-            q2artifact.export_data(output_dir=aout)
-            files = listdir(aout)
-            if len(files) != 1:
-                msg = ('Error processing results: There are some unexpected '
-                       'files: "%s"' % ', '.join(files))
-                return False, None, msg
-            fp = join(aout, files[0])
-            # making sure the newly created file comes with the correct
-            # permissions for nginx
-            chmod(fp, 0o664)
-
-            if (q2artifact.type.name == 'FeatureTable'):
-                # Re-add the observation metadata if exists in the input and if
-                # not one of the plugin/methods that actually changes that
-                # information
-                if biom_fp is not None and (q2plugin, q2method) not in [
-                        ('taxa', 'collapse'), ('greengenes2', 'non_v4_16s')]:
-                    fin = load_table(biom_fp)
-                    fout = load_table(fp)
-
-                    # making sure that the resulting biom is not empty
-                    if fout.shape == (0, 0):
-                        msg = ('The resulting table is empty, please review '
-                               'your parameters')
-                        return False, None, msg
-
-                    metadata = {
-                        i: fin.metadata(i, axis='observation')
-                        for i in fout.ids(axis='observation')}
-                    fout.add_metadata(metadata, axis='observation')
-                    with biom_open(fp, 'w') as bf:
-                        fout.to_hdf5(bf, "Qiita's Qiime2 plugin with "
-                                     "observation metadata")
-
-                # if there is a tree, let's copy it and then add it to
-                # the new artifact
-                if tree_fp is not None and analysis_id is not None:
-                    bn = basename(tree_fp)
-                    new_tree_fp = join(
-                        out_dir, aout, 'from_%s_%s' % (artifact_id, bn))
-                    copyfile(tree_fp, new_tree_fp)
-                    ai = ArtifactInfo(aname, 'BIOM', [
-                        (fp, 'biom'),
-                        (new_tree_fp, 'plain_text'),
-                        (qza_fp, 'qza')])
-                else:
-                    ai = ArtifactInfo(
-                        aname, 'BIOM', [(fp, 'biom'), (qza_fp, 'qza')])
-
-            else:
-                qtype = str(q2artifact.type)
-                if qtype not in Q2_QIITA_SEMANTIC_TYPE:
-                    if "PCoAResults % Properties('biplot')" == qtype:
-                        qtype = 'PCoAResults'
-                atype = Q2_QIITA_SEMANTIC_TYPE[qtype]
-                ai = ArtifactInfo(
-                    aname, atype, [(fp, 'plain_text'), (qza_fp, 'qza')])
-            out_info.append(ai)
+            return ArtifactInfo(
+                aname, 'q2_visualization', [(qzv_fp, 'qzv')]), None
+
+        qza_fp = q2artifact.save(aout + '.qza')
+        # making sure the newly created file comes with the correct
+        # permissions for nginx; note that it can be a hardlink to the file
+        # of the artifact, see export_artifact
+        files = export_artifact(q2artifact, aout, 0o664)
+        if len(files) != 1:
+            msg = ('Error processing results: There are some unexpected '
+                   'files: "%s"' % ', '.join(files))
+            return None, msg
+        fp = join(aout, files[0])
+
+        if q2artifact.type.name != 'FeatureTable':
+            qtype = str(q2artifact.type)
+            if qtype not in Q2_QIITA_SEMANTIC_TYPE:
+                if "PCoAResults % Properties('biplot')" == qtype:
+                    qtype = 'PCoAResults'
+            atype = Q2_QIITA_SEMANTIC_TYPE[qtype]
+            return ArtifactInfo(
+                aname, atype, [(fp, 'plain_text'), (qza_fp, 'qza')]), None
+
+        # Re-add the observation metadata if exists in the input and if
+        # not one of the plugin/methods that actually changes that
+        # information
+        if readd_obs_metadata:
+            fout = load_table(fp)
+
+            # making sure that the resulting biom is not empty
+            if fout.shape == (0, 0):
+                msg = ('The resulting table is empty, please review '
+                       'your parameters')
+                return None, msg
+
+            # the table is returned as it is when there is no metadata to
+            # add, so there is nothing to write
+            obs_fout = add_observation_metadata(fout, biom_fp, input_obs_ids)
+            if obs_fout is not fout:
+                fout = obs_fout
+                # the exported file can share its data with the artifact
+                # (see export_artifact) so we need to replace it, not to
+                # modify it
+                with biom_open(fp + '.tmp', 'w') as bf:
+                    fout.to_hdf5(bf, "Qiita's Qiime2 plugin with "
+                                 "observation metadata")
+                replace(fp + '.tmp', fp)
+                chmod(fp, 0o664)
+            # freeing memory, the other outputs can be using it
+            del fout, obs_fout
+
+        # if there is a tree, let's copy it and then add it to the new
+        # artifact
+        if tree_fp is not None and analysis_id is not None:
+            bn = basename(tree_fp)
+            new_tree_fp = join(
+                out_dir, aout, 'from_%s_%s' % (artifact_id, bn))
+            place_file(tree_fp, new_tree_fp, 0o664)
+            return ArtifactInfo(aname, 'BIOM', [
+                (fp, 'biom'),
+                (new_tree_fp, 'plain_text'),
+                (qza_fp, 'qza')]), None
+        return ArtifactInfo(
+            aname, 'BIOM', [(fp, 'biom'), (qza_fp, 'qza')]), None
+
+    readd_obs_metadata = biom_fp is not None and (q2plugin, q2method) not in [
+        ('taxa', 'collapse'), ('greengenes2', 'non_v4_16s')]
+    # the input observation ids, see tables.py; they are the same for all
+    # the outputs so we only load them once
+    is_table = [not isinstance(a, qiime2.Visualization) and
+                a.type.name == 'FeatureTable' for a in results]
+    input_obs_ids = None
+    if readd_obs_metadata and any(is_table):
+        input_obs_ids = load_observation_ids(biom_fp)
+
+    n_outputs = len(results)
+    n_light = n_outputs - sum(is_table)
+    with ThreadPoolExecutor(max_workers=1) as tables_ex, \
+            ThreadPoolExecutor(max_workers=max(min(n_light, cpus), 1)) as ex:
+        futures = [
+            (tables_ex if table else ex).submit(_save_output, aname, q2a)
+            for aname, q2a, table in zip(results._fields, results, is_table)]
+        for i, _ in enumerate(as_completed(futures)):
+            qclient.update_progress(i + 1, n_outputs, 'outputs')
+
+    for future in futures:
+        ai, msg = future.result()
+        if msg is not None:
+            return False, None, msg
+        out_info.append(ai)
+
+    if job_key is not None:
+        try:
+            add_job_to_cache(job_key, out_dir, out_info, job_names)
+        except OSError:
+            # not being able to cache (for example, disk full) is not an error
+            pass
 
     return True, out_info, ""
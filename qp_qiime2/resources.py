@@ -0,0 +1,249 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import os
+from os import environ, sysconf
+from os.path import join
+from math import ceil
+from contextlib import contextmanager
+
+# the folder where the cgroup filesystem is mounted
+CGROUP_DIR = '/sys/fs/cgroup'
+# cgroup v1 uses a huge number (close to the max int64) for no memory limit
+CGROUP_V1_NO_LIMIT = 2 ** 60
+# the parameters used by the QIIME 2 methods to set the number of jobs or
+# threads, like n_jobs in classify_sklearn or threads in beta_phylogenetic
+THREAD_PARAMETERS = ('n_jobs', 'threads', 'n_threads', 'n_jobs_or_threads')
+# the Qiita value of the THREAD_PARAMETERS that the users didn't set, so they
+# are set to the CPUs of the job, see util.py and fill_thread_parameters
+AUTO_THREADS = 'auto'
+# the ENV vars used by the OpenMP & BLAS libraries to set their threads
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                   'OPENBLAS_NUM_THREADS')
+# the ENV vars with the CPUs & memory (in bytes) limits of the job, when they
+# are not the ones of this process; for example, the jobs executed by the
+# daemon are limited by the resources of the start_qiime2 that forwarded
+# them, see daemon.py
+CPU_LIMIT_ENV_VAR = 'QP_QIIME2_CPU_LIMIT'
+MEMORY_LIMIT_ENV_VAR = 'QP_QIIME2_MEMORY_LIMIT'
+
+
+def _get_cgroup_paths():
+    """Returns the cgroup of this process for each of the controllers
+
+    Returns
+    -------
+    dict of {str: str}
+        {controller: cgroup path}; the cgroup v2 (unified) path is stored
+        under the empty string
+    """
+    paths = {}
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                _, controllers, path = line.strip().split(':', 2)
+                for controller in controllers.split(','):
+                    paths[controller] = path.lstrip('/')
+    except (OSError, ValueError):
+        pass
+    return paths
+
+
+def _read_cgroup_file(controller, fname):
+    """Reads a file of the cgroup of this process
+
+    Parameters
+    ----------
+    controller : str
+        The cgroup v1 controller, like memory, or the empty string for cgroup
+        v2
+    fname : str
+        The name of the file, like memory.max
+
+    Returns
+    -------
+    str or None
+        The contents of the file or None if it doesn't exist
+
+    Notes
+    -----
+    In containers the cgroup path in /proc/self/cgroup is not always the one
+    mounted (the cgroup namespace can hide it) so we also try the root of
+    the controller
+    """
+    path = _get_cgroup_paths().get(controller)
+    if path is None:
+        return None
+    folder = join(CGROUP_DIR, controller)
+    for fp in (join(folder, path, fname), join(folder, fname)):
+        try:
+            with open(fp) as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+def _get_slurm_cpus():
+    for var in ('SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE'):
+        if environ.get(var, '').isdigit():
+            return int(environ[var])
+    return None
+
+
+def get_memory_limit():
+    """Returns the memory available to this job
+
+    Returns
+    -------
+    int
+        The memory in bytes
+
+    Notes
+    -----
+    This is the minimum of the physical memory, the memory limit of the
+    cgroup (v2 memory.max or v1 memory.limit_in_bytes) and the memory
+    requested to SLURM (SLURM_MEM_PER_NODE or SLURM_MEM_PER_CPU times the
+    number of CPUs, both in MB), and QP_QIIME2_MEMORY_LIMIT, when present.
+    """
+    limits = [sysconf('SC_PHYS_PAGES') * sysconf('SC_PAGE_SIZE')]
+    if environ.get(MEMORY_LIMIT_ENV_VAR, '').isdigit():
+        limits.append(int(environ[MEMORY_LIMIT_ENV_VAR]))
+
+    value = _read_cgroup_file('', 'memory.max')
+    if value is not None and value.isdigit():
+        limits.append(int(value))
+    value = _read_cgroup_file('memory', 'memory.limit_in_bytes')
+    if value is not None and value.isdigit() and \
+            int(value) < CGROUP_V1_NO_LIMIT:
+        limits.append(int(value))
+
+    if environ.get('SLURM_MEM_PER_NODE', '').isdigit():
+        limits.append(int(environ['SLURM_MEM_PER_NODE']) * 2 ** 20)
+    elif environ.get('SLURM_MEM_PER_CPU', '').isdigit():
+        cpus = _get_slurm_cpus() or 1
+        limits.append(int(environ['SLURM_MEM_PER_CPU']) * cpus * 2 ** 20)
+
+    return min(limits)
+
+
+def get_cpu_count():
+    """Returns the number of CPUs available to this job
+
+    Returns
+    -------
+    int
+        The number of CPUs, at least 1
+
+    Notes
+    -----
+    This is the minimum of the CPUs this process can run on (affinity mask,
+    or all the CPUs where it's not available, like in macOS),
+    the CPU quota of the cgroup (v2 cpu.max or v1 cpu.cfs_quota_us /
+    cpu.cfs_period_us), rounded up, SLURM_CPUS_PER_TASK and
+    QP_QIIME2_CPU_LIMIT, when present.
+    """
+    sched_getaffinity = getattr(os, 'sched_getaffinity', None)
+    if sched_getaffinity is not None:
+        counts = [len(sched_getaffinity(0))]
+    else:
+        counts = [os.cpu_count() or 1]
+    if environ.get(CPU_LIMIT_ENV_VAR, '').isdigit():
+        counts.append(int(environ[CPU_LIMIT_ENV_VAR]))
+
+    value = _read_cgroup_file('', 'cpu.max')
+    if value is not None:
+        quota, _, period = value.partition(' ')
+        if quota.isdigit() and period.isdigit():
+            counts.append(ceil(int(quota) / int(period)))
+    quota = _read_cgroup_file('cpu', 'cpu.cfs_quota_us')
+    period = _read_cgroup_file('cpu', 'cpu.cfs_period_us')
+    if quota is not None and period is not None and quota.isdigit() and \
+            period.isdigit():
+        counts.append(ceil(int(quota) / int(period)))
+
+    slurm_cpus = _get_slurm_cpus()
+    if slurm_cpus is not None:
+        counts.append(slurm_cpus)
+
+    return max(min(counts), 1)
+
+
+def fill_thread_parameters(q2params, method_params, budget):
+    """Sets the unset thread parameters of a method to the thread budget
+
+    Parameters
+    ----------
+    q2params : dict
+        The parameters that will be passed to the method, without the thread
+        parameters the user didn't set (AUTO_THREADS); it's updated in place
+    method_params : dict of {str: qiime2.core.type.signature.ParameterSpec}
+        The parameters of the method signature
+    budget : int
+        The number of threads the job can use, see get_cpu_count
+
+    Returns
+    -------
+    int
+        The number of jobs/threads that the method will use; 1 if the method
+        doesn't have thread parameters
+
+    Notes
+    -----
+    Only the parameters not in q2params are set, so the values selected by
+    the user are never changed, even if they are the default ones.
+    """
+    used = 1
+    for name in THREAD_PARAMETERS:
+        if name not in method_params:
+            continue
+        value = q2params.get(name)
+        if value is None:
+            value = budget
+            q2params[name] = value
+        if isinstance(value, int) and value > used:
+            used = value
+    return used
+
+
+@contextmanager
+def limit_threads(n_threads):
+    """Limits the threads of the OpenMP & BLAS libraries within the context
+
+    Parameters
+    ----------
+    n_threads : int
+        The maximum number of threads
+
+    Notes
+    -----
+    The ENV vars are used by the libraries loaded after this, and by the
+    subprocesses of the method, and threadpoolctl (if available) limits the
+    libraries already loaded. The ENV vars already set, for example in the
+    --env-script passed to configure_qiime2, are not changed.
+    """
+    modified = []
+    for var in THREAD_ENV_VARS:
+        if var not in environ:
+            environ[var] = str(n_threads)
+            modified.append(var)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        threadpool_limits = None
+
+    try:
+        if threadpool_limits is not None:
+            with threadpool_limits(limits=n_threads):
+                yield
+        else:
+            yield
+    finally:
+        for var in modified:
+            environ.pop(var, None)
@@ -0,0 +1,250 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+# Note that biom, h5py, numpy and pandas are imported within the functions,
+# see the note in qp_qiime2.py
+
+
+def load_table_shape(biom_fp):
+    """Loads the shape of a BIOM table without loading the table
+
+    Parameters
+    ----------
+    biom_fp : str
+        The path to the BIOM table, in HDF5 format
+
+    Returns
+    -------
+    list of int
+        The number of observations and samples
+    """
+    import h5py
+
+    with h5py.File(biom_fp, 'r') as f:
+        return [int(x) for x in f.attrs['shape']]
+
+
+def load_observation_ids(biom_fp):
+    """Loads the observation ids of a BIOM table
+
+    Parameters
+    ----------
+    biom_fp : str
+        The path to the BIOM table, in HDF5 format
+
+    Returns
+    -------
+    numpy.array of str
+        The observation ids
+    """
+    import h5py
+    import numpy as np
+
+    with h5py.File(biom_fp, 'r') as f:
+        ids = f['observation/ids']
+        ids = ids.asstr()[:] if ids.size > 0 else ids[:]
+
+    return np.asarray(ids, dtype=object)
+
+
+def load_observation_metadata(biom_fp, positions=None):
+    """Loads the observation metadata of a BIOM table
+
+    Parameters
+    ----------
+    biom_fp : str
+        The path to the BIOM table, in HDF5 format
+    positions : numpy.array of int, optional
+        The positions of the observations to load, sorted and without
+        duplicates; by default, all of them
+
+    Returns
+    -------
+    list of dict or None
+        The metadata of the observations, in the same order; None if the
+        table doesn't have observation metadata
+
+    Notes
+    -----
+    Only the rows of the observation metadata at positions are read from
+    the file (not the counts or the rest of the metadata) and the values are
+    parsed like biom.load_table does
+    """
+    import h5py
+    from collections import defaultdict
+    from biom.table import general_parser, vlen_list_of_str_parser
+
+    parser = defaultdict(lambda: general_parser)
+    for category in ('taxonomy', 'Taxonomy', 'KEGG_Pathways',
+                     'collapsed_ids'):
+        parser[category] = vlen_list_of_str_parser
+
+    with h5py.File(biom_fp, 'r') as f:
+        grp = f['observation/metadata']
+        if not len(grp):
+            return None
+        n = len(positions) if positions is not None else f[
+            'observation/ids'].shape[0]
+        metadata = [{} for _ in range(n)]
+        if not n:
+            return metadata
+        for category, dset in grp.items():
+            # h5py reads the rows of a list of sorted positions
+            data = dset[:] if positions is None else dset[positions]
+            category = category.replace('@@SLASH@@', '/')
+            parse_f = parser[category]
+            for md, value in zip(metadata, data):
+                md[category] = parse_f(value)
+
+    return metadata
+
+
+def write_observation_ids_as_fasta(biom_fp, fasta_fp, chunk_size=100000):
+    """Writes the observation ids of a BIOM table as a FASTA file
+
+    Parameters
+    ----------
+    biom_fp : str
+        The path to the BIOM table, in HDF5 format
+    fasta_fp : str
+        The path where to write the FASTA file
+    chunk_size : int, optional
+        The number of ids to read at a time
+
+    Notes
+    -----
+    This is used for tables where the features are sequences (like deblur),
+    thus each id is also the sequence. Only the observation ids are read
+    from the file and in chunks, so memory doesn't depend on the size of the
+    table.
+    """
+    import h5py
+
+    with h5py.File(biom_fp, 'r') as f, open(fasta_fp, 'w') as fasta:
+        ids = f['observation/ids']
+        for start in range(0, ids.shape[0], chunk_size):
+            chunk = ids[start:start + chunk_size]
+            fasta.write(''.join(
+                '>{0}\n{0}\n'.format(
+                    _id.decode('utf-8') if isinstance(_id, bytes) else _id)
+                for _id in chunk))
+
+
+def add_observation_metadata(table, biom_fp, ids):
+    """Returns a copy of table with the observation metadata of other table
+
+    Parameters
+    ----------
+    table : biom.Table
+        The table where to add the observation metadata
+    biom_fp : str
+        The path to the BIOM table with the observation metadata, in HDF5
+        format
+    ids : numpy.array of str
+        The observation ids of biom_fp, see load_observation_ids
+
+    Returns
+    -------
+    biom.Table
+        A new table with the same data than table and the metadata of its
+        observations; the observations not in ids get the same categories,
+        with Unassigned as taxonomy and None for the rest, as biom can't
+        write tables with inconsistent categories. If biom_fp doesn't have
+        observation metadata, or none of the observations are in ids, table
+        is returned as it is
+
+    Notes
+    -----
+    The observations of table are aligned to ids in bulk by pandas and only
+    the metadata of the ones in table is read from biom_fp, so memory
+    depends on the size of table, not the size of the input. The new table
+    is created with all the metadata at once, so we don't need to update the
+    metadata of each of the observations
+    """
+    import numpy as np
+    import pandas as pd
+    from biom import Table
+
+    obs_ids = table.ids(axis='observation')
+    positions = pd.Index(ids).get_indexer(obs_ids)
+    found = positions != -1
+    if not found.any():
+        return table
+    # the rows are read in the order of the file, see
+    # load_observation_metadata
+    rows, inverse = np.unique(positions[found], return_inverse=True)
+    metadata = load_observation_metadata(biom_fp, rows)
+    if metadata is None:
+        return table
+
+    missing = {c: ['Unassigned'] if c == 'taxonomy' else None
+               for c in metadata[0]}
+    obs_metadata = [dict(missing) for _ in range(len(obs_ids))]
+    for i, j in zip(np.flatnonzero(found), inverse):
+        obs_metadata[i] = metadata[j]
+
+    return Table(
+        table.matrix_data, obs_ids, table.ids(),
+        observation_metadata=obs_metadata,
+        sample_metadata=table.metadata(axis='sample'),
+        table_id=table.table_id, type=table.type)
+
+
+def write_table_with_taxonomy(table, taxonomy, biom_fp, generated_by):
+    """Writes a BIOM table adding the taxonomy as observation metadata
+
+    Parameters
+    ----------
+    table : biom.Table
+        The table to write
+    taxonomy : pandas.DataFrame
+        The FeatureData[Taxonomy] view as DataFrame: indexed by feature id
+        with the Taxon column and, optionally, the Confidence column
+    biom_fp : str
+        The path where to write the table, in HDF5 format
+    generated_by : str
+        The generated-by attribute of the table
+
+    Notes
+    -----
+    This is equivalent to adding the taxonomy, split by ';', and confidence
+    via table.add_metadata and writing the table with to_hdf5, but without
+    creating a dict per feature: the table is written as is and then the
+    metadata datasets are written directly to the file, as biom does: a 2D
+    variable length string dataset for the taxonomy (padded with empty
+    strings) and a 1D one for the confidence. The taxonomy is split and
+    stripped by pandas per rank (column) instead of per feature.
+    """
+    import h5py
+    from biom.util import biom_open
+
+    with biom_open(biom_fp, 'w') as bf:
+        table.to_hdf5(bf, generated_by)
+
+    ids = table.ids(axis='observation')
+    if not len(ids):
+        return
+    taxonomy = taxonomy.reindex(ids)
+    ranks = taxonomy['Taxon'].str.split(';', expand=True)
+    ranks = ranks.apply(lambda x: x.str.strip()).fillna('')
+    datasets = {'taxonomy': ranks.to_numpy(dtype=object)}
+    if 'Confidence' in taxonomy.columns:
+        confidence = taxonomy['Confidence']
+        if confidence.dtype == object:
+            confidence = confidence.fillna('').astype(str)
+        datasets['Confidence'] = confidence.to_numpy()
+
+    with h5py.File(biom_fp, 'a') as f:
+        grp = f['observation/metadata']
+        for category, data in datasets.items():
+            # if the table already had this category, we replace it
+            if category in grp:
+                del grp[category]
+            dtype = h5py.string_dtype() if data.dtype == object else None
+            grp.create_dataset(category, data=data, dtype=dtype,
+                               compression='gzip')
@@ -0,0 +1,262 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from collections import namedtuple
+from os import environ, listdir
+from os.path import join
+from json import dump
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import h5py
+import numpy as np
+from biom import load_table
+
+from qp_qiime2.benchmarks import (
+    FakeQiitaClient, generate_dataset, run_benchmark, format_results,
+    save_baseline, load_baseline, compare_to_baseline, format_comparison)
+from qp_qiime2.benchmarks.baseline import BASELINE_VERSION
+from qp_qiime2.benchmarks.suite import build_parameters
+from qp_qiime2.benchmarks.synthetic import (
+    write_table, write_tree, generate_metadata, iter_feature_ids)
+
+# a simplified qiita_client.QiitaCommand
+QiitaCommand = namedtuple(
+    'QiitaCommand', ['required_parameters', 'optional_parameters'])
+
+
+class BenchmarksTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_fake_qiita_client(self):
+        artifacts = {1: {'files': {'biom': [{'filepath': 'table.biom'}]},
+                         'analysis': 2}}
+        analyses = {2: {'1.s1': {'ph': '7'}}}
+        qclient = FakeQiitaClient(artifacts, analyses)
+
+        obs = qclient.get('/qiita_db/artifacts/1/')
+        self.assertEqual(obs, artifacts[1])
+        obs['analysis'] = None
+        self.assertEqual(qclient.get('/qiita_db/artifacts/1/'), artifacts[1])
+        self.assertEqual(
+            qclient.get('/qiita_db/analysis/2/metadata/'), analyses[2])
+        with self.assertRaises(KeyError):
+            qclient.get('/qiita_db/artifacts/3/')
+        with self.assertRaises(ValueError):
+            qclient.get('/qiita_db/jobs/')
+        self.assertEqual([url for _, url in qclient.requests], [
+            '/qiita_db/artifacts/1/', '/qiita_db/artifacts/1/',
+            '/qiita_db/analysis/2/metadata/', '/qiita_db/artifacts/3/',
+            '/qiita_db/jobs/'])
+
+        qclient.update_job_step('job-id', 'Step 1 of 4')
+        self.assertEqual([s[1:] for s in qclient.steps],
+                         [('job-id', 'Step 1 of 4')])
+
+    def test_build_parameters(self):
+        command = QiitaCommand(
+            {'qp-hide-plugin': ('string', 'diversity'),
+             'qp-hide-method': ('string', 'beta_phylogenetic'),
+             'The feature table [table]': ('artifact', ['BIOM']),
+             'qp-hide-paramThe feature table [table]': ('string', 'table'),
+             'Phylogenetic tree': (
+                 'choice:["None", "Artifact tree, if exists"]', 'None'),
+             'qp-hide-paramPhylogenetic tree': ('string', 'phylogeny')},
+            {'The metric (metric)': ('choice:["Unweighted UniFrac"]',
+                                     'Unweighted UniFrac'),
+             'qp-hide-paramThe metric (metric)': ('string', 'metric'),
+             'The threads (threads)': ('integer', 1),
+             'qp-hide-paramThe threads (threads)': ('string', 'threads')})
+
+        obs = build_parameters(command, 5, {'threads': 2}, True)
+        self.assertEqual(obs, {
+            'qp-hide-plugin': 'diversity',
+            'qp-hide-method': 'beta_phylogenetic',
+            'The feature table [table]': '5',
+            'qp-hide-paramThe feature table [table]': 'table',
+            'Phylogenetic tree': 'Artifact tree, if exists',
+            'qp-hide-paramPhylogenetic tree': 'phylogeny',
+            'The metric (metric)': 'Unweighted UniFrac',
+            'qp-hide-paramThe metric (metric)': 'metric',
+            'The threads (threads)': '2',
+            'qp-hide-paramThe threads (threads)': 'threads'})
+
+        obs = build_parameters(command, 5, {}, False)
+        self.assertEqual(obs['Phylogenetic tree'], 'None')
+        self.assertEqual(obs['The threads (threads)'], '1')
+
+    def test_generate_dataset(self):
+        dataset = generate_dataset(self.out_dir, 10, 50, seed=3)
+        table = load_table(dataset['biom'])
+        self.assertEqual(table.shape, (50, 10))
+        self.assertEqual(sorted(dataset['metadata']), sorted(table.ids()))
+        self.assertEqual(dataset['sampling_depth'],
+                         table.sum(axis='sample').min())
+        with open(dataset['tree']) as f:
+            tree = f.read()
+        for oid in table.ids(axis='observation'):
+            self.assertIn(oid, tree)
+
+        # it's deterministic
+        other = generate_dataset(mkdtemp(dir=self.out_dir), 10, 50, seed=3)
+        self.assertEqual(load_table(other['biom']), table)
+        self.assertEqual(other['metadata'], dataset['metadata'])
+
+    @patch('qp_qiime2.benchmarks.synthetic.MAX_NNZ_IN_MEMORY', 50)
+    @patch('qp_qiime2.benchmarks.synthetic.CHUNK_SIZE', 7)
+    def test_write_table(self):
+        # with small chunks & blocks to make sure they are merged correctly
+        fp = join(self.out_dir, 'table.biom')
+        totals = write_table(fp, 30, 100, seed=1)
+        table = load_table(fp)
+        self.assertEqual(table.shape, (100, 30))
+        np.testing.assert_array_equal(totals, table.sum(axis='sample'))
+        self.assertEqual(list(table.ids(axis='observation')), [
+            fid for chunk in iter_feature_ids(100, seed=1) for fid in chunk])
+        for md in table.metadata(axis='observation'):
+            self.assertTrue(md['taxonomy'][0] == 'Unassigned' or
+                            len(md['taxonomy']) == 7)
+        # every sample has some features
+        self.assertTrue((table.sum(axis='sample') > 0).all())
+
+        # the counts per feature (CSR) and per sample (CSC) are the same
+        with h5py.File(fp, 'r') as f:
+            obs = f['observation/matrix']
+            smp = f['sample/matrix']
+            self.assertEqual(f.attrs['nnz'], table.nnz)
+            csr = table.matrix_data.tocsr()
+            np.testing.assert_array_equal(obs['indptr'][:], csr.indptr)
+            np.testing.assert_array_equal(obs['indices'][:], csr.indices)
+            np.testing.assert_array_equal(obs['data'][:], csr.data)
+            csc = table.matrix_data.tocsc()
+            np.testing.assert_array_equal(smp['indptr'][:], csc.indptr)
+            np.testing.assert_array_equal(smp['data'][:], csc.data)
+
+    def test_write_tree(self):
+        fp = join(self.out_dir, 'tree.tre')
+        write_tree(fp, 5, seed=1)
+        with open(fp) as f:
+            obs = f.read()
+        self.assertTrue(obs.startswith('(('))
+        self.assertTrue(obs.endswith(')root;\n'))
+        self.assertEqual(obs.count('('), 4)
+        self.assertEqual(obs.count(':'), 8)
+        for fid in next(iter_feature_ids(5, seed=1)):
+            self.assertIn(fid + ':', obs)
+
+    def test_generate_metadata(self):
+        obs = generate_metadata(200, seed=2)
+        self.assertEqual(len(obs), 200)
+        self.assertEqual(obs, generate_metadata(200, seed=2))
+        self.assertNotEqual(obs, generate_metadata(200, seed=3))
+        values = [md['ph'] for md in obs.values()]
+        self.assertTrue(any(v in ('not provided', 'not collected', '')
+                            for v in values))
+        numeric = [float(v) for v in values if v.replace('.', '').isdigit()]
+        self.assertGreater(len(numeric), 150)
+        self.assertEqual(
+            {md['host_sex'] for md in obs.values()} - {
+                'not provided', 'not collected', 'not applicable',
+                'missing: not provided', ''}, {'female', 'male'})
+
+    def test_run_benchmark(self):
+        dataset = generate_dataset(self.out_dir, 10, 50)
+        cache_dir = mkdtemp()
+        self.addCleanup(rmtree, cache_dir)
+        with patch.dict(environ, {'QP_QIIME2_CACHE': cache_dir}):
+            obs = run_benchmark('rarefy', dataset, self.out_dir)
+            # the benchmark used its own empty caches, not the ones set
+            self.assertEqual(environ['QP_QIIME2_CACHE'], cache_dir)
+        self.assertEqual(listdir(cache_dir), [])
+        self.assertTrue(obs['success'])
+        self.assertEqual(obs['name'], 'rarefy')
+        self.assertEqual(
+            [p['name'] for p in obs['phases']],
+            ['Collecting information', 'Converting', 'Running',
+             'Processing results'])
+        # the job steps are coalesced so, as the job is fast, only the first
+        # one is sent, see qiita.JobStepReporter
+        self.assertEqual(obs['steps'][0][1],
+                         'Step 1 of 4: Collecting information')
+        self.assertGreater(obs['peak_rss'], 0)
+        self.assertIn('Processing results', format_results([obs]))
+
+    def test_baseline(self):
+        fp = join(self.out_dir, 'baseline.json')
+        dataset = {'samples': 10, 'features': 50, 'seed': 0, 'richness': None}
+        results = [
+            {'name': 'alpha', 'success': True, 'message': '',
+             'wall_time': 10.0, 'peak_rss': 100 * 2 ** 20},
+            {'name': 'beta', 'success': True, 'message': '',
+             'wall_time': 1.0, 'peak_rss': 100 * 2 ** 20}]
+        save_baseline(fp, results, dataset)
+        baseline = load_baseline(fp)
+        self.assertEqual(baseline['version'], BASELINE_VERSION)
+        self.assertEqual(baseline['dataset'], dataset)
+        self.assertEqual(baseline['benchmarks'], {
+            'alpha': {'wall_time': 10.0, 'peak_rss': 100 * 2 ** 20},
+            'beta': {'wall_time': 1.0, 'peak_rss': 100 * 2 ** 20}})
+
+        # a failed benchmark can't be a baseline
+        failed = {'name': 'rarefy', 'success': False, 'message': 'Boom!',
+                  'wall_time': 1.0, 'peak_rss': None}
+        with self.assertRaisesRegex(ValueError, 'Boom!'):
+            save_baseline(fp, results + [failed], dataset)
+
+        # alpha is 30% slower, beta is 40% slower but only by 0.4s, and
+        # both use 20% more memory
+        current = [
+            {'name': 'alpha', 'success': True, 'message': '',
+             'wall_time': 13.0, 'peak_rss': 120 * 2 ** 20},
+            {'name': 'beta', 'success': True, 'message': '',
+             'wall_time': 1.4, 'peak_rss': 120 * 2 ** 20},
+            dict(failed), {'name': 'collapse', 'success': True,
+                           'message': '', 'wall_time': 1.0,
+                           'peak_rss': 2 ** 20}]
+        obs = compare_to_baseline(current, baseline, dataset)
+        self.assertEqual(
+            [(c['name'], c['metric'], c['regression']) for c in obs], [
+                ('alpha', 'wall_time', True), ('alpha', 'peak_rss', False),
+                ('beta', 'wall_time', False), ('beta', 'peak_rss', False),
+                ('rarefy', 'wall_time', True), ('rarefy', 'peak_rss', True),
+                ('collapse', 'wall_time', False),
+                ('collapse', 'peak_rss', False)])
+        self.assertAlmostEqual(obs[0]['ratio'], 1.3)
+        self.assertIsNone(obs[6]['baseline'])
+        self.assertIsNone(obs[6]['ratio'])
+
+        obs = compare_to_baseline(current, baseline, dataset, tolerance=0.5,
+                                  memory_tolerance=0.1)
+        self.assertEqual(
+            [(c['name'], c['metric']) for c in obs if c['regression']], [
+                ('alpha', 'peak_rss'), ('beta', 'peak_rss'),
+                ('rarefy', 'wall_time'), ('rarefy', 'peak_rss')])
+        table = format_comparison(obs)
+        self.assertIn('+30.0%', table)
+        self.assertEqual(table.count('REGRESSION'), 4)
+
+        # the dataset must be the same
+        with self.assertRaisesRegex(ValueError, 'not the same'):
+            compare_to_baseline(current, baseline, dict(dataset, seed=1))
+
+        # and the version of the file
+        baseline['version'] = BASELINE_VERSION + 1
+        with open(fp, 'w') as f:
+            dump(baseline, f)
+        with self.assertRaisesRegex(ValueError, 'not supported'):
+            load_baseline(fp)
+
+
+if __name__ == '__main__':
+    main()
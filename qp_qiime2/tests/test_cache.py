@@ -0,0 +1,146 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, utime, makedirs, listdir
+from os.path import join, isdir, exists, basename
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_qiime2.cache import (
+    get_cache_dir, hash_key, load_json, save_json, hash_file,
+    get_cached_file, add_to_cache, evict_cache)
+
+
+class CacheTests(TestCase):
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        self.old_cache = environ.pop('QP_QIIME2_CACHE', None)
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+        environ.pop('QP_QIIME2_CACHE', None)
+        if self.old_cache is not None:
+            environ['QP_QIIME2_CACHE'] = self.old_cache
+
+    def test_get_cache_dir(self):
+        self.assertIsNone(get_cache_dir('registry'))
+
+        environ['QP_QIIME2_CACHE'] = self.cache_dir
+        obs = get_cache_dir('registry')
+        self.assertEqual(obs, join(self.cache_dir, 'registry'))
+        self.assertTrue(isdir(obs))
+
+    def test_hash_key(self):
+        self.assertEqual(hash_key({'a': 1, 'b': [1, 2]}),
+                         hash_key({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(hash_key({'a': 1}), hash_key({'a': 2}))
+
+    def test_load_save_json(self):
+        fp = join(self.cache_dir, 'test.json')
+        self.assertIsNone(load_json(fp))
+        save_json(fp, {'a': [1, 2]})
+        self.assertEqual(load_json(fp), {'a': [1, 2]})
+
+        with open(fp, 'w') as f:
+            f.write('{not valid')
+        self.assertIsNone(load_json(fp))
+
+    def test_hash_file(self):
+        fp = join(self.cache_dir, 'file.txt')
+        with open(fp, 'w') as f:
+            f.write('some content')
+        exp = ('290f493c44f5d63d06b374d0a5abd292fae38b92cab2fae5efefe1b0e9347f'
+               '56')
+        self.assertEqual(hash_file(fp), exp)
+
+        # with caching enabled the hash is stored and reused
+        environ['QP_QIIME2_CACHE'] = self.cache_dir
+        self.assertEqual(hash_file(fp, block_size=3), exp)
+        self.assertEqual(hash_file(fp), exp)
+        self.assertEqual(len(listdir(get_cache_dir('hashes'))), 1)
+
+        # the stored hashes are not evicted while hashing, only with the
+        # rest of the cache
+        environ['QP_QIIME2_CACHE_MAX_SIZE'] = '0'
+        self.addCleanup(environ.pop, 'QP_QIIME2_CACHE_MAX_SIZE', None)
+        with open(fp, 'a') as f:
+            f.write(' and more')
+        self.assertNotEqual(hash_file(fp), exp)
+        self.assertEqual(len(listdir(get_cache_dir('hashes'))), 2)
+        evict_cache('hashes')
+        self.assertEqual(listdir(get_cache_dir('hashes')), [])
+
+    def test_add_get_cached_file(self):
+        def _writer(fp):
+            with open(fp, 'w') as f:
+                f.write('x' * 1024)
+
+        # no cache, nothing happens
+        self.assertIsNone(add_to_cache('artifacts', 'key1', '.qza', _writer))
+        self.assertIsNone(get_cached_file('artifacts', 'key1', '.qza'))
+
+        environ['QP_QIIME2_CACHE'] = self.cache_dir
+        self.assertIsNone(get_cached_file('artifacts', 'key1', '.qza'))
+        obs = add_to_cache('artifacts', 'key1', '.qza', _writer)
+        self.assertEqual(basename(obs), 'key1.qza')
+        self.assertEqual(get_cached_file('artifacts', 'key1', '.qza'), obs)
+
+        # a failing writer doesn't leave files behind
+        def _failing_writer(fp):
+            raise ValueError('failing')
+        with self.assertRaises(ValueError):
+            add_to_cache('artifacts', 'key2', '.qza', _failing_writer)
+        self.assertIsNone(get_cached_file('artifacts', 'key2', '.qza'))
+
+    def test_evict_cache(self):
+        environ['QP_QIIME2_CACHE'] = self.cache_dir
+
+        def _writer(fp):
+            with open(fp, 'w') as f:
+                f.write('x' * 1024)
+
+        fps = [add_to_cache('artifacts', 'key%d' % i, '.qza', _writer)
+               for i in range(3)]
+        for i, fp in enumerate(fps):
+            utime(fp, (i, i))
+        # using key0 makes it the most recently used
+        get_cached_file('artifacts', 'key0', '.qza')
+
+        # 2 files fit in the cache
+        evict_cache('artifacts', 2048 / 2 ** 30)
+        self.assertTrue(exists(fps[0]))
+        self.assertFalse(exists(fps[1]))
+        self.assertTrue(exists(fps[2]))
+
+    def test_evict_cache_folders(self):
+        environ['QP_QIIME2_CACHE'] = self.cache_dir
+        cache_dir = get_cache_dir('jobs')
+
+        folders = []
+        for i in range(3):
+            folder = join(cache_dir, 'key%d' % i)
+            makedirs(join(folder, 'sub'))
+            for fp in (join(folder, 'a.txt'), join(folder, 'sub', 'b.txt')):
+                with open(fp, 'w') as f:
+                    f.write('x' * 1024)
+            utime(folder, (i, i))
+            folders.append(folder)
+        # the folders being written are ignored
+        makedirs(join(cache_dir, 'key3.tmp'))
+
+        # each folder has 2KB, so 2 of them fit in the cache
+        evict_cache('jobs', 4096 / 2 ** 30)
+        self.assertFalse(exists(folders[0]))
+        self.assertTrue(exists(folders[1]))
+        self.assertTrue(exists(folders[2]))
+        self.assertTrue(exists(join(cache_dir, 'key3.tmp')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from os import environ, utime, stat
+from os.path import join
+from shutil import rmtree
+from sqlite3 import connect
+from tempfile import mkdtemp
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import pandas as pd
+
+from qp_qiime2.cache import get_cache_dir
+from qp_qiime2.classifiers import (
+    load_classifier, CLASSIFIERS_POOL, get_assignments_key,
+    get_cached_assignments, add_cached_assignments,
+    get_classify_sklearn_batching, BASE_MEMORY, ASSIGNMENT_SIZE)
+
+
+class ClassifiersTests(TestCase):
+    def test_load_classifier(self):
+        fp = join(environ.get('QP_QIIME2_DBS'),
+                  'gg-13-8-99-515-806-nb-classifier.qza')
+        CLASSIFIERS_POOL.pop(fp, None)
+        self.addCleanup(CLASSIFIERS_POOL.pop, fp, None)
+
+        obs = load_classifier(fp)
+        self.assertEqual(str(obs.type), 'TaxonomicClassifier')
+        self.assertIn(fp, CLASSIFIERS_POOL)
+        # the second time it comes from the pool
+        self.assertIs(load_classifier(fp), obs)
+
+        # if the file changes, it's loaded again
+        fstat = stat(fp)
+        utime(fp, (fstat.st_atime, fstat.st_mtime + 1))
+        self.addCleanup(utime, fp, (fstat.st_atime, fstat.st_mtime))
+        new = load_classifier(fp)
+        self.assertIsNot(new, obs)
+        self.assertEqual(new.uuid, obs.uuid)
+
+    def test_cached_assignments(self):
+        old_cache = environ.pop('QP_QIIME2_CACHE', None)
+        if old_cache is not None:
+            self.addCleanup(environ.__setitem__, 'QP_QIIME2_CACHE', old_cache)
+        # caching disabled, the classifier is not even hashed
+        self.assertIsNone(get_assignments_key('not-a-classifier.qza', {}))
+        self.assertIsNone(get_cached_assignments('key', ['AAA']))
+
+        cache_dir = mkdtemp()
+        self.addCleanup(rmtree, cache_dir)
+        environ['QP_QIIME2_CACHE'] = cache_dir
+        self.addCleanup(environ.pop, 'QP_QIIME2_CACHE')
+
+        obs = get_cached_assignments('key', ['AAA', 'CCC'])
+        self.assertEqual(len(obs.index), 0)
+        self.assertEqual(list(obs.columns), ['Taxon', 'Confidence'])
+
+        taxonomy = pd.DataFrame(
+            {'Taxon': ['k__Bacteria; p__Firmicutes', 'k__Bacteria'],
+             'Confidence': ['0.98', '0.71']},
+            index=pd.Index(['AAA', 'GGG'], name='Feature ID'))
+        add_cached_assignments('key', taxonomy)
+        obs = get_cached_assignments('key', ['AAA', 'CCC'])
+        self.assertEqual(obs.index.name, 'Feature ID')
+        self.assertEqual(list(obs.index), ['AAA'])
+        self.assertEqual(obs.loc['AAA', 'Taxon'], 'k__Bacteria; p__Firmicutes')
+        self.assertEqual(obs.loc['AAA', 'Confidence'], '0.98')
+        # other keys (classifiers/parameters) don't share assignments
+        obs = get_cached_assignments('other-key', ['AAA', 'GGG'])
+        self.assertEqual(len(obs.index), 0)
+
+        # taxonomies without confidence
+        add_cached_assignments('other-key', taxonomy[['Taxon']])
+        obs = get_cached_assignments('other-key', ['GGG'])
+        self.assertEqual(obs.loc['GGG', 'Taxon'], 'k__Bacteria')
+        self.assertIsNone(obs.loc['GGG', 'Confidence'])
+
+    def test_evict_assignments(self):
+        cache_dir = mkdtemp()
+        self.addCleanup(rmtree, cache_dir)
+
+        def _taxonomy(sequences):
+            return pd.DataFrame(
+                {'Taxon': ['k__Bacteria'] * len(sequences)},
+                index=pd.Index(sequences, name='Feature ID'))
+
+        # room for 3 assignments
+        with patch.dict(environ, {
+                'QP_QIIME2_CACHE': cache_dir,
+                'QP_QIIME2_CACHE_MAX_SIZE': str(
+                    3 * ASSIGNMENT_SIZE / 2 ** 30)}):
+            with patch('qp_qiime2.classifiers.time',
+                       side_effect=range(1, 10)):
+                add_cached_assignments('key', _taxonomy(['AAA', 'CCC']))
+                add_cached_assignments('key', _taxonomy(['GGG']))
+                # using AAA so CCC is the least recently used
+                get_cached_assignments('key', ['AAA'])
+                add_cached_assignments('key', _taxonomy(['TTT']))
+
+            obs = get_cached_assignments('key', ['AAA', 'CCC', 'GGG', 'TTT'])
+        self.assertCountEqual(obs.index, ['AAA', 'GGG', 'TTT'])
+
+    def test_assignments_old_database(self):
+        # the databases without the last access of the assignments
+        cache_dir = mkdtemp()
+        self.addCleanup(rmtree, cache_dir)
+        with patch.dict(environ, {'QP_QIIME2_CACHE': cache_dir}):
+            with connect(join(get_cache_dir('taxonomy'),
+                              'assignments.sqlite')) as conn:
+                conn.execute(
+                    'CREATE TABLE assignments (key TEXT, sequence TEXT, '
+                    'taxon TEXT, confidence TEXT, '
+                    'PRIMARY KEY (key, sequence))')
+                conn.execute("INSERT INTO assignments VALUES "
+                             "('key', 'AAA', 'k__Bacteria', '0.9')")
+            conn.close()
+
+            obs = get_cached_assignments('key', ['AAA'])
+        self.assertEqual(obs.loc['AAA', 'Taxon'], 'k__Bacteria')
+
+    def test_get_classify_sklearn_batching(self):
+        out_dir = mkdtemp()
+        self.addCleanup(rmtree, out_dir)
+        # a fake classifier, 64 MB uncompressed: 512 taxa, so each read
+        # needs 12 KB
+        mb = 2 ** 20
+        gb = 2 ** 30
+        fp = join(out_dir, 'classifier.qza')
+        with ZipFile(fp, 'w', compression=ZIP_DEFLATED) as zf:
+            zf.writestr('data/sklearn_pipeline.tar', b'\0' * 64 * mb)
+
+        # plenty of memory: all the CPUs with the max batch size
+        self.assertEqual(get_classify_sklearn_batching(
+            fp, 1000000, memory=100 * gb, cpus=4), (20000, 4))
+        # the batches are not larger than needed
+        self.assertEqual(get_classify_sklearn_batching(
+            fp, 10000, memory=100 * gb, cpus=4), (2500, 4))
+        # small tables use a single job
+        self.assertEqual(get_classify_sklearn_batching(
+            fp, 500, memory=100 * gb, cpus=4), (500, 1))
+        # less memory: smaller batches
+        memory = 2.5 * gb
+        rpb, n_jobs = get_classify_sklearn_batching(
+            fp, 1000000, memory=memory, cpus=4)
+        self.assertEqual(n_jobs, 4)
+        self.assertLess(rpb, 20000)
+        self.assertLessEqual(
+            BASE_MEMORY + (n_jobs + 1) * 64 * mb + n_jobs * rpb * 12 * 2 ** 10,
+            0.8 * memory)
+        # even less memory: fewer jobs
+        rpb, n_jobs = get_classify_sklearn_batching(
+            fp, 1000000, memory=1.5 * gb, cpus=4)
+        self.assertEqual(n_jobs, 1)
+        self.assertGreaterEqual(rpb, 1000)
+        # not enough memory at all
+        self.assertEqual(get_classify_sklearn_batching(
+            fp, 1000000, memory=gb, cpus=4), (1000, 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from os import environ, stat, getcwd
+from os.path import join, exists
+from json import dumps, loads
+from shutil import rmtree
+from socket import socket, AF_UNIX, SOCK_STREAM
+from stat import S_IMODE
+from tempfile import mkdtemp
+from threading import Thread
+
+from qp_qiime2.daemon import QiitaDaemon, execute_in_daemon
+from qp_qiime2.resources import get_cpu_count, get_memory_limit
+
+
+def _fake_plugin(url, job_id, output_dir):
+    if job_id == 'failure':
+        raise ValueError('This job failed')
+    with open(join(output_dir, job_id), 'w') as f:
+        f.write(url)
+    # the environment of the job, to check what the worker received
+    with open(join(output_dir, job_id + '.json'), 'w') as f:
+        f.write(dumps({'environ': dict(environ), 'cwd': getcwd(),
+                       'cpus': get_cpu_count(),
+                       'memory': get_memory_limit()}))
+
+
+class DaemonTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.socket_path = join(self.out_dir, 'qp-qiime2.sock')
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def _start_daemon(self):
+        server = QiitaDaemon(self.socket_path, _fake_plugin, 2)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        def _stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+        self.addCleanup(_stop)
+
+    def test_execute_in_daemon_no_daemon(self):
+        self.assertFalse(execute_in_daemon(
+            self.socket_path, 'https://localhost:8383', 'job-id',
+            self.out_dir))
+        self.assertFalse(exists(join(self.out_dir, 'job-id')))
+
+    def test_execute_in_daemon_permission_error(self):
+        # for example, a stale socket of a daemon of another user
+        with patch('qp_qiime2.daemon.socket') as mock_socket:
+            sock = mock_socket.return_value.__enter__.return_value
+            sock.connect.side_effect = PermissionError(13, 'Permission denied')
+            self.assertFalse(execute_in_daemon(
+                self.socket_path, 'https://localhost:8383', 'job-id',
+                self.out_dir))
+
+    def test_execute_in_daemon_not_accepted(self):
+        # the daemon closes the connection before accepting the job
+        with socket(AF_UNIX, SOCK_STREAM) as server:
+            server.bind(self.socket_path)
+            server.listen(1)
+
+            def _serve():
+                conn, _ = server.accept()
+                with conn, conn.makefile('rb') as f:
+                    f.readline()
+            thread = Thread(target=_serve)
+            thread.start()
+            self.assertFalse(execute_in_daemon(
+                self.socket_path, 'https://localhost:8383', 'job-id',
+                self.out_dir))
+            thread.join()
+
+    def test_execute_in_daemon(self):
+        self._start_daemon()
+        self.assertTrue(execute_in_daemon(
+            self.socket_path, 'https://localhost:8383', 'job-id',
+            self.out_dir))
+        with open(join(self.out_dir, 'job-id')) as f:
+            self.assertEqual(f.read(), 'https://localhost:8383')
+
+    def test_socket_permissions(self):
+        self._start_daemon()
+        self.assertEqual(S_IMODE(stat(self.socket_path).st_mode), 0o600)
+
+    def test_request(self):
+        # the job is sent with the environment and limits of this process
+        requests = []
+        with socket(AF_UNIX, SOCK_STREAM) as server:
+            server.bind(self.socket_path)
+            server.listen(1)
+
+            def _serve():
+                conn, _ = server.accept()
+                with conn, conn.makefile('rwb') as f:
+                    requests.append(loads(f.readline()))
+                    f.write(b'{"accepted": true}\n')
+                    f.write(b'{"success": true, "error": ""}\n')
+            thread = Thread(target=_serve)
+            thread.start()
+            self.assertTrue(execute_in_daemon(
+                self.socket_path, 'https://localhost:8383', 'job-id',
+                self.out_dir))
+            thread.join()
+
+        self.assertEqual(requests, [{
+            'url': 'https://localhost:8383', 'job_id': 'job-id',
+            'output_dir': self.out_dir, 'environ': dict(environ),
+            'cwd': getcwd(), 'cpus': get_cpu_count(),
+            'memory': get_memory_limit()}])
+
+    def test_request_context(self):
+        # the worker uses the environment and limits of the request
+        self._start_daemon()
+        request = {'url': 'https://localhost:8383', 'job_id': 'job-id',
+                   'output_dir': self.out_dir,
+                   'environ': {'SLURM_JOB_ID': '1234'}, 'cwd': self.out_dir,
+                   'cpus': 1, 'memory': 2 ** 20}
+        with socket(AF_UNIX, SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            sock.sendall(dumps(request).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                self.assertTrue(loads(f.readline())['accepted'])
+                self.assertTrue(loads(f.readline())['success'])
+
+        with open(join(self.out_dir, 'job-id.json')) as f:
+            obs = loads(f.read())
+        self.assertEqual(obs['environ'], {
+            'SLURM_JOB_ID': '1234', 'QP_QIIME2_CPU_LIMIT': '1',
+            'QP_QIIME2_MEMORY_LIMIT': str(2 ** 20)})
+        self.assertEqual(obs['cwd'], self.out_dir)
+        self.assertEqual(obs['cpus'], 1)
+        self.assertEqual(obs['memory'], 2 ** 20)
+        # and the daemon is not changed
+        self.assertNotIn('SLURM_JOB_ID', environ)
+
+    def test_execute_in_daemon_error(self):
+        self._start_daemon()
+        with self.assertRaisesRegex(RuntimeError, 'This job failed'):
+            execute_in_daemon(
+                self.socket_path, 'https://localhost:8383', 'failure',
+                self.out_dir)
+
+
+if __name__ == '__main__':
+    main()
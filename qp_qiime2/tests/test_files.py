@@ -0,0 +1,148 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from os import mkdir, stat, chmod
+from os.path import join, samefile, exists
+from stat import S_IMODE
+from shutil import rmtree
+from tempfile import mkdtemp
+from types import SimpleNamespace
+
+from qp_qiime2.files import place_file, export_artifact, reflink
+
+
+class FakeArtifact(object):
+    def __init__(self, data_dir):
+        self._archiver = SimpleNamespace(data_dir=data_dir)
+        self.exported = False
+
+    def export_data(self, output_dir):
+        self.exported = True
+        mkdir(output_dir)
+        with open(join(output_dir, 'exported.txt'), 'w') as f:
+            f.write('exported')
+
+
+class FilesTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+        self.src = join(self.out_dir, 'tree.tre')
+        with open(self.src, 'w') as f:
+            f.write('(a,b);')
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_reflink(self):
+        dst = join(self.out_dir, 'reflink.tre')
+        try:
+            reflink(self.src, dst)
+        except OSError:
+            # the filesystem doesn't support reflinks, making sure that we
+            # don't leave anything behind
+            self.assertFalse(exists(dst))
+        else:
+            self.assertFalse(samefile(self.src, dst))
+            with open(dst) as f:
+                self.assertEqual(f.read(), '(a,b);')
+
+    def test_place_file(self):
+        dst = join(self.out_dir, 'from_5_tree.tre')
+        with patch('qp_qiime2.files.reflink', side_effect=OSError('no')):
+            place_file(self.src, dst)
+        self.assertTrue(samefile(self.src, dst))
+
+    def test_place_file_permissions(self):
+        chmod(self.src, 0o644)
+        dst = join(self.out_dir, 'from_5_tree.tre')
+        with patch('qp_qiime2.files.reflink', side_effect=OSError('no')):
+            place_file(self.src, dst, 0o664)
+        # the permissions are different so we can't use a hardlink
+        self.assertFalse(samefile(self.src, dst))
+        self.assertEqual(S_IMODE(stat(dst).st_mode), 0o664)
+        self.assertEqual(S_IMODE(stat(self.src).st_mode), 0o644)
+
+        # with the same permissions we can
+        dst = join(self.out_dir, 'from_6_tree.tre')
+        chmod(self.src, 0o664)
+        with patch('qp_qiime2.files.reflink', side_effect=OSError('no')):
+            place_file(self.src, dst, 0o664)
+        self.assertTrue(samefile(self.src, dst))
+
+    def test_place_file_copy(self):
+        dst = join(self.out_dir, 'from_5_tree.tre')
+        with patch('qp_qiime2.files.reflink', side_effect=OSError('no')), \
+                patch('qp_qiime2.files.link', side_effect=OSError('no')):
+            place_file(self.src, dst, 0o664)
+        self.assertFalse(samefile(self.src, dst))
+        self.assertEqual(S_IMODE(stat(dst).st_mode), 0o664)
+        with open(dst) as f:
+            self.assertEqual(f.read(), '(a,b);')
+
+    def test_export_artifact(self):
+        data_dir = join(self.out_dir, 'data')
+        mkdir(data_dir)
+        with open(join(data_dir, 'distance-matrix.tsv'), 'w') as f:
+            f.write('\ta\tb\n')
+        artifact = FakeArtifact(data_dir)
+
+        aout = join(self.out_dir, 'distance_matrix')
+        with patch('qp_qiime2.files.reflink', side_effect=OSError('no')):
+            obs = export_artifact(artifact, aout)
+        self.assertEqual(obs, ['distance-matrix.tsv'])
+        self.assertFalse(artifact.exported)
+        self.assertEqual(
+            stat(join(aout, 'distance-matrix.tsv')).st_ino,
+            stat(join(data_dir, 'distance-matrix.tsv')).st_ino)
+
+    def test_export_artifact_permissions(self):
+        # the files of qiime2 are never chmod-ed via a hardlink
+        data_dir = join(self.out_dir, 'data')
+        mkdir(data_dir)
+        src = join(data_dir, 'distance-matrix.tsv')
+        with open(src, 'w') as f:
+            f.write('\ta\tb\n')
+        chmod(src, 0o444)
+        artifact = FakeArtifact(data_dir)
+
+        aout = join(self.out_dir, 'distance_matrix')
+        with patch('qp_qiime2.files.reflink', side_effect=OSError('no')):
+            export_artifact(artifact, aout, 0o664)
+        dst = join(aout, 'distance-matrix.tsv')
+        self.assertFalse(samefile(src, dst))
+        self.assertEqual(S_IMODE(stat(dst).st_mode), 0o664)
+        self.assertEqual(S_IMODE(stat(src).st_mode), 0o444)
+
+        # the exported files are chmod-ed too
+        artifact = FakeArtifact(join(self.out_dir, 'does-not-exist'))
+        aout = join(self.out_dir, 'out')
+        export_artifact(artifact, aout, 0o664)
+        self.assertEqual(
+            S_IMODE(stat(join(aout, 'exported.txt')).st_mode), 0o664)
+
+    def test_export_artifact_fallback(self):
+        # data with subfolders
+        data_dir = join(self.out_dir, 'data')
+        mkdir(data_dir)
+        mkdir(join(data_dir, 'subfolder'))
+        artifact = FakeArtifact(data_dir)
+        obs = export_artifact(artifact, join(self.out_dir, 'out1'))
+        self.assertEqual(obs, ['exported.txt'])
+        self.assertTrue(artifact.exported)
+
+        # not extracted archive
+        artifact = FakeArtifact(join(self.out_dir, 'does-not-exist'))
+        obs = export_artifact(artifact, join(self.out_dir, 'out2'))
+        self.assertEqual(obs, ['exported.txt'])
+        self.assertTrue(artifact.exported)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, makedirs, listdir
+from os.path import join, exists
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qiita_client import ArtifactInfo
+
+from qp_qiime2.jobs import (
+    get_job_key, get_cached_job, add_job_to_cache, is_reusable,
+    OUT_INFO_FILENAME)
+
+
+class JobsTests(TestCase):
+    def setUp(self):
+        self.cache_dir = mkdtemp()
+        self.out_dir = mkdtemp()
+        self.old_cache = environ.pop('QP_QIIME2_CACHE', None)
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+        rmtree(self.out_dir)
+        environ.pop('QP_QIIME2_CACHE', None)
+        if self.old_cache is not None:
+            environ['QP_QIIME2_CACHE'] = self.old_cache
+
+    def _write_outputs(self, out_dir):
+        makedirs(join(out_dir, 'distance_matrix'))
+        files = {'distance_matrix.qza': 'qza',
+                 'distance_matrix/distance-matrix.tsv': 'plain_text'}
+        for fp, content in files.items():
+            with open(join(out_dir, fp), 'w') as f:
+                f.write(content)
+        return [ArtifactInfo('distance_matrix', 'distance_matrix', [
+            (join(out_dir, 'distance_matrix/distance-matrix.tsv'),
+             'plain_text'),
+            (join(out_dir, 'distance_matrix.qza'), 'qza')])]
+
+    def test_get_job_key(self):
+        inputs = {'table': ('FeatureTable[Frequency]', 'abc'),
+                  'phylogeny': None}
+        key = get_job_key('diversity', 'beta_phylogenetic',
+                          {'metric': 'unweighted_unifrac'}, inputs)
+        self.assertEqual(key, get_job_key(
+            'diversity', 'beta_phylogenetic',
+            {'metric': 'unweighted_unifrac'}, dict(inputs)))
+        # the performance parameters are not part of the key
+        self.assertEqual(key, get_job_key(
+            'diversity', 'beta_phylogenetic',
+            {'metric': 'unweighted_unifrac', 'threads': 8}, inputs))
+        # but everything else is
+        self.assertNotEqual(key, get_job_key(
+            'diversity', 'beta_phylogenetic',
+            {'metric': 'weighted_unifrac'}, inputs))
+        self.assertNotEqual(key, get_job_key(
+            'diversity', 'beta_phylogenetic',
+            {'metric': 'unweighted_unifrac'},
+            dict(inputs, table=('FeatureTable[Frequency]', 'abd'))))
+        self.assertNotEqual(key, get_job_key(
+            'diversity', 'beta', {'metric': 'unweighted_unifrac'}, inputs))
+
+        # the sets don't depend on their order
+        self.assertEqual(
+            get_job_key('diversity', 'alpha', {'metrics': {'a', 'b'}}, {}),
+            get_job_key('diversity', 'alpha', {'metrics': {'b', 'a'}}, {}))
+
+    def test_is_reusable(self):
+        self.assertTrue(is_reusable(
+            'diversity', 'beta', {'metric': 'braycurtis'}))
+        # the methods with random results are never reused
+        self.assertFalse(is_reusable(
+            'feature-table', 'rarefy', {'sampling_depth': 10}))
+        self.assertFalse(is_reusable(
+            'diversity', 'core_metrics', {'sampling_depth': 10}))
+        # unless they have a seed
+        self.assertTrue(is_reusable(
+            'sample-classifier', 'split_table', {'random_state': 1}))
+        self.assertFalse(is_reusable(
+            'sample-classifier', 'split_table', {'random_state': None}))
+
+    def test_jobs_cache(self):
+        job_dir = join(self.out_dir, 'job1')
+        out_info = self._write_outputs(job_dir)
+
+        # without QP_QIIME2_CACHE there is no cache
+        self.assertFalse(add_job_to_cache('key', job_dir, out_info))
+        self.assertIsNone(get_cached_job('key', job_dir))
+
+        environ['QP_QIIME2_CACHE'] = self.cache_dir
+        self.assertIsNone(get_cached_job('key', job_dir))
+        self.assertTrue(add_job_to_cache('key', job_dir, out_info))
+        self.assertEqual(listdir(join(self.cache_dir, 'jobs')), ['key'])
+        self.assertTrue(exists(
+            join(self.cache_dir, 'jobs', 'key', OUT_INFO_FILENAME)))
+        # storing it twice is fine
+        self.assertTrue(add_job_to_cache('key', job_dir, out_info))
+        self.assertEqual(listdir(join(self.cache_dir, 'jobs')), ['key'])
+
+        new_dir = join(self.out_dir, 'job2')
+        obs = get_cached_job('key', new_dir)
+        self.assertEqual(len(obs), 1)
+        self.assertEqual(obs[0].output_name, 'distance_matrix')
+        self.assertEqual(obs[0].artifact_type, 'distance_matrix')
+        self.assertEqual(obs[0].files, [
+            (join(new_dir, 'distance_matrix/distance-matrix.tsv'),
+             'plain_text'),
+            (join(new_dir, 'distance_matrix.qza'), 'qza')])
+        for (fp, _), (exp_fp, _) in zip(obs[0].files, out_info[0].files):
+            with open(fp) as f, open(exp_fp) as g:
+                self.assertEqual(f.read(), g.read())
+
+        # the files named after the job are renamed for the new job
+        tree_fp = join(job_dir, 'from_1_tree.tre')
+        with open(tree_fp, 'w') as f:
+            f.write('(a,b);')
+        out_info[0].files.append((tree_fp, 'plain_text'))
+        self.assertTrue(add_job_to_cache(
+            'key3', job_dir, out_info, {'{tree}': 'from_1_tree.tre'}))
+        self.assertTrue(exists(join(self.cache_dir, 'jobs', 'key3', '{tree}')))
+        new_dir = join(self.out_dir, 'job3')
+        obs = get_cached_job('key3', new_dir, {'{tree}': 'from_2_tree.tre'})
+        self.assertEqual(obs[0].files[-1],
+                         (join(new_dir, 'from_2_tree.tre'), 'plain_text'))
+        with open(join(new_dir, 'from_2_tree.tre')) as f:
+            self.assertEqual(f.read(), '(a,b);')
+        out_info[0].files.pop()
+
+        # the jobs with files outside of their folder are not stored
+        out_info[0].files.append((join(self.out_dir, 'other.txt'), 'log'))
+        self.assertFalse(add_job_to_cache('key2', job_dir, out_info))
+        self.assertIsNone(get_cached_job('key2', job_dir))
+
+
+if __name__ == '__main__':
+    main()
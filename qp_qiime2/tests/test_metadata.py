@@ -0,0 +1,117 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os import environ, listdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import pandas as pd
+import qiime2
+
+from qp_qiime2.metadata import build_metadata, get_analysis_metadata
+
+
+class FakeQiitaClient(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.requests = []
+
+    def get(self, url):
+        self.requests.append(url)
+        return self.payload
+
+
+class MetadataTests(TestCase):
+    def setUp(self):
+        self.out_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def _load_metadata_from_tsv(self, payload):
+        # this is how the metadata used to be generated in call_qiime2
+        metadata = pd.DataFrame.from_dict(payload, orient='index')
+        metadata_fp = join(self.out_dir, 'metadata.txt')
+        metadata.to_csv(metadata_fp, index_label='#SampleID', na_rep='',
+                        sep='\t', encoding='utf-8')
+        metadata_columns = qiime2.Metadata.load(metadata_fp).columns
+        return qiime2.Metadata.load(
+            metadata_fp, column_missing_schemes={
+                c: 'INSDC:missing' for c in metadata_columns})
+
+    def test_build_metadata(self):
+        payload = {
+            '1.SKB1.640202': {
+                'ph': '6.94', 'depth': '0.15', 'env': 'soil',
+                'season': ' winter ', 'qiita_empty': '',
+                'altitude': 'not applicable', 'description': '1',
+                'collection': 'missing: control sample', 'count': '10'},
+            '1.SKB2.640194': {
+                'ph': '7.15', 'depth': 'not provided', 'env': 'soil',
+                'season': 'summer', 'qiita_empty': '',
+                'altitude': 'not applicable', 'description': 'a sample',
+                'collection': '2011-11-11', 'count': '12'},
+            '1.SKB3.640195': {
+                'ph': '6.8', 'depth': '0.3', 'env': 'not collected',
+                'season': '', 'qiita_empty': '',
+                'altitude': '0', 'description': '3',
+                'collection': '2011-11-12', 'count': ''}}
+
+        exp = self._load_metadata_from_tsv(payload)
+        obs = build_metadata(payload)
+
+        self.assertEqual(obs.columns, exp.columns)
+        self.assertEqual(obs.id_header, exp.id_header)
+        pd.testing.assert_frame_equal(
+            obs.to_dataframe(encode_missing=True),
+            exp.to_dataframe(encode_missing=True))
+        pd.testing.assert_frame_equal(obs.to_dataframe(), exp.to_dataframe())
+        self.assertEqual(obs, exp)
+
+        # making sure that the types are the expected ones
+        self.assertEqual(obs.columns['ph'].type, 'numeric')
+        self.assertEqual(obs.columns['depth'].type, 'numeric')
+        self.assertEqual(obs.columns['altitude'].type, 'numeric')
+        self.assertEqual(obs.columns['env'].type, 'categorical')
+        self.assertEqual(obs.columns['description'].type, 'categorical')
+        self.assertEqual(obs.columns['collection'].type, 'categorical')
+
+    def test_get_analysis_metadata(self):
+        payload = {
+            '1.SKB1.640202': {'ph': '6.94', 'env': 'soil'},
+            '1.SKB2.640194': {'ph': 'not provided', 'env': 'soil'}}
+        qclient = FakeQiitaClient(payload)
+        exp = build_metadata(payload)
+
+        old_cache = environ.pop('QP_QIIME2_CACHE', None)
+        if old_cache is not None:
+            self.addCleanup(environ.__setitem__, 'QP_QIIME2_CACHE', old_cache)
+        self.assertEqual(get_analysis_metadata(qclient, 1), exp)
+        self.assertEqual(
+            qclient.requests, ['/qiita_db/analysis/1/metadata/'])
+
+        environ['QP_QIIME2_CACHE'] = self.out_dir
+        self.addCleanup(environ.pop, 'QP_QIIME2_CACHE')
+        self.assertEqual(get_analysis_metadata(qclient, 1), exp)
+        self.assertEqual(len(listdir(join(self.out_dir, 'metadata'))), 1)
+        # the second time, it's loaded from the cache
+        self.assertEqual(get_analysis_metadata(qclient, 1), exp)
+        self.assertEqual(len(listdir(join(self.out_dir, 'metadata'))), 1)
+
+        # changing the metadata invalidates the cache
+        qclient.payload['1.SKB2.640194']['ph'] = '7.1'
+        obs = get_analysis_metadata(qclient, 1)
+        self.assertEqual(obs, build_metadata(qclient.payload))
+        self.assertNotEqual(obs, exp)
+        self.assertEqual(len(listdir(join(self.out_dir, 'metadata'))), 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join, realpath, dirname, getsize
+from collections import namedtuple
+from json import load
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_qiime2.profiling import JobProfile, get_path_size
+
+# a simplified qiita_client.ArtifactInfo
+ArtifactInfo = namedtuple(
+    'ArtifactInfo', ['output_name', 'artifact_type', 'files'])
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.biom_fp = join(
+            dirname(realpath(__file__)), 'support_files', 'deblur.biom')
+        self.out_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_get_path_size(self):
+        fp = join(self.out_dir, 'file.txt')
+        with open(fp, 'w') as f:
+            f.write('1234')
+        self.assertEqual(get_path_size(fp), 4)
+        self.assertEqual(get_path_size(self.out_dir), 4)
+
+    def test_job_profile(self):
+        profile = JobProfile('job-id')
+        profile.start_phase('Collecting information')
+        profile.start_phase('Running')
+        # using some memory and CPU
+        data = [str(i) for i in range(100000)]
+        del data
+        profile.add_input('table', self.biom_fp, 'biom')
+        profile.add_input('phylogeny', join(self.out_dir, 'missing.tre'))
+
+        txt_fp = join(self.out_dir, 'output.txt')
+        with open(txt_fp, 'w') as f:
+            f.write('output')
+        profile.add_outputs([ArtifactInfo(
+            'distance_matrix', 'distance_matrix',
+            [(txt_fp, 'plain_text')])])
+
+        fp = join(self.out_dir, 'profile.json')
+        profile.save(fp, True)
+        with open(fp) as f:
+            obs = load(f)
+
+        self.assertEqual(obs['job_id'], 'job-id')
+        self.assertTrue(obs['success'])
+        self.assertEqual([p['name'] for p in obs['phases']],
+                         ['Collecting information', 'Running'])
+        for phase in obs['phases']:
+            for k in ('wall', 'cpu', 'children_cpu', 'read_bytes',
+                      'write_bytes', 'rchar', 'wchar', 'children_peak_rss'):
+                self.assertGreaterEqual(phase[k], 0)
+            self.assertGreater(phase['peak_rss'], 0)
+
+        self.assertEqual(obs['inputs'], [
+            {'name': 'table', 'filepath': self.biom_fp, 'type': 'biom',
+             'size': getsize(self.biom_fp), 'shape': [3748, 5]},
+            {'name': 'phylogeny', 'filepath': join(
+                self.out_dir, 'missing.tre'), 'type': None, 'size': None}])
+        self.assertEqual(obs['outputs'], [
+            {'name': 'distance_matrix', 'filepath': txt_fp,
+             'type': 'plain_text', 'size': 6}])
+
+
+if __name__ == '__main__':
+    main()
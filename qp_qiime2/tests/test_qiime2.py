@@ -24,7 +24,8 @@ from qp_qiime2 import plugin
 from qp_qiime2.qp_qiime2 import (
     ALPHA_DIVERSITY_METRICS_PHYLOGENETIC, ALPHA_DIVERSITY_METRICS,
     BETA_DIVERSITY_METRICS, BETA_DIVERSITY_METRICS_PHYLOGENETIC, call_qiime2,
-    CORRELATION_METHODS, BETA_GROUP_SIG_METHODS)
+    CORRELATION_METHODS, BETA_GROUP_SIG_METHODS, _convert_input,
+    _get_job_key)
 
 
 class qiime2Tests(PluginTestCase):
@@ -51,6 +52,50 @@ class qiime2Tests(PluginTestCase):
                 else:
                     remove(fp)
 
+    def test_convert_input(self):
+        tree_fp = join(self.basedir, 'prune_97_gg_13_8.tre')
+        qza, msg = _convert_input('phylogeny', tree_fp, 'Phylogeny[Rooted]')
+        self.assertIsNone(msg)
+        self.assertEqual(str(qza.type), 'Phylogeny[Rooted]')
+
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        bad_fp = join(out_dir, 'bad.txt')
+        with open(bad_fp, 'w') as f:
+            f.write('this is not a tree nor a table')
+        qza, msg = _convert_input('phylogeny', bad_fp, 'Phylogeny[Rooted]')
+        self.assertIsNone(qza)
+        self.assertTrue(msg.startswith(
+            'Error converting "Phylogeny[Rooted]": '))
+        qza, msg = _convert_input(
+            'FeatureData[Taxonomy]', bad_fp, 'FeatureData[Taxonomy]')
+        self.assertIsNone(qza)
+        self.assertEqual(msg, 'Error generating taxonomy. Are you sure '
+                              'this artifact has taxonomy?')
+
+    def test_get_job_key_without_biom(self):
+        # the taxonomy of a non BIOM artifact is identified by its own file
+        out_dir = mkdtemp()
+        self._clean_up_files.append(out_dir)
+        taxonomy_fp = join(out_dir, 'taxonomy.tsv')
+        with open(taxonomy_fp, 'w') as f:
+            f.write('Feature ID\tTaxon\nA\tk__Bacteria\n')
+        q2inputs = {'FeatureData[Taxonomy]': (
+            taxonomy_fp, 'FeatureData[Taxonomy]')}
+
+        key = _get_job_key(None, 'taxa', 'collapse', {'level': 2}, q2inputs,
+                           None, 1, None, None, {})
+        self.assertIsNotNone(key)
+        self.assertEqual(key, _get_job_key(
+            None, 'taxa', 'collapse', {'level': 2}, q2inputs, None, 1, None,
+            None, {}))
+
+        # a missing file can't be identified
+        remove(taxonomy_fp)
+        self.assertIsNone(_get_job_key(
+            None, 'taxa', 'collapse', {'level': 2}, q2inputs, None, 1, None,
+            None, {}))
+
     def test_not_analysis_artifact(self):
         params = {
             'The feature table to be rarefied. [table]': '5',
@@ -0,0 +1,316 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+from socket import timeout as socket_timeout
+from threading import Event, Lock
+from time import time, sleep
+
+from qiita_client.testing import PluginTestCase
+
+from qp_qiime2.qiita import (
+    QiitaJobClient, JobStepReporter, is_transient_error, call_with_retries,
+    MAX_CONCURRENT_REQUESTS, MIN_STEP_INTERVAL, HEARTBEAT_INTERVAL,
+    ARTIFACT_URL)
+
+
+class SlowQiitaClient(object):
+    def __init__(self, delay=0.2, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.fail_with = RuntimeError('Qiita is down')
+        self.requests = []
+        self.steps = []
+        self._lock = Lock()
+
+    def get(self, url, **kwargs):
+        with self._lock:
+            self.requests.append(url)
+        sleep(self.delay)
+        if url in self.fail:
+            self.fail.remove(url)
+            raise self.fail_with
+        return {'url': url}
+
+    def update_job_step(self, job_id, new_step, ignore_error=False):
+        self.steps.append((job_id, new_step))
+
+
+def wait_for(condition, timeout=5):
+    """Waits for condition to be true, polling it until timeout"""
+    end = time() + timeout
+    while not condition():
+        if time() > end:
+            raise AssertionError('Timed out waiting for the condition')
+        sleep(0.01)
+
+
+class QiitaJobClientTests(TestCase):
+    def test_get(self):
+        qclient = SlowQiitaClient(delay=0)
+        client = QiitaJobClient(qclient)
+        self.assertEqual(client.get('/a/'), {'url': '/a/'})
+        self.assertEqual(client.get('/a/'), {'url': '/a/'})
+        self.assertEqual(client.get('/b/'), {'url': '/b/'})
+        self.assertEqual(qclient.requests, ['/a/', '/b/'])
+
+        # the requests with extra arguments are not memoized
+        client.get('/a/', rettype='object')
+        self.assertEqual(qclient.requests, ['/a/', '/b/', '/a/'])
+
+        # the job steps are sent in the background, see JobStepReporter
+        client.update_job_step('job-id', 'Step 1 of 4')
+        wait_for(lambda: qclient.steps)
+        self.assertEqual(qclient.steps, [('job-id', 'Step 1 of 4')])
+        client.close()
+
+    def test_prefetch(self):
+        qclient = SlowQiitaClient(delay=0.2)
+        client = QiitaJobClient(qclient)
+        start = time()
+        client.prefetch('/a/', '/b/', '/c/', '/a/')
+        for url in ('/a/', '/b/', '/c/'):
+            self.assertEqual(client.get(url), {'url': url})
+        # the requests ran at the same time
+        self.assertLess(time() - start, 0.5)
+        self.assertCountEqual(qclient.requests, ['/a/', '/b/', '/c/'])
+        client.close()
+
+    def test_get_error(self):
+        qclient = SlowQiitaClient(delay=0, fail=['/a/'])
+        client = QiitaJobClient(qclient)
+        client.prefetch('/a/')
+        with self.assertRaisesRegex(RuntimeError, 'Qiita is down'):
+            client.get('/a/')
+        # the failures are not memoized
+        self.assertEqual(client.get('/a/'), {'url': '/a/'})
+        self.assertEqual(qclient.requests, ['/a/', '/a/'])
+        client.close()
+
+    def test_close(self):
+        started = Event()
+        release = Event()
+
+        class BlockedQiitaClient(object):
+            requests = []
+
+            def get(self, url):
+                self.requests.append(url)
+                started.set()
+                release.wait()
+                return {}
+
+        qclient = BlockedQiitaClient()
+        client = QiitaJobClient(qclient)
+        client.prefetch(*['/%d/' % i for i in range(10)])
+        started.wait()
+        # close doesn't wait for the running requests and cancels the rest
+        client.close()
+        pending = client._futures[MAX_CONCURRENT_REQUESTS:]
+        self.assertTrue(pending)
+        self.assertTrue(all(f.cancelled() for f in pending))
+        release.set()
+        self.assertLess(len(qclient.requests), 10)
+
+    @patch('qp_qiime2.qiita.RETRY_BACKOFF', 0)
+    def test_get_retries(self):
+        qclient = SlowQiitaClient(delay=0, fail=['/a/'])
+        client = QiitaJobClient(qclient)
+        qclient.fail_with = ConnectionResetError('Connection reset by peer')
+        # the transient errors are retried
+        self.assertEqual(client.get('/a/'), {'url': '/a/'})
+        self.assertEqual(qclient.requests, ['/a/', '/a/'])
+        client.close()
+
+
+class RetriesTests(TestCase):
+    def test_is_transient_error(self):
+        self.assertTrue(is_transient_error(ConnectionError('reset')))
+        self.assertTrue(is_transient_error(TimeoutError('timed out')))
+        self.assertTrue(is_transient_error(socket_timeout('timed out')))
+        # and the ones of requests
+        from requests.exceptions import (
+            ConnectionError as RequestsConnectionError, ReadTimeout)
+        self.assertTrue(is_transient_error(RequestsConnectionError('refused')))
+        self.assertTrue(is_transient_error(ReadTimeout('timed out')))
+        # but not the rest of the OSErrors
+        self.assertFalse(is_transient_error(
+            FileNotFoundError(2, 'No such file or directory')))
+        self.assertFalse(is_transient_error(
+            PermissionError(13, 'Permission denied')))
+        # qiita_client already retried these
+        self.assertFalse(is_transient_error(RuntimeError(
+            "Request 'get /qiita_db/artifacts/1/' did not succeed. Status "
+            "code: 503. Message: busy")))
+        self.assertFalse(is_transient_error(RuntimeError(
+            "Request 'get /qiita_db/artifacts/1/' did not succeed. Status "
+            "code: 404. Message: not found")))
+        self.assertFalse(is_transient_error(KeyError('files')))
+
+    @patch('qp_qiime2.qiita.RETRY_BACKOFF', 0.01)
+    @patch('qp_qiime2.qiita.MAX_RETRIES', 2)
+    def test_call_with_retries(self):
+        calls = []
+
+        def func(value, errors):
+            calls.append(value)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return value
+
+        self.assertEqual(call_with_retries(func, 1, []), 1)
+        self.assertEqual(calls, [1])
+
+        calls.clear()
+        errors = [TimeoutError(), ConnectionError('reset')]
+        self.assertEqual(call_with_retries(func, 2, errors=errors), 2)
+        self.assertEqual(calls, [2, 2, 2])
+
+        # the retries are bounded
+        calls.clear()
+        errors = [TimeoutError(), TimeoutError(), TimeoutError('3rd')]
+        with self.assertRaisesRegex(TimeoutError, '3rd'):
+            call_with_retries(func, 3, errors)
+        self.assertEqual(calls, [3, 3, 3])
+
+        # and the other errors are not retried
+        calls.clear()
+        with self.assertRaises(ValueError):
+            call_with_retries(func, 4, [ValueError(), TimeoutError()])
+        self.assertEqual(calls, [4])
+
+    def test_connection_pool(self):
+        # all the requests of a job fit in the connection pool of requests,
+        # so their connections are kept alive and reused
+        from requests.adapters import DEFAULT_POOLSIZE
+        self.assertLessEqual(MAX_CONCURRENT_REQUESTS, DEFAULT_POOLSIZE)
+
+
+class QiitaClientTests(PluginTestCase):
+    def test_get(self):
+        # the job requests go through the real client
+        client = QiitaJobClient(self.qclient)
+        client.prefetch(ARTIFACT_URL % 8)
+        obs = client.get(ARTIFACT_URL % 8)
+        self.assertEqual(obs, self.qclient.get(ARTIFACT_URL % 8))
+        self.assertIn('files', obs)
+        client.close()
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class JobStepReporterTests(TestCase):
+    def _advance(self, reporter, clock, seconds):
+        # the thread waits in real time, so it's woken up to check the clock
+        with reporter._cond:
+            clock.now += seconds
+            reporter._cond.notify_all()
+
+    def test_get_message(self):
+        reporter = JobStepReporter(SlowQiitaClient(), FakeClock())
+        reporter.update('job-id', 'Step 4 of 4: Processing results')
+        start = reporter._step_start
+        self.assertEqual(reporter.get_message(start),
+                         'Step 4 of 4: Processing results')
+        self.assertEqual(reporter.get_message(start + 3725.5),
+                         'Step 4 of 4: Processing results (elapsed: 1:02:05)')
+        reporter.update_progress(2, 5, 'outputs')
+        self.assertEqual(reporter.get_message(start + 65),
+                         'Step 4 of 4: Processing results (2 of 5 outputs, '
+                         'elapsed: 0:01:05)')
+        reporter.close()
+
+    def test_update(self):
+        qclient = SlowQiitaClient(delay=0)
+        clock = FakeClock()
+        reporter = JobStepReporter(qclient, clock)
+        # the first one is sent right away
+        reporter.update('job-id', 'Step 1 of 4')
+        wait_for(lambda: len(qclient.steps) == 1)
+        self.assertEqual(qclient.steps, [('job-id', 'Step 1 of 4')])
+
+        # these are coalesced, only the last one is sent when
+        # MIN_STEP_INTERVAL is reached
+        reporter.update('job-id', 'Step 2 of 4')
+        reporter.update('job-id', 'Step 3 of 4')
+        self._advance(reporter, clock, MIN_STEP_INTERVAL - 1)
+        self.assertEqual(qclient.steps, [('job-id', 'Step 1 of 4')])
+        self._advance(reporter, clock, 1)
+        wait_for(lambda: len(qclient.steps) == 2)
+        self.assertEqual(qclient.steps[1],
+                         ('job-id', 'Step 3 of 4 (elapsed: 0:00:05)'))
+
+        # the heartbeat, with the elapsed time
+        self._advance(reporter, clock, HEARTBEAT_INTERVAL)
+        wait_for(lambda: len(qclient.steps) == 3)
+        self.assertEqual(qclient.steps[2],
+                         ('job-id', 'Step 3 of 4 (elapsed: 0:01:05)'))
+
+        # nothing is sent after closing
+        reporter.update('job-id', 'Step 4 of 4')
+        reporter.close()
+        reporter.update('job-id', 'Step 5 of 4')
+        self._advance(reporter, clock, HEARTBEAT_INTERVAL)
+        self.assertEqual(len(qclient.steps), 3)
+        self.assertFalse(reporter._thread.is_alive())
+
+    def test_update_does_not_block(self):
+        started = Event()
+        release = Event()
+
+        class BlockedQiitaClient(object):
+            steps = []
+
+            def update_job_step(self, job_id, new_step, ignore_error=False):
+                started.set()
+                release.wait()
+                self.steps.append((job_id, new_step))
+
+        qclient = BlockedQiitaClient()
+        reporter = JobStepReporter(qclient, FakeClock())
+        reporter.update('job-id', 'Step 0')
+        self.assertTrue(started.wait(5))
+        # the updates don't wait for the one being sent
+        for i in range(1, 100):
+            reporter.update('job-id', 'Step %d' % i)
+            reporter.update_progress(i, 100, 'outputs')
+        release.set()
+        reporter.close()
+        self.assertEqual(qclient.steps, [('job-id', 'Step 0')])
+
+    def test_update_error(self):
+        qclient = SlowQiitaClient(delay=0)
+        clock = FakeClock()
+        reporter = JobStepReporter(qclient, clock)
+        calls = []
+
+        def update_job_step(job_id, new_step, ignore_error=False):
+            calls.append(new_step)
+            raise RuntimeError('Qiita is down')
+
+        qclient.update_job_step = update_job_step
+        reporter.update('job-id', 'Step 1 of 4')
+        wait_for(lambda: len(calls) == 1)
+        # the errors are ignored and the thread keeps sending the updates
+        reporter.update('job-id', 'Step 2 of 4')
+        self._advance(reporter, clock, MIN_STEP_INTERVAL)
+        wait_for(lambda: len(calls) == 2)
+        self.assertEqual(calls, ['Step 1 of 4',
+                                 'Step 2 of 4 (elapsed: 0:00:05)'])
+        reporter.close()
+
+
+if __name__ == '__main__':
+    main()
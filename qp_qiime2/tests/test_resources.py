@@ -0,0 +1,165 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from unittest.mock import patch
+import os
+from os import makedirs, sysconf, environ
+from collections import namedtuple
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from qp_qiime2.resources import (
+    get_memory_limit, get_cpu_count, fill_thread_parameters, limit_threads)
+
+# a simplified qiime2 ParameterSpec
+ParameterSpec = namedtuple('ParameterSpec', ['default'])
+
+
+class ResourcesTests(TestCase):
+    def setUp(self):
+        self.cgroup_dir = mkdtemp()
+        self.addCleanup(rmtree, self.cgroup_dir)
+        patcher = patch('qp_qiime2.resources.CGROUP_DIR', self.cgroup_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # not using the SLURM variables of the environment running the tests
+        patcher = patch.dict('qp_qiime2.resources.environ', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.physical_memory = sysconf('SC_PHYS_PAGES') * sysconf(
+            'SC_PAGE_SIZE')
+        if hasattr(os, 'sched_getaffinity'):
+            self.cpus = len(os.sched_getaffinity(0))
+        else:
+            self.cpus = os.cpu_count()
+
+    def _write_cgroup(self, paths, files):
+        patcher = patch('qp_qiime2.resources._get_cgroup_paths',
+                        return_value=paths)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for fp, value in files.items():
+            fp = join(self.cgroup_dir, fp)
+            makedirs(fp.rsplit('/', 1)[0], exist_ok=True)
+            with open(fp, 'w') as f:
+                f.write(value + '\n')
+
+    def test_get_memory_limit(self):
+        self._write_cgroup({}, {})
+        self.assertEqual(get_memory_limit(), self.physical_memory)
+
+        # SLURM
+        with patch.dict('qp_qiime2.resources.environ', {
+                'SLURM_MEM_PER_CPU': '2', 'SLURM_CPUS_PER_TASK': '3'}):
+            self.assertEqual(get_memory_limit(), 6 * 2 ** 20)
+        with patch.dict('qp_qiime2.resources.environ',
+                        {'SLURM_MEM_PER_NODE': '5'}):
+            self.assertEqual(get_memory_limit(), 5 * 2 ** 20)
+        # the limits forwarded with the job, see daemon.py
+        with patch.dict('qp_qiime2.resources.environ',
+                        {'QP_QIIME2_MEMORY_LIMIT': '4096'}):
+            self.assertEqual(get_memory_limit(), 4096)
+
+    def test_get_memory_limit_cgroup_v1(self):
+        self._write_cgroup(
+            {'memory': 'job'},
+            {'memory/job/memory.limit_in_bytes': '1024'})
+        self.assertEqual(get_memory_limit(), 1024)
+
+    def test_get_memory_limit_cgroup_v1_no_limit(self):
+        self._write_cgroup(
+            {'memory': ''},
+            {'memory/memory.limit_in_bytes': '9223372036854771712'})
+        self.assertEqual(get_memory_limit(), self.physical_memory)
+
+    def test_get_memory_limit_cgroup_v2(self):
+        self._write_cgroup({'': 'job'}, {'job/memory.max': '2048'})
+        self.assertEqual(get_memory_limit(), 2048)
+        self._write_cgroup({'': 'job'}, {'job/memory.max': 'max'})
+        self.assertEqual(get_memory_limit(), self.physical_memory)
+
+    def test_get_cpu_count(self):
+        self._write_cgroup({}, {})
+        self.assertEqual(get_cpu_count(), self.cpus)
+        with patch.dict('qp_qiime2.resources.environ',
+                        {'SLURM_CPUS_PER_TASK': '1'}):
+            self.assertEqual(get_cpu_count(), 1)
+        with patch.dict('qp_qiime2.resources.environ',
+                        {'QP_QIIME2_CPU_LIMIT': '1'}):
+            self.assertEqual(get_cpu_count(), 1)
+
+    def test_get_cpu_count_no_affinity(self):
+        # like in macOS
+        self._write_cgroup({}, {})
+        with patch('qp_qiime2.resources.os') as mock_os:
+            del mock_os.sched_getaffinity
+            mock_os.cpu_count.return_value = 3
+            self.assertEqual(get_cpu_count(), 3)
+            mock_os.cpu_count.return_value = None
+            self.assertEqual(get_cpu_count(), 1)
+
+    def test_get_cpu_count_cgroup(self):
+        # cgroup v2, 0.5 CPUs
+        self._write_cgroup({'': ''}, {'cpu.max': '50000 100000'})
+        self.assertEqual(get_cpu_count(), 1)
+        # cgroup v1, no quota
+        self._write_cgroup(
+            {'cpu': ''},
+            {'cpu/cpu.cfs_quota_us': '-1', 'cpu/cpu.cfs_period_us': '100000'})
+        self.assertEqual(get_cpu_count(), self.cpus)
+
+
+class ThreadsTests(TestCase):
+    def test_fill_thread_parameters(self):
+        method_params = {'metric': ParameterSpec('braycurtis'),
+                         'n_jobs': ParameterSpec(1)}
+        # unset
+        q2params = {'metric': 'jaccard'}
+        self.assertEqual(
+            fill_thread_parameters(q2params, method_params, 4), 4)
+        self.assertEqual(q2params, {'metric': 'jaccard', 'n_jobs': 4})
+        # set by the user to the default value
+        q2params = {'n_jobs': 1}
+        self.assertEqual(
+            fill_thread_parameters(q2params, method_params, 4), 1)
+        self.assertEqual(q2params, {'n_jobs': 1})
+        # set by the user
+        q2params = {'n_jobs': 2}
+        self.assertEqual(
+            fill_thread_parameters(q2params, method_params, 4), 2)
+        self.assertEqual(q2params, {'n_jobs': 2})
+        # without thread parameters
+        q2params = {}
+        self.assertEqual(fill_thread_parameters(
+            q2params, {'metric': ParameterSpec('braycurtis')}, 4), 1)
+        self.assertEqual(q2params, {})
+        # threads & 'auto' defaults
+        q2params = {}
+        self.assertEqual(fill_thread_parameters(
+            q2params, {'threads': ParameterSpec('auto')}, 3), 3)
+        self.assertEqual(q2params, {'threads': 3})
+
+    def test_limit_threads(self):
+        with patch.dict(environ, {'MKL_NUM_THREADS': '8'}):
+            environ.pop('OMP_NUM_THREADS', None)
+            environ.pop('OPENBLAS_NUM_THREADS', None)
+            with limit_threads(2):
+                self.assertEqual(environ['OMP_NUM_THREADS'], '2')
+                self.assertEqual(environ['OPENBLAS_NUM_THREADS'], '2')
+                # set by the user
+                self.assertEqual(environ['MKL_NUM_THREADS'], '8')
+            self.assertNotIn('OMP_NUM_THREADS', environ)
+            self.assertNotIn('OPENBLAS_NUM_THREADS', environ)
+            self.assertEqual(environ['MKL_NUM_THREADS'], '8')
+
+
+if __name__ == '__main__':
+    main()
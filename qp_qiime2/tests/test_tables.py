@@ -0,0 +1,152 @@
+# -----------------------------------------------------------------------------
+# Copyright (c) 2014--, The Qiita Development Team.
+#
+# Distributed under the terms of the BSD 3-clause License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# -----------------------------------------------------------------------------
+
+from unittest import TestCase, main
+from os.path import join, realpath, dirname
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import pandas as pd
+from biom import load_table, Table
+from biom.util import biom_open
+
+from qp_qiime2.tables import (
+    load_observation_ids, load_observation_metadata, add_observation_metadata,
+    write_observation_ids_as_fasta, write_table_with_taxonomy)
+
+
+class TablesTests(TestCase):
+    def setUp(self):
+        self.biom_fp = join(
+            dirname(realpath(__file__)), 'support_files', 'deblur.biom')
+        self.out_dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.out_dir)
+
+    def test_load_observation_metadata(self):
+        exp = load_table(self.biom_fp)
+        exp_metadata = list(exp.metadata(axis='observation'))
+        metadata = load_observation_metadata(self.biom_fp)
+        self.assertEqual(metadata, exp_metadata)
+
+        # only the observations at positions
+        metadata = load_observation_metadata(self.biom_fp, np.array([1, 4]))
+        self.assertEqual(metadata, [exp_metadata[1], exp_metadata[4]])
+        self.assertEqual(
+            load_observation_metadata(self.biom_fp, np.array([], dtype=int)),
+            [])
+
+    def test_load_observation_metadata_no_metadata(self):
+        table = Table(np.array([[1, 2], [3, 4]]), ['o1', 'o2'], ['s1', 's2'])
+        fp = join(self.out_dir, 'no-metadata.biom')
+        with biom_open(fp, 'w') as f:
+            table.to_hdf5(f, 'test')
+        self.assertIsNone(load_observation_metadata(fp))
+        # and the tables are not changed
+        self.assertIs(add_observation_metadata(
+            table, fp, load_observation_ids(fp)), table)
+
+    def test_write_observation_ids_as_fasta(self):
+        table = load_table(self.biom_fp)
+        exp = ''.join('>{0}\n{0}\n'.format(_id)
+                      for _id in table.ids(axis='observation'))
+
+        fasta_fp = join(self.out_dir, 'sequences.fna')
+        # using a chunk size that doesn't divide the number of features
+        write_observation_ids_as_fasta(self.biom_fp, fasta_fp, chunk_size=7)
+        with open(fasta_fp) as f:
+            self.assertEqual(f.read(), exp)
+
+        write_observation_ids_as_fasta(self.biom_fp, fasta_fp)
+        with open(fasta_fp) as f:
+            self.assertEqual(f.read(), exp)
+
+    def test_add_observation_metadata(self):
+        full = load_table(self.biom_fp)
+        ids = load_observation_ids(self.biom_fp)
+
+        # a subset of the table, in a different order and without metadata
+        obs_ids = full.ids(axis='observation')[:10][::-1]
+        subset = full.filter(obs_ids, axis='observation', inplace=False)
+        subset = subset.sort_order(obs_ids, axis='observation')
+        table = Table(subset.matrix_data, subset.ids(axis='observation'),
+                      subset.ids(), table_id='subset')
+        self.assertIsNone(table.metadata(axis='observation'))
+
+        obs = add_observation_metadata(table, self.biom_fp, ids)
+        self.assertEqual(obs.table_id, 'subset')
+        self.assertEqual(list(obs.ids(axis='observation')), list(obs_ids))
+        self.assertEqual(list(obs.ids()), list(subset.ids()))
+        self.assertEqual(
+            (obs.matrix_data != subset.matrix_data).nnz, 0)
+        for oid in obs_ids:
+            self.assertEqual(obs.metadata(oid, axis='observation'),
+                             full.metadata(oid, axis='observation'))
+
+        # observations without metadata in the input
+        table = Table(np.array([[1, 2]]), ['unknown'], ['s1', 's2'])
+        obs = add_observation_metadata(table, self.biom_fp, ids)
+        self.assertIs(obs, table)
+        self.assertIsNone(obs.metadata(axis='observation'))
+
+        # only some of them have metadata: the rest get the same categories
+        # so the table can be written
+        table = Table(np.array([[1, 2], [3, 4]]), [obs_ids[0], 'unknown'],
+                      ['s1', 's2'])
+        obs = add_observation_metadata(table, self.biom_fp, ids)
+        fp = join(self.out_dir, 'partial.biom')
+        with biom_open(fp, 'w') as f:
+            obs.to_hdf5(f, 'test')
+        obs = load_table(fp)
+        self.assertEqual(obs.metadata(obs_ids[0], axis='observation'),
+                         full.metadata(obs_ids[0], axis='observation'))
+        self.assertEqual(
+            obs.metadata('unknown', axis='observation')['taxonomy'],
+            ['Unassigned'])
+
+    def test_write_table_with_taxonomy(self):
+        table = load_table(self.biom_fp)
+        ids = table.ids(axis='observation')
+        taxa = ['k__Bacteria; p__Firmicutes; c__Bacilli',
+                'k__Bacteria ;p__Proteobacteria', 'Unassigned']
+        # in a different order than the table to make sure it's aligned
+        taxonomy = pd.DataFrame(
+            {'Taxon': [taxa[i % 3] for i in range(len(ids))],
+             'Confidence': [str(i / len(ids)) for i in range(len(ids))]},
+            index=pd.Index(ids, name='Feature ID'))[::-1]
+
+        # what we used to do
+        df = taxonomy.rename(columns={'Taxon': 'taxonomy'})
+        df['taxonomy'] = [[y.strip() for y in x]
+                          for x in df['taxonomy'].str.split(';')]
+        exp = table.copy()
+        exp.add_metadata(df.to_dict(orient='index'), axis='observation')
+
+        fp = join(self.out_dir, 'taxonomy.biom')
+        write_table_with_taxonomy(table, taxonomy, fp, 'Generated in Qiita')
+        obs = load_table(fp)
+        self.assertEqual(list(obs.ids(axis='observation')), list(ids))
+        self.assertEqual(list(obs.ids()), list(table.ids()))
+        self.assertEqual((obs.matrix_data != table.matrix_data).nnz, 0)
+        self.assertEqual(list(obs.metadata(axis='observation')),
+                         list(exp.metadata(axis='observation')))
+
+        # without confidence
+        write_table_with_taxonomy(
+            table, taxonomy[['Taxon']], fp, 'Generated in Qiita')
+        obs = load_table(fp)
+        self.assertEqual(
+            [md['taxonomy'] for md in obs.metadata(axis='observation')],
+            [md['taxonomy'] for md in exp.metadata(axis='observation')])
+        self.assertNotIn('Confidence', obs.metadata(axis='observation')[0])
+
+
+if __name__ == '__main__':
+    main()
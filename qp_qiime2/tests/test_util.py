@@ -7,10 +7,18 @@
 # -----------------------------------------------------------------------------
 
 from unittest import TestCase, main
+from unittest.mock import patch
+from os import environ
+from shutil import rmtree
+from tempfile import mkdtemp
 
+from qiita_client import QiitaPlugin
 from qiime2.sdk import PluginManager
 
-from qp_qiime2.util import get_qiime2_type_name_and_predicate
+from qp_qiime2 import plugin
+from qp_qiime2.util import (
+    get_qiime2_type_name_and_predicate, get_registry_cache_key,
+    load_registry_cache, save_registry_cache)
 
 
 class UtilTests(TestCase):
@@ -30,6 +38,47 @@ class UtilTests(TestCase):
         obs = get_qiime2_type_name_and_predicate(parameters['confidence'])
         self.assertEqual(exp, obs)
 
+    def test_registry_cache(self):
+        cache_dir = mkdtemp()
+        self.addCleanup(rmtree, cache_dir)
+        old_cache = environ.pop('QP_QIIME2_CACHE', None)
+        if old_cache is not None:
+            self.addCleanup(environ.__setitem__, 'QP_QIIME2_CACHE', old_cache)
+        # without QP_QIIME2_CACHE there is no cache, so not even a key
+        with patch('qp_qiime2.util.distributions') as mock_distributions:
+            self.assertIsNone(get_registry_cache_key())
+        mock_distributions.assert_not_called()
+        save_registry_cache(plugin, None)
+        self.assertIsNone(load_registry_cache(None, 'test'))
+
+        environ['QP_QIIME2_CACHE'] = cache_dir
+        self.addCleanup(environ.pop, 'QP_QIIME2_CACHE')
+        key = get_registry_cache_key()
+        self.assertIsNotNone(key)
+        self.assertIsNone(load_registry_cache(key, 'test'))
+        save_registry_cache(plugin, key)
+        self.assertIsNone(load_registry_cache(key + 'wrong', 'test'))
+        new_plugin = load_registry_cache(key, 'test')
+        self.assertIsInstance(new_plugin, QiitaPlugin)
+        self.assertEqual(new_plugin.version, plugin.version)
+
+        self.assertEqual(list(plugin.task_dict), list(new_plugin.task_dict))
+        for name, exp in plugin.task_dict.items():
+            obs = new_plugin.task_dict[name]
+            self.assertEqual(obs.description, exp.description)
+            self.assertEqual(obs.function, exp.function)
+            self.assertEqual(
+                obs.required_parameters, exp.required_parameters)
+            self.assertEqual(
+                obs.optional_parameters, exp.optional_parameters)
+            self.assertEqual(obs.outputs, exp.outputs)
+            self.assertEqual(
+                obs.default_parameter_sets, exp.default_parameter_sets)
+            self.assertEqual(obs.analysis_only, exp.analysis_only)
+
+        # the key should be stable
+        self.assertEqual(key, get_registry_cache_key())
+
 
 if __name__ == '__main__':
     main()
@@ -6,16 +6,20 @@
 # The full license is in the file LICENSE, distributed with this software.
 # -----------------------------------------------------------------------------
 
-from os import environ
-from os.path import join
+from os import environ, stat
+from os.path import join, dirname
 from glob import glob
 from json import dumps
+from importlib.metadata import distributions, version
 
-from qiita_client import QiitaCommand
+from qiita_client import QiitaPlugin, QiitaCommand
 
 from .qp_qiime2 import (
     Q2_QIITA_SEMANTIC_TYPE,
     PRIMITIVE_TYPES, call_qiime2, RENAME_COMMANDS, NOT_VALID_OUTPUTS)
+from .cache import get_cache_dir, hash_key, load_json, save_json
+from .jobs import JOB_CACHE_PARAMETER
+from .resources import THREAD_PARAMETERS, AUTO_THREADS
 
 
 def get_qiime2_type_name_and_predicate(element):
@@ -87,8 +91,119 @@ def get_extra_configuration_paths():
     return qp_qiime2_dbs, qp_filtering_qza
 
 
+def get_registry_cache_key():
+    """Generates the key of the registry cache for the current environment
+
+    Returns
+    -------
+    str or None
+        A hash of the qiime2 version, the version of each installed qiime2
+        plugin, the files in QP_QIIME2_DBS & QP_QIIME2_FILTER_QZA and the
+        source of this package; any change in those will generate a new key.
+        None if caching is disabled
+
+    Notes
+    -----
+    The plugin versions are retrieved from the package metadata, without
+    loading the plugins, as that is what we are trying to avoid; without
+    QP_QIIME2_CACHE nothing is scanned as the key is not used
+    """
+    if get_cache_dir('registry') is None:
+        return None
+
+    q2_plugins = {
+        dist.metadata['Name']: dist.version for dist in distributions()
+        if any(ep.group == 'qiime2.plugins' for ep in dist.entry_points)}
+    qp_qiime2_dbs, qp_filtering_qza = get_extra_configuration_paths()
+    extra_paths = []
+    for fp in qp_qiime2_dbs + qp_filtering_qza:
+        fstat = stat(fp)
+        extra_paths.append((fp, fstat.st_size, fstat.st_mtime))
+    sources = {}
+    for fp in sorted(glob(join(dirname(__file__), '*.py'))):
+        with open(fp, 'rb') as f:
+            sources[fp] = hash_key(f.read().decode('utf-8'))
+
+    return hash_key({
+        'qiime2': version('qiime2'), 'plugins': q2_plugins,
+        'extra_paths': extra_paths, 'sources': sources})
+
+
+def load_registry_cache(key, description):
+    """Creates the plugin and registers the commands stored in the cache
+
+    Parameters
+    ----------
+    key : str or None
+        The registry cache key, see get_registry_cache_key
+    description : str
+        The plugin description
+
+    Returns
+    -------
+    qiita_client.QiitaPlugin or None
+        The plugin with all the commands or None if there is no valid cache
+
+    Notes
+    -----
+    The plugin version, which is the qiime2 version, is stored in the cache
+    so we don't need to import qiime2 to retrieve it
+    """
+    cache_dir = get_cache_dir('registry')
+    if cache_dir is None or key is None:
+        return None
+    registry = load_json(join(cache_dir, '%s.json' % key))
+    if not registry or not registry.get('commands'):
+        return None
+
+    plugin = QiitaPlugin('qiime2', registry['version'], description)
+    for cmd in registry['commands']:
+        # JSON doesn't have tuples so let's bring them back, just to be sure
+        # that the commands are the same than the ones we would have created
+        req_params = {k: tuple(v)
+                      for k, v in cmd['required_parameters'].items()}
+        opt_params = {k: tuple(v)
+                      for k, v in cmd['optional_parameters'].items()}
+        plugin.register_command(QiitaCommand(
+            cmd['name'], cmd['description'], call_qiime2, req_params,
+            opt_params, cmd['outputs'], cmd['default_parameter_sets'],
+            analysis_only=cmd['analysis_only']))
+
+    return plugin
+
+
+def save_registry_cache(plugin, key):
+    """Stores the commands registered in plugin in the registry cache
+
+    Parameters
+    ----------
+    plugin : qiita_client.QiitaPlugin
+        The plugin with the registered commands
+    key : str or None
+        The registry cache key, see get_registry_cache_key
+    """
+    cache_dir = get_cache_dir('registry')
+    if cache_dir is None or key is None:
+        return
+
+    commands = [{
+        'name': cmd.name,
+        'description': cmd.description,
+        'required_parameters': cmd.required_parameters,
+        'optional_parameters': cmd.optional_parameters,
+        'outputs': cmd.outputs,
+        'default_parameter_sets': cmd.default_parameter_sets,
+        'analysis_only': cmd.analysis_only}
+        for cmd in plugin.task_dict.values()]
+    save_json(join(cache_dir, '%s.json' % key), {
+        'version': plugin.version, 'commands': commands})
+
+
 def register_qiime2_commands(plugin, methods_to_add, q2_expected_plugins,
                              analysis_only=True):
+    # avoid some alpha metrics within the alpha_rarefaction method
+    from q2_diversity._alpha import alpha_rarefaction_unsupported_metrics
+
     qp_qiime2_dbs, qp_filtering_qza = get_extra_configuration_paths()
 
     for q2plugin, m in methods_to_add:
@@ -264,9 +379,21 @@ def register_qiime2_commands(plugin, methods_to_add, q2_expected_plugins,
             if qname == 'diversity' and value_pair in RENAME_COMMANDS:
                 # converting to list to the serialize doesn't complaint
                 vals = list(RENAME_COMMANDS[value_pair])
+                # alpha rarefaction has some "forbidden" metrics and we need
+                # to be sure to not add them here
+                if value_pair == ('alpha_rarefaction', 'metrics'):
+                    vals = [
+                        v for v in vals if RENAME_COMMANDS[value_pair][v]
+                        not in alpha_rarefaction_unsupported_metrics]
                 data_type = 'choice:%s' % dumps(vals)
                 default = vals[0]
 
+            # the jobs/threads are set to the CPUs of the job unless the user
+            # selects a number, see resources.py
+            if pname in THREAD_PARAMETERS:
+                data_type = 'string'
+                default = AUTO_THREADS
+
             # the diversity methods can have a choice param with no values
             # so we need to fix so users can actually select things;
             # however,we want to make sure that this is the only one,
@@ -320,6 +447,10 @@ def register_qiime2_commands(plugin, methods_to_add, q2_expected_plugins,
                     # can retrieve later
                     opt_params['qp-hide-param' + ename] = ('string', pname)
 
+        # the results of an identical job are reused unless the users opt
+        # out, see jobs.py
+        opt_params[JOB_CACHE_PARAMETER] = ('boolean', True)
+
         qiime_cmd = QiitaCommand("%s [%s]" % (m.name, mid), m.description,
                                  call_qiime2, req_params, opt_params,
                                  outputs_params, {'Default': {}},
@@ -44,8 +44,9 @@ setup(name='qp-qiime2',
       url='https://github.com/qiita-spots/qp-qiime2',
       setup_requires=["cython"],
       test_suite='nose.collector',
-      packages=['qp_qiime2'],
-      scripts=['scripts/configure_qiime2', 'scripts/start_qiime2'],
+      packages=['qp_qiime2', 'qp_qiime2.benchmarks'],
+      scripts=['scripts/configure_qiime2', 'scripts/start_qiime2',
+               'scripts/start_qiime2_daemon', 'scripts/benchmark_qiime2'],
       extras_require={'test': ["nose >= 0.10.1", "pep8"]},
       install_requires=['click >= 3.3', 'future',
                         'qiita-files @ https://github.com/'